@@ -0,0 +1,343 @@
+"""
+Out-of-core training on the full pixel table.
+
+The pixel table written by create_csv.ipynb (one row per pixel, 3x3 kernel columns per feature) is far too
+large to hold in memory as a DataFrame. Here every feature column is quantized once into uint8 bins and
+written to memory-mapped .npy files, so that training and prediction only ever hold one chunk of rows in RAM.
+
+Two learners train on the bins: a random forest grown chunk by chunk (warm start), whose peak memory is bounded by
+the chunk size but whose trees each only see one chunk, and a HistGradientBoostingClassifier fitted on up to
+`max_rows` rows at once, whose histograms use the store's bins as they are. `python out_of_core.py` measures both
+against the notebook.
+"""
+import argparse
+import json
+import os
+import resource
+import time
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from sklearn.ensemble import HistGradientBoostingClassifier, RandomForestClassifier
+from sklearn.metrics import f1_score, recall_score
+from sklearn.pipeline import make_pipeline
+from sklearn.preprocessing import FunctionTransformer
+
+FRAME_SIZE = 62 * 62  # pixels per chip once the outer pixels are stripped for the 3x3 kernel
+TARGET = "tomorrows_fires"
+INDEX = "image_index"
+MAX_BINS = 255
+NAN_BIN = 255  # reserved bin for missing values, so chips can be predicted whole
+CLASS_WEIGHT = {0: 1.0, 1: 4}
+
+
+def compute_bin_edges(csv_path: str, chunk_rows: int = FRAME_SIZE * 256, sample_frac: float = 0.02,
+                      max_bins: int = MAX_BINS - 1, random_state: int = 42) -> dict:
+    """
+    Stream the csv once and compute quantile bin edges for every feature column from a random sample of rows.
+    Columns with few distinct values (fire masks, landcover classes) get one bin per value.
+    """
+    rng = np.random.default_rng(random_state)
+    samples = []
+    for chunk in pd.read_csv(csv_path, chunksize=chunk_rows):
+        keep = rng.random(len(chunk)) < sample_frac
+        samples.append(chunk.loc[keep, [c for c in chunk.columns if c not in (TARGET, INDEX)]])
+    sample = pd.concat(samples)
+
+    edges = {}
+    for column in sample.columns:
+        values = sample[column].dropna().values.astype(np.float64)
+        unique = np.unique(values)
+        if len(unique) <= max_bins:
+            # midpoints between the distinct values, so each value lands in its own bin
+            edges[column] = (unique[:-1] + unique[1:]) / 2
+        else:
+            quantiles = np.linspace(0, 1, max_bins + 1)[1:-1]
+            edges[column] = np.unique(np.quantile(values, quantiles))
+    return edges
+
+
+def quantize(values: np.ndarray, edges: np.ndarray) -> np.ndarray:
+    """Map float values onto uint8 bin codes, with NaN going to NAN_BIN."""
+    binned = np.searchsorted(edges, values, side="right").astype(np.uint8)
+    binned[np.isnan(values)] = NAN_BIN
+    return binned
+
+
+class BinnedPixelStore:
+    """
+    On-disk, pre-binned copy of the pixel table.
+
+    Rows keep the order of the csv, so the pixels of a chip are always FRAME_SIZE contiguous rows and a chip can
+    be sliced out by offset instead of filtering a DataFrame on image_index.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = Path(directory)
+        with open(self.directory / "meta.json") as f:
+            meta = json.load(f)
+        self.feature_names = meta["feature_names"]
+        self.edges = {k: np.asarray(v) for k, v in meta["edges"].items()}
+        self.X = np.load(self.directory / "X.npy", mmap_mode="r")
+        self.y = np.load(self.directory / "y.npy", mmap_mode="r")
+        self.image_index = np.load(self.directory / "image_index.npy", mmap_mode="r")
+        self.complete = np.load(self.directory / "complete.npy", mmap_mode="r")
+        self.chip_ids = np.load(self.directory / "chip_ids.npy")
+
+    @classmethod
+    def from_csv(cls, csv_path: str, directory: str, chunk_rows: int = FRAME_SIZE * 256, edges: dict = None):
+        """
+        Quantize the pixel table into a store in `directory`. Two streaming passes over the csv are made,
+        one to fit the bin edges (skipped if `edges` are given) and one to write the bins.
+        """
+        if chunk_rows % FRAME_SIZE:
+            raise ValueError(f'"chunk_rows" must be a multiple of {FRAME_SIZE} so chips are not split')
+        directory = Path(directory)
+        directory.mkdir(parents=True, exist_ok=True)
+        if edges is None:
+            edges = compute_bin_edges(csv_path, chunk_rows=chunk_rows)
+
+        columns = pd.read_csv(csv_path, nrows=0).columns
+        feature_names = [c for c in columns if c not in (TARGET, INDEX)]
+        n_rows = sum(len(chunk) for chunk in pd.read_csv(csv_path, chunksize=chunk_rows, usecols=[INDEX]))
+        if n_rows % FRAME_SIZE:
+            raise ValueError(f"{csv_path} has {n_rows} rows, expected whole chips of {FRAME_SIZE} pixels")
+
+        X = np.lib.format.open_memmap(directory / "X.npy", mode="w+", dtype=np.uint8,
+                                      shape=(n_rows, len(feature_names)))
+        y = np.lib.format.open_memmap(directory / "y.npy", mode="w+", dtype=np.uint8, shape=(n_rows,))
+        image_index = np.lib.format.open_memmap(directory / "image_index.npy", mode="w+", dtype=np.int64,
+                                                shape=(n_rows,))
+        complete = np.lib.format.open_memmap(directory / "complete.npy", mode="w+", dtype=bool, shape=(n_rows,))
+        start = 0
+        for chunk in pd.read_csv(csv_path, chunksize=chunk_rows):
+            stop = start + len(chunk)
+            for j, column in enumerate(feature_names):
+                X[start:stop, j] = quantize(chunk[column].values.astype(np.float64), edges[column])
+            y[start:stop] = np.nan_to_num(chunk[TARGET].values).astype(np.uint8)
+            image_index[start:stop] = chunk[INDEX].values.astype(np.int64)
+            # the rows kept by the notebook's df.dropna()
+            complete[start:stop] = chunk.notna().all(axis=1).values
+            start = stop
+        X.flush(), y.flush(), image_index.flush(), complete.flush()
+
+        np.save(directory / "chip_ids.npy", np.asarray(image_index[::FRAME_SIZE]))
+        with open(directory / "meta.json", "w") as f:
+            json.dump({"feature_names": feature_names, "edges": {k: v.tolist() for k, v in edges.items()}}, f)
+        return cls(directory)
+
+    def chip_offsets(self, chip_ids) -> np.ndarray:
+        """Row offsets of the first pixel of each chip in `chip_ids`."""
+        order = np.argsort(self.chip_ids)
+        found = np.searchsorted(self.chip_ids, chip_ids, sorter=order)
+        positions = order[np.minimum(found, len(order) - 1)]
+        if not np.array_equal(self.chip_ids[positions], np.asarray(chip_ids)):
+            raise KeyError("Some chip ids are not in the store")
+        return positions * FRAME_SIZE
+
+    def chip_rows(self, chip_ids) -> np.ndarray:
+        """Row indexes of every pixel of the given chips."""
+        offsets = self.chip_offsets(chip_ids)
+        return (offsets[:, None] + np.arange(FRAME_SIZE)[None, :]).ravel()
+
+    def complete_rows(self, rows) -> np.ndarray:
+        """The rows without missing values in any column, i.e. the rows the notebook keeps after dropna."""
+        rows = np.asarray(rows)
+        return rows[self.complete[rows]]
+
+
+def iter_row_chunks(rows: np.ndarray, chunk_rows: int, random_state: int = 42):
+    """
+    Yield shuffled chunks of positions into `rows`, each ordered by row index so that reads from the memmap
+    stay sequential.
+    """
+    rng = np.random.default_rng(random_state)
+    positions = rng.permutation(len(rows))
+    for start in range(0, len(rows), chunk_rows):
+        chunk = positions[start:start + chunk_rows]
+        yield chunk[np.argsort(rows[chunk])]
+
+
+def train_streaming_forest(store: BinnedPixelStore, rows: np.ndarray, chunk_rows: int = 2_000_000,
+                           trees_per_chunk: int = 10, sample_weight: np.ndarray = None,
+                           **forest_kwargs) -> RandomForestClassifier:
+    """
+    Train a random forest on every row in `rows` without loading them all at once. Each chunk of rows grows
+    `trees_per_chunk` new trees on the uint8 bins (warm start), so splits fall on the pre-computed bin edges
+    as in a histogram-based learner and peak memory is bounded by the chunk size. Each tree only sees the rows of
+    its chunk though, see train_hist_gradient_boosting for a learner fitted on all rows at once.
+    :param store: BinnedPixelStore holding the pre-binned pixel table
+    :param rows: row indexes to train on, typically store.complete_rows(store.chip_rows(train_indexes))
+    :param chunk_rows: number of rows held in memory per chunk
+    :param trees_per_chunk: trees grown on each chunk
+    :param sample_weight: optional per-row weights aligned with `rows`
+    :param forest_kwargs: passed to RandomForestClassifier, defaults match the notebook
+    :return: fitted RandomForestClassifier
+    """
+    forest_kwargs = {"n_jobs": -1, "max_depth": 10, "class_weight": CLASS_WEIGHT, **forest_kwargs}
+    model = RandomForestClassifier(n_estimators=trees_per_chunk, warm_start=True, **forest_kwargs)
+    rows = np.asarray(rows)
+    for n, chunk in enumerate(iter_row_chunks(rows, chunk_rows)):
+        model.n_estimators = trees_per_chunk * (n + 1)
+        chunk_weight = None if sample_weight is None else sample_weight[chunk]
+        model.fit(store.X[rows[chunk]], store.y[rows[chunk]], sample_weight=chunk_weight)
+    return model
+
+
+def missing_bins_to_nan(X: np.ndarray) -> np.ndarray:
+    """Float copy of binned rows with NAN_BIN as NaN, so that it is treated as a missing value."""
+    X = np.asarray(X, dtype=np.float32)
+    X[X == NAN_BIN] = np.nan
+    return X
+
+
+def train_hist_gradient_boosting(store: BinnedPixelStore, rows: np.ndarray, max_rows: int = None,
+                                 sample_weight: np.ndarray = None, random_state: int = 42, **hgb_kwargs):
+    """
+    Train a HistGradientBoostingClassifier on the bins of `rows`. There are fewer bins per column than the
+    classifier's 255, so each bin of the store gets its own histogram bin and NAN_BIN goes to the missing value
+    bin. Unlike train_streaming_forest every tree sees all the training rows, but they are held in memory at
+    once, as float64 while fitting, i.e. 8 bytes per row and feature against 1 in the store.
+    :param store: BinnedPixelStore holding the pre-binned pixel table
+    :param rows: row indexes to train on, typically store.complete_rows(store.chip_rows(train_indexes))
+    :param max_rows: if set, train on a uniform sample of at most this many rows to bound memory
+    :param sample_weight: optional per-row weights aligned with `rows`
+    :param random_state: seed of the row sample and of the classifier
+    :param hgb_kwargs: passed to HistGradientBoostingClassifier
+    :return: fitted pipeline taking the store's bins, so it can be passed to predict_chips
+    """
+    rows = np.asarray(rows)
+    if max_rows is not None and len(rows) > max_rows:
+        keep = np.sort(np.random.default_rng(random_state).choice(len(rows), max_rows, replace=False))
+        rows = rows[keep]
+        sample_weight = None if sample_weight is None else sample_weight[keep]
+    y = np.asarray(store.y[rows])
+    # CLASS_WEIGHT as sample weights, as the class_weight parameter needs a recent scikit-learn
+    weight = np.where(y == 1, CLASS_WEIGHT[1], CLASS_WEIGHT[0]).astype(np.float64)
+    if sample_weight is not None:
+        weight *= sample_weight
+    model = make_pipeline(
+        FunctionTransformer(missing_bins_to_nan),
+        HistGradientBoostingClassifier(random_state=random_state, **hgb_kwargs),
+    )
+    model.fit(store.X[rows], y, histgradientboostingclassifier__sample_weight=weight)
+    return model
+
+
+def predict_rows(model, store: BinnedPixelStore, rows: np.ndarray, chunk_rows: int = 2_000_000) -> np.ndarray:
+    """Predict the classes of `rows` chunk by chunk, in the order of `rows`."""
+    rows = np.asarray(rows)
+    return np.concatenate([model.predict(store.X[rows[start:start + chunk_rows]])
+                           for start in range(0, len(rows), chunk_rows)])
+
+
+def predict_chips(model, store: BinnedPixelStore, chip_ids, batch_chips: int = 256,
+                  proba: bool = False) -> np.ndarray:
+    """
+    Predict whole chips in batches, returning an array of shape (n_chips, 62, 62) in the order of `chip_ids`.
+    :param model: fitted classifier trained on the store's bins
+    :param store: BinnedPixelStore holding the pre-binned pixel table
+    :param chip_ids: image indexes to predict
+    :param batch_chips: number of chips predicted per call to the model
+    :param proba: return fire probabilities instead of classes
+    """
+    chip_ids = np.asarray(chip_ids)
+    predictions = np.empty((len(chip_ids), FRAME_SIZE), dtype=np.float32 if proba else np.uint8)
+    for start in range(0, len(chip_ids), batch_chips):
+        rows = store.chip_rows(chip_ids[start:start + batch_chips])
+        features = store.X[np.sort(rows)]
+        order = np.argsort(np.argsort(rows))  # undo the sort so rows follow chip_ids
+        if proba:
+            batch = model.predict_proba(features)[:, 1][order]
+        else:
+            batch = model.predict(features)[order]
+        predictions[start:start + batch_chips] = batch.reshape(-1, FRAME_SIZE)
+    return predictions.reshape(-1, 62, 62)
+
+
+def _peak_rss_mb() -> float:
+    """Peak resident set size of this process in MB (ru_maxrss is in KB on linux)"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _scores(y_true: np.ndarray, y_pred: np.ndarray) -> dict:
+    """Fire class F1 and recall on the test chips"""
+    return {"test_f1": f1_score(y_true, y_pred), "test_recall": recall_score(y_true, y_pred)}
+
+
+def _split_ids(splits_csv: str, split: str) -> np.ndarray:
+    splits = pd.read_csv(splits_csv)
+    return splits[splits["class"] == split]["sample_id"].values
+
+
+def _run_notebook_baseline(csv_path: str, splits_csv: str) -> dict:
+    """The in-memory path of random_forest.ipynb: full DataFrame, 10% sample of the training rows."""
+    start = time.perf_counter()
+    df = pd.read_csv(csv_path)
+    df.dropna(inplace=True)
+    train_df = df[df[INDEX].isin(_split_ids(splits_csv, "train"))]
+    train_df = train_df.sample(frac=0.1, random_state=42)
+    features = train_df.drop(columns=[INDEX, TARGET])
+    model = RandomForestClassifier(n_estimators=100, n_jobs=-1, max_depth=10, class_weight=CLASS_WEIGHT)
+    model.fit(features.values, train_df[TARGET].values)
+    wall_time = time.perf_counter() - start
+    test_df = df[df[INDEX].isin(_split_ids(splits_csv, "test"))]
+    scores = _scores(test_df[TARGET].values, model.predict(test_df.drop(columns=[INDEX, TARGET]).values))
+    return {"method": "notebook", "train_rows": len(train_df), "wall_time_s": wall_time,
+            "peak_rss_mb": _peak_rss_mb(), **scores}
+
+
+def _run_out_of_core(csv_path: str, splits_csv: str, store_dir: str, chunk_rows: int, learner: str) -> dict:
+    """
+    Build the binned store and train `learner` ("streaming_forest" or "hist_gradient_boosting") on the training
+    rows kept by the notebook's dropna, the boosting on at most chunk_rows of them.
+    """
+    start = time.perf_counter()
+    store = BinnedPixelStore.from_csv(csv_path, store_dir)
+    binned = time.perf_counter()
+    train_ids = np.intersect1d(_split_ids(splits_csv, "train"), store.chip_ids)
+    rows = store.complete_rows(store.chip_rows(train_ids))
+    if learner == "streaming_forest":
+        model = train_streaming_forest(store, rows, chunk_rows=chunk_rows)
+        train_rows = len(rows)
+    else:
+        model = train_hist_gradient_boosting(store, rows, max_rows=chunk_rows)
+        train_rows = min(len(rows), chunk_rows)
+    wall_time = time.perf_counter() - start
+    test_rows = store.complete_rows(store.chip_rows(np.intersect1d(_split_ids(splits_csv, "test"), store.chip_ids)))
+    scores = _scores(store.y[test_rows], predict_rows(model, store, test_rows, chunk_rows=chunk_rows))
+    return {"method": learner, "train_rows": train_rows, "binning_time_s": binned - start,
+            "wall_time_s": wall_time, "peak_rss_mb": _peak_rss_mb(), **scores}
+
+
+def _in_subprocess(target, *args) -> dict:
+    """Run `target` in a fresh process so peak RSS is measured for that method alone."""
+    import multiprocessing
+
+    ctx = multiprocessing.get_context("spawn")
+    with ctx.Pool(1, maxtasksperchild=1) as pool:
+        return pool.apply(target, args)
+
+
+def benchmark(csv_path: str, splits_csv: str, store_dir: str, chunk_rows: int = 2_000_000) -> pd.DataFrame:
+    """
+    Report wall time, peak RSS and test F1 and recall of the notebook's in-memory training against the out-of-core
+    learners. All of them train and are scored on the rows without missing values, as in the notebook.
+    """
+    results = [
+        _in_subprocess(_run_notebook_baseline, csv_path, splits_csv),
+        _in_subprocess(_run_out_of_core, csv_path, splits_csv, store_dir, chunk_rows, "streaming_forest"),
+        _in_subprocess(_run_out_of_core, csv_path, splits_csv, store_dir, chunk_rows, "hist_gradient_boosting"),
+    ]
+    return pd.DataFrame(results).set_index("method")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark out-of-core training against the notebook")
+    parser.add_argument("--csv", default="data.csv")
+    parser.add_argument("--splits", default="splits.csv")
+    parser.add_argument("--store", default="binned_store")
+    parser.add_argument("--chunk-rows", type=int, default=2_000_000)
+    args = parser.parse_args()
+    print(benchmark(args.csv, args.splits, os.path.abspath(args.store), args.chunk_rows).to_string())
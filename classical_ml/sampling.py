@@ -0,0 +1,212 @@
+"""
+Fire-aware sampling index for pixel level training data.
+
+Tomorrow's fire pixels are a tiny fraction of each chip, so rather than materializing every background pixel
+and downsampling uniformly, the position of every pixel is recorded per chip in one of three strata while the
+kernels are extracted:
+- positive: tomorrow's fire pixels
+- near: negatives within k pixels of today's or tomorrow's fires
+- far: all other negatives
+A StratifiedSampler then draws batches at configurable ratios with importance weights, using only the index.
+"""
+import threading
+
+import numpy as np
+
+try:
+    from out_of_core import FRAME_SIZE, NAN_BIN, BinnedPixelStore
+except ModuleNotFoundError:
+    # imported as classical_ml.sampling, from outside the classical_ml directory
+    from .out_of_core import FRAME_SIZE, NAN_BIN, BinnedPixelStore
+
+STRATA = ("positive", "near", "far")
+FRAME_SHAPE = (62, 62)
+
+
+def _dilate(mask: np.ndarray, k: int) -> np.ndarray:
+    """Binary dilation of a 2d mask with a (2k+1)x(2k+1) square"""
+    padded = np.pad(mask, k)
+    windows = np.lib.stride_tricks.sliding_window_view(padded, (2 * k + 1, 2 * k + 1))
+    return windows.any(axis=(-2, -1))
+
+
+def fire_strata(todays_fires: np.ndarray, tomorrows_fires: np.ndarray, k: int = 2) -> np.ndarray:
+    """
+    Label every pixel of a chip with its stratum: 0 positive, 1 near negative, 2 far negative.
+    Both arrays must already have the outer pixels stripped, matching the rows of the pixel table.
+    """
+    todays_fires = np.nan_to_num(todays_fires) > 0
+    tomorrows_fires = np.nan_to_num(tomorrows_fires) > 0
+    strata = np.full(todays_fires.shape, 2, dtype=np.uint8)
+    strata[_dilate(todays_fires | tomorrows_fires, k)] = 1
+    strata[tomorrows_fires] = 0
+    return strata
+
+
+class SampleIndex:
+    """
+    Per stratum, the chip and pixel position of every pixel of the pixel table. Each chip's pixels are
+    FRAME_SIZE contiguous rows in the table, so a (chip, pixel) pair maps straight to a row.
+    """
+
+    def __init__(self, chip_ids: np.ndarray, chips: dict, pixels: dict, k: int):
+        self.chip_ids = np.asarray(chip_ids)
+        self.chips = chips
+        self.pixels = pixels
+        self.k = k
+
+    def counts(self) -> dict:
+        """Number of pixels in each stratum"""
+        return {name: len(self.pixels[name]) for name in STRATA}
+
+    def save(self, path: str):
+        arrays = {"chip_ids": self.chip_ids, "k": np.array(self.k)}
+        for name in STRATA:
+            arrays[f"{name}_chip"] = self.chips[name]
+            arrays[f"{name}_pixel"] = self.pixels[name]
+        np.savez(path, **arrays)
+
+    @classmethod
+    def load(cls, path: str):
+        arrays = np.load(path)
+        chips = {name: arrays[f"{name}_chip"] for name in STRATA}
+        pixels = {name: arrays[f"{name}_pixel"] for name in STRATA}
+        return cls(arrays["chip_ids"], chips, pixels, int(arrays["k"]))
+
+    @classmethod
+    def from_store(cls, store: BinnedPixelStore, k: int = 2, batch_chips: int = 1024):
+        """
+        Build the index from an existing BinnedPixelStore, for tables that were extracted without one.
+        Only the todays_fires_4 column and the target are read.
+        """
+        column = store.feature_names.index("todays_fires_4")
+        zero_bin = np.searchsorted(store.edges["todays_fires_4"], 0.0, side="right")
+        builder = IndexBuilder(k=k)
+        for start in range(0, len(store.chip_ids), batch_chips):
+            chip_ids = store.chip_ids[start:start + batch_chips]
+            rows = slice(start * FRAME_SIZE, (start + len(chip_ids)) * FRAME_SIZE)
+            todays = store.X[rows, column]
+            todays = ((todays > zero_bin) & (todays != NAN_BIN)).reshape(-1, *FRAME_SHAPE)
+            tomorrows = np.asarray(store.y[rows]).reshape(-1, *FRAME_SHAPE)
+            for chip_id, today, tomorrow in zip(chip_ids, todays, tomorrows):
+                builder.add_stripped(chip_id, today, tomorrow)
+        return builder.build()
+
+    def rows(self, store: BinnedPixelStore, stratum: str, positions: np.ndarray = None) -> np.ndarray:
+        """Rows of the pixel table for a stratum, optionally only at `positions` within the stratum"""
+        chips, pixels = self.chips[stratum], self.pixels[stratum]
+        if positions is not None:
+            chips, pixels = chips[positions], pixels[positions]
+        return store.chip_offsets(self.chip_ids[chips]) + pixels
+
+
+class IndexBuilder:
+    """Accumulates the strata of each chip as kernels are extracted, safe to call from a ThreadPool"""
+
+    def __init__(self, k: int = 2):
+        self.k = k
+        self._lock = threading.Lock()
+        self._chip_ids = []
+        self._strata = []
+
+    def add_chip(self, chip_id: int, todays_fires: np.ndarray, tomorrows_fires: np.ndarray):
+        """Add a chip from its full 64x64 fire masks, stripping the outer pixels as the kernel extraction does"""
+        self.add_stripped(chip_id, todays_fires[1:-1, 1:-1], tomorrows_fires[1:-1, 1:-1])
+
+    def add_stripped(self, chip_id: int, todays_fires: np.ndarray, tomorrows_fires: np.ndarray):
+        strata = fire_strata(todays_fires, tomorrows_fires, self.k).ravel()
+        with self._lock:
+            self._chip_ids.append(int(chip_id))
+            self._strata.append(strata)
+
+    def build(self) -> SampleIndex:
+        chip_ids = np.asarray(self._chip_ids, dtype=np.int64)
+        strata = np.stack(self._strata) if self._strata else np.empty((0, FRAME_SIZE), dtype=np.uint8)
+        chips, pixels = {}, {}
+        for label, name in enumerate(STRATA):
+            chip_pos, pixel = np.nonzero(strata == label)
+            chips[name] = chip_pos.astype(np.int32)
+            pixels[name] = pixel.astype(np.uint16)
+        return SampleIndex(chip_ids, chips, pixels, self.k)
+
+
+def _check_ratios(ratios: dict, population: dict):
+    """Raise a ValueError naming the strata if the ratios cannot be turned into sampling shares"""
+    unknown = sorted(set(ratios) - set(STRATA))
+    if unknown:
+        raise ValueError(f"Unknown strata in ratios: {unknown}, expected some of {list(STRATA)}")
+    invalid = {name: ratio for name, ratio in ratios.items() if not np.isfinite(ratio) or ratio < 0}
+    if invalid:
+        raise ValueError(f"Ratios must be finite and non-negative, got {invalid}")
+    populated = {name: ratios.get(name, 0) for name in STRATA if population[name]}
+    if not populated:
+        raise ValueError("No pixels to sample, every stratum is empty for these chips")
+    if not any(populated.values()):
+        empty = [name for name in STRATA if not population[name]]
+        raise ValueError(f"Every populated stratum has a ratio of 0: {populated}, the other strata are empty: {empty}")
+
+
+class StratifiedSampler:
+    """
+    Draw stratified samples of pixels from a SampleIndex.
+
+    Each returned pixel carries an importance weight, (share of the population in its stratum) / (share of the
+    sample in its stratum), so weighted metrics and losses are unbiased estimates for the full table.
+    :param index: SampleIndex to draw from
+    :param ratios: relative share of each stratum in a batch, e.g. {"positive": 1, "near": 2, "far": 1}, strata left
+        out are not drawn
+    :param chip_ids: optional subset of chips to draw from, e.g. the training split
+    :param seed: random seed
+    """
+
+    def __init__(self, index: SampleIndex, ratios: dict = None, chip_ids=None, seed: int = 42):
+        self.index = index
+        ratios = ratios or {"positive": 1, "near": 2, "far": 1}
+        self.rng = np.random.default_rng(seed)
+
+        allowed = None
+        if chip_ids is not None:
+            allowed = np.isin(index.chip_ids, chip_ids)
+        self.positions = {}
+        for name in STRATA:
+            positions = np.arange(len(index.chips[name]))
+            if allowed is not None:
+                positions = positions[allowed[index.chips[name]]]
+            self.positions[name] = positions
+
+        population = {name: len(self.positions[name]) for name in STRATA}
+        _check_ratios(ratios, population)
+        total_ratio = sum(ratios.get(name, 0) for name in STRATA if population[name])
+        self.shares = {
+            name: ratios.get(name, 0) / total_ratio if population[name] else 0.0 for name in STRATA
+        }
+        total = sum(population.values())
+        self.weights = {
+            name: (population[name] / total) / self.shares[name] if self.shares[name] else 0.0 for name in STRATA
+        }
+
+    def sample(self, n: int) -> dict:
+        """
+        Draw n pixels (with replacement within each stratum).
+        :return: dict of stratum name to (positions within the stratum, importance weights)
+        """
+        counts = self.rng.multinomial(n, [self.shares[name] for name in STRATA])
+        batch = {}
+        for name, count in zip(STRATA, counts):
+            drawn = self.positions[name][self.rng.integers(0, len(self.positions[name]), count)] \
+                if count else np.empty(0, dtype=np.int64)
+            batch[name] = (drawn, np.full(count, self.weights[name], dtype=np.float32))
+        return batch
+
+    def sample_rows(self, store: BinnedPixelStore, n: int):
+        """
+        Draw n rows of the pixel table, sorted for sequential reads from the store.
+        :return: tuple of (row indexes, importance weights)
+        """
+        rows, weights = [], []
+        for name, (positions, weight) in self.sample(n).items():
+            rows.append(self.index.rows(store, name, positions))
+            weights.append(weight)
+        rows, weights = np.concatenate(rows), np.concatenate(weights)
+        order = np.argsort(rows)
+        return rows[order], weights[order]
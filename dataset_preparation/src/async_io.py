@@ -0,0 +1,385 @@
+import asyncio
+import contextvars
+import functools
+import itertools
+import json
+import os
+import random
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from urllib.parse import urlparse
+
+import numpy as np
+import rasterio
+
+from src.constants import DEFAULT_PARAMS, ERA5_ROOT, MODIS_STAC_URL
+from src.data_sources import (
+    atmospheric_from_dataset,
+    atmospheric_from_topleft,
+    elevation_from_topleft,
+    era5_bounds,
+    fires_from_topleft,
+    landcover_from_topleft,
+    modis_search_body,
+    ndvi_from_items,
+    public_modis_items,
+)
+from src.geospatial import bounds_to_geojson, reproject_coordinates
+from src.pipeline import LAYER_GROUPS, save_chip
+from src.tracing import chip_context, traced
+
+
+def _host(path):
+    """Host of a url, or bucket of an S3 path with or without the s3:// prefix"""
+    return urlparse(path).netloc or path.split("/")[0]
+
+
+def _retryable(error):
+    """Errors worth retrying: throttling, server errors, timeouts and dropped connections"""
+    import aiohttp
+
+    if isinstance(error, aiohttp.ClientResponseError):
+        return error.status == 429 or error.status >= 500
+    if isinstance(error, (FileNotFoundError, PermissionError)):
+        return False
+    return isinstance(error, (aiohttp.ClientError, asyncio.TimeoutError, OSError))
+
+
+class AsyncClient:
+    """
+    Shared HTTP and S3 sessions for fetching chip data from an event loop
+    Network requests are limited per host and retried with exponential backoff, and CPU bound work such as warping is
+    run on a thread pool, so many chips can wait on the network at once with a few threads.
+    """
+
+    def __init__(
+        self, limit_per_host=32, retries=4, backoff=0.5, timeout=60, workers=None, s3_options=None, fs=None
+    ):
+        """
+        :param limit_per_host: maximum number of concurrent requests to each host, or S3 bucket
+        :param retries: number of retries of a failed request
+        :param backoff: seconds to wait before the first retry, doubled for each retry
+        :param timeout: seconds before a request times out
+        :param workers: number of threads for CPU bound work, defaults to the number of CPUs
+        :param s3_options: keyword arguments of s3fs.S3FileSystem, defaults to anonymous access, uploads need
+            credentials
+        :param fs: filesystem with the async methods of s3fs used here (_ls, _cat_file and _put), e.g. a local
+            stand-in bucket; defaults to an s3fs.S3FileSystem
+        """
+        self.limit_per_host = limit_per_host
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.workers = workers or os.cpu_count()
+        self.s3_options = s3_options if s3_options is not None else {"anon": True}
+        self.fs = fs
+        self._s3_session = None
+        self._semaphores = defaultdict(lambda: asyncio.Semaphore(self.limit_per_host))
+
+    async def __aenter__(self):
+        import aiohttp
+        import s3fs
+
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit_per_host=self.limit_per_host),
+            timeout=aiohttp.ClientTimeout(total=self.timeout),
+            raise_for_status=True,
+        )
+        if self.fs is None:
+            self.fs = s3fs.S3FileSystem(asynchronous=True, skip_instance_cache=True, **self.s3_options)
+            self._s3_session = await self.fs.set_session()
+        self.executor = ThreadPoolExecutor(max_workers=self.workers)
+        return self
+
+    async def __aexit__(self, *args):
+        await self.session.close()
+        if self._s3_session is not None:
+            await self._s3_session.close()
+        self.executor.shutdown(wait=True)
+
+    async def _request(self, host, request):
+        """
+        Run a request, waiting for a slot of its host and retrying on transient errors
+        :param host: host, or S3 bucket, of the request
+        :param request: function returning the coroutine of the request, called for every attempt
+        :return: result of the request
+        """
+        for attempt in range(self.retries + 1):
+            try:
+                async with self._semaphores[host]:
+                    return await request()
+            except Exception as e:
+                if attempt == self.retries or not _retryable(e):
+                    raise
+            # the slot is released while waiting, with jitter so that throttled requests do not retry together
+            await asyncio.sleep(self.backoff * 2**attempt * (1 + random.random()))
+
+    async def post_json(self, url, body):
+        """
+        :param url: url to post to
+        :param body: JSON body of the request
+        :return: decoded JSON response
+        """
+
+        async def request():
+            async with self.session.post(url, json=body) as response:
+                return await response.json(content_type=None)
+
+        return await self._request(_host(url), request)
+
+    async def s3_ls(self, path, refresh=False):
+        """
+        :param path: S3 prefix to list
+        :param refresh: do not use the listings cached by earlier calls
+        :return: list of paths
+        """
+        return await self._request(_host(path), lambda: self.fs._ls(path, refresh=refresh))
+
+    async def s3_cat(self, path):
+        """
+        :param path: S3 object to read
+        :return: bytes of the object
+        """
+        return await self._request(_host(path), lambda: self.fs._cat_file(path))
+
+    async def s3_upload(self, local_path, s3_path):
+        """
+        :param local_path: file or directory to upload
+        :param s3_path: destination prefix
+        """
+        await self._request(_host(s3_path), lambda: self.fs._put(str(local_path), s3_path, recursive=True))
+
+    async def run(self, func, *args, **kwargs):
+        """
+        Run a blocking function on the thread pool, keeping the chip and span of the calling task for tracing
+        :return: result of the function
+        """
+        context = contextvars.copy_context()
+        return await asyncio.get_running_loop().run_in_executor(
+            self.executor, functools.partial(context.run, func, *args, **kwargs)
+        )
+
+    async def open_zarr_subset(self, store_url, variable, selection):
+        """
+        Open a zarr store, fetching only the chunks of a variable needed for a selection
+        Metadata and coordinates are fetched in full, as they are small, and every chunk is fetched concurrently
+        :param store_url: s3:// url of the zarr store
+        :param variable: name of the data variable
+        :param selection: dict of dimension name to slice of coordinate labels, as for xarray.Dataset.sel
+        :return: xarray.Dataset whose chunks outside the selection are left empty
+        """
+        import xarray as xarr
+
+        root = store_url.rstrip("/")
+        bucket_root = root.replace("s3://", "", 1)
+        entries = await self.s3_ls(root)
+
+        keys, coordinates = [], []
+        for entry in entries:
+            name = entry.rstrip("/").split("/")[-1]
+            if name.startswith("."):
+                keys.append(name)
+            elif name == variable:
+                keys += [f"{variable}/.zarray", f"{variable}/.zattrs"]
+            else:
+                coordinates.append(entry)
+        for paths in await asyncio.gather(*map(self.s3_ls, coordinates)):
+            keys += [path[len(bucket_root) + 1:] for path in paths]
+
+        store = await self._fetch_keys(root, keys)
+        dataset = xarr.open_zarr(store, consolidated=False)
+        data = dataset[variable]
+
+        # chunks of the variable intersecting the selection
+        chunk_ranges = []
+        for dim, chunk_size in zip(data.dims, data.encoding["chunks"]):
+            if dim in selection:
+                indexer = dataset.indexes[dim].slice_indexer(selection[dim].start, selection[dim].stop)
+                start, stop = indexer.start or 0, indexer.stop if indexer.stop is not None else data.sizes[dim]
+            else:
+                start, stop = 0, data.sizes[dim]
+            chunk_ranges.append(range(start // chunk_size, max(stop - 1, start) // chunk_size + 1))
+        separator = json.loads(store[f"{variable}/.zarray"]).get("dimension_separator", ".")
+        chunk_keys = [
+            f"{variable}/" + separator.join(str(i) for i in index) for index in itertools.product(*chunk_ranges)
+        ]
+        store.update(await self._fetch_keys(root, chunk_keys))
+        return xarr.open_zarr(store, consolidated=False)
+
+    async def _fetch_keys(self, root, keys):
+        async def fetch(key):
+            try:
+                return key, await self.s3_cat(f"{root}/{key}")
+            except FileNotFoundError:
+                # optional metadata such as .zattrs, or chunks never written as they only hold the fill value
+                return key, None
+
+        return {key: value for key, value in await asyncio.gather(*map(fetch, keys)) if value is not None}
+
+
+@traced("ndvi")
+async def fetch_ndvi(top_left, epsg, date_to_query, client, stac_url=MODIS_STAC_URL):
+    """
+    ndvi_from_topleft with the STAC search made on the event loop, and the MODIS bands read on the thread pool
+    :param top_left: list of the top left coordinates of the chip
+    :param epsg: EPSG code for top_left
+    :param date_to_query: date to load data for as string '2021-05-01'
+    :param client: AsyncClient
+    :param stac_url: search endpoint of the STAC holding the MODIS items
+    :return: numpy array of the NDVI data derived from MODIS bands
+    """
+    aoi = bounds_to_geojson(
+        rasterio.coords.BoundingBox(
+            left=top_left[1],
+            right=top_left[1] + 32000,
+            bottom=top_left[0] - 32000,
+            top=top_left[0],
+        )
+    )
+    aoi_4326 = reproject_coordinates(aoi, epsg, 4326)
+    results = await client.post_json(
+        stac_url, modis_search_body(aoi_4326, datetime.strptime(date_to_query, "%Y-%m-%d"))
+    )
+    return await client.run(ndvi_from_items, public_modis_items(results["features"]), epsg, top_left, aoi)
+
+
+@traced("atmospheric")
+async def fetch_atmospheric(topleft, epsg_code, date, params, client, era5_root=ERA5_ROOT):
+    """
+    atmospheric_from_topleft with the zarr chunks of the chip fetched concurrently on the event loop, and the
+    reprojection run on the thread pool
+    Local era5 roots, e.g. the benchmark fixtures, are read by atmospheric_from_topleft on the thread pool.
+    :param topleft: list of the top left coordinates of the chip
+    :param epsg_code: EPSG code for topleft
+    :param date: date of the chip as string '2021-05-01'
+    :param params: list of era5 variables to load
+    :param client: AsyncClient
+    :param era5_root: root of the era5 zarr stores
+    :return: xarray.Dataset of atmospheric data
+    """
+    import xarray as xarr
+
+    if not era5_root.startswith("s3://"):
+        return await client.run(atmospheric_from_topleft.__wrapped__, topleft, epsg_code, date, params, era5_root)
+
+    date_to_query = datetime.strptime(date, "%Y-%m-%d")
+    left84, bottom84, right84, top84 = era5_bounds(topleft, epsg_code)
+    day = date_to_query.strftime("%Y-%m-%d")
+    # the same rough crop as atmospheric_from_dataset, in the stored longitudes that are shifted by 180 degrees
+    selection = {
+        "lat": slice(top84 + 0.25, bottom84 - 0.25),
+        "lon": slice(left84 - 0.25 + 180, right84 + 0.25 + 180),
+        "time0": slice(day, day),
+        "time1": slice(day, day),
+    }
+    datasets = await asyncio.gather(
+        *(
+            client.open_zarr_subset(
+                f"{era5_root}/{date_to_query.year}/{str.zfill(str(date_to_query.month), 2)}/data/{param}.zarr",
+                param,
+                selection,
+            )
+            for param in params
+        )
+    )
+    return await client.run(atmospheric_from_dataset, xarr.merge(datasets), topleft, epsg_code, date, params)
+
+
+async def chip_layers_async(chip, features, fires, client, cog_footprints=None):
+    """
+    Load the layers of a chip as chip_layers, fetching its data sources concurrently
+    :param chip: chip bounds, a row of the manifest as a dict
+    :param features: names of the layers to load
+    :param fires: gpd.GeoDataFrame of fire points
+    :param client: AsyncClient
+    :param cog_footprints: gpd.GeoDataFrame of the dem footprints, needed for elevation
+    :return: dict of layer name to 2D array
+    """
+    top_left, epsg, date = [chip["top"], chip["left"]], chip["epsg"], chip["date"]
+
+    async def load_fires():
+        fire_array = await client.run(fires_from_topleft, top_left, epsg, date, fires=fires)
+        return {"todays_fires": fire_array.bool.values, "todays_frp": fire_array.frp.values}
+
+    async def load_elevation():
+        return {"elevation": await client.run(elevation_from_topleft, top_left, epsg, cog_footprints)}
+
+    async def load_landcover():
+        return {"landcover": await client.run(landcover_from_topleft, top_left, epsg)}
+
+    async def load_ndvi():
+        return {"ndvi": await fetch_ndvi(top_left, epsg, date, client)}
+
+    async def load_atmospheric():
+        atmos = await fetch_atmospheric(top_left, epsg, date, DEFAULT_PARAMS, client)
+        return {var: getattr(atmos, var).values[0] for var in list(atmos.data_vars)}
+
+    loaders = {
+        "fires": load_fires,
+        "elevation": load_elevation,
+        "landcover": load_landcover,
+        "ndvi": load_ndvi,
+        "atmospheric": load_atmospheric,
+    }
+    groups = [group for group, names in LAYER_GROUPS.items() if set(names) & set(features)]
+    layers = {}
+    for group_layers in await asyncio.gather(*(loaders[group]() for group in groups)):
+        layers.update(group_layers)
+    missing = set(features) - set(layers)
+    if missing:
+        raise ValueError(f"No data source for features: {sorted(missing)}")
+    return {name: np.asarray(layers[name]) for name in features}
+
+
+async def map_chips(process, chips, concurrency=256):
+    """
+    Run a coroutine function on every chip, with a bounded number of chips in flight
+    :param process: coroutine function taking a chip dict
+    :param chips: chip dicts, rows of the manifest
+    :param concurrency: maximum number of chips processed at once
+    :return: list of the results, or of the exceptions raised, in the order of the chips
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def bounded(chip):
+        async with semaphore:
+            with chip_context(chip["idx"]):
+                return await process(chip)
+
+    return await asyncio.gather(*map(bounded, chips), return_exceptions=True)
+
+
+def load_chips(
+    chips, features, fires, cog_footprints=None, concurrency=256, output_dir=None, output_s3=None, **client_options
+):
+    """
+    Load the layers of many chips from a single event loop, optionally writing and uploading every chip
+    :param chips: chip dicts, rows of the manifest
+    :param features: names of the layers to load
+    :param fires: gpd.GeoDataFrame of fire points
+    :param cog_footprints: gpd.GeoDataFrame of the dem footprints, needed for elevation
+    :param concurrency: maximum number of chips processed at once
+    :param output_dir: if set, the layers of each chip are written to output_dir/idx with save_chip
+    :param output_s3: if set, each written chip directory is uploaded to output_s3/idx, needs output_dir
+    :param client_options: keyword arguments of AsyncClient, e.g. s3_options with credentials for uploads
+    :return: dict of chip idx to dict of layers, or to the exception that dropped the chip
+    """
+    if output_s3 is not None and output_dir is None:
+        raise ValueError("output_s3 needs an output_dir to write the chips to before uploading them")
+
+    async def process(chip, client):
+        layers = await chip_layers_async(chip, features, fires, client, cog_footprints)
+        if output_dir is not None:
+            chip_dir = os.path.join(output_dir, str(chip["idx"]))
+            await client.run(save_chip, chip_dir, chip, layers)
+            if output_s3 is not None:
+                await client.s3_upload(chip_dir, f"{output_s3.rstrip('/')}/{chip['idx']}")
+        return layers
+
+    async def main():
+        async with AsyncClient(**client_options) as client:
+            results = await map_chips(lambda chip: process(chip, client), chips, concurrency)
+        return {chip["idx"]: result for chip, result in zip(chips, results)}
+
+    return asyncio.run(main())
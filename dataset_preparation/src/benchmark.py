@@ -0,0 +1,377 @@
+import argparse
+import asyncio
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import rasterio
+import xarray as xarr
+from rasterio.io import MemoryFile
+from rasterio.shutil import copy as rio_copy
+from rasterio.transform import from_origin
+from rasterio.warp import transform_bounds
+from shapely.geometry import box
+
+from src.constants import DEFAULT_PARAMS
+from src.data_sources import (
+    ndvi_from_topleft,
+    landcover_from_topleft,
+    atmospheric_from_topleft,
+    fires_from_topleft,
+    elevation_from_topleft,
+)
+from src.async_io import AsyncClient, fetch_atmospheric, fetch_ndvi, map_chips
+from src.block_cache import BlockCache, get_block_cache, set_block_cache
+from src.tracing import Tracer, chip_context, set_tracer
+
+FIXTURE_EPSG = 32610
+FIXTURE_TOP_LEFT = [4300000, 500000]
+FIXTURE_DATE = "2021-08-01"
+# atmospheric_from_topleft opens every DEFAULT_PARAMS store, so the fixtures hold all of them
+FIXTURE_PARAMS = DEFAULT_PARAMS
+FIXTURE_RES = 0.002
+# bucket name under which the async benchmark reads the fixtures, through LocalBucket
+FIXTURE_BUCKET = "fixtures"
+
+
+def _write_cog(path, data, transform, crs=4326):
+    """Write a single band array as a Cloud-Optimized GeoTIFF"""
+    profile = {
+        "driver": "GTiff",
+        "dtype": data.dtype.name,
+        "count": 1,
+        "height": data.shape[0],
+        "width": data.shape[1],
+        "crs": rasterio.crs.CRS.from_epsg(crs),
+        "transform": transform,
+    }
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with MemoryFile() as memfile:
+        with memfile.open(**profile) as dst:
+            dst.write(data, 1)
+        with memfile.open() as src:
+            rio_copy(src, path, driver="COG")
+    return path
+
+
+def fixture_chips(n_chips, spacing=4000):
+    """
+    Chips of the benchmark, on a grid around FIXTURE_TOP_LEFT so that each one has a different location
+    :param n_chips: number of chips
+    :param spacing: distance between chips in metres
+    :return: list of chip dicts as in the manifest
+    """
+    side = int(np.ceil(np.sqrt(n_chips)))
+    chips = []
+    for idx in range(n_chips):
+        top = FIXTURE_TOP_LEFT[0] - (idx // side) * spacing
+        left = FIXTURE_TOP_LEFT[1] + (idx % side) * spacing
+        chips.append({"idx": idx, "left": left, "bottom": top - 32000, "right": left + 32000, "top": top,
+                      "epsg": FIXTURE_EPSG, "date": FIXTURE_DATE})
+    return chips
+
+
+def build_fixtures(root, chips, seed=0):
+    """
+    Write local stand-ins of every data source covering the chips
+    :param root: directory to write the fixtures to
+    :param chips: chip dicts from fixture_chips
+    :param seed: random seed of the synthetic data
+    :return: dict of the keyword arguments pointing the data sources at the fixtures, plus the fires and the dem
+        footprints
+    """
+    rng = np.random.default_rng(seed)
+    left = min(c["left"] for c in chips)
+    bottom = min(c["bottom"] for c in chips)
+    right = max(c["right"] for c in chips)
+    top = max(c["top"] for c in chips)
+    west, south, east, north = transform_bounds(f"EPSG:{FIXTURE_EPSG}", "EPSG:4326", left, bottom, right, top)
+    west, south, east, north = west - 0.3, south - 0.3, east + 0.3, north + 0.3
+    width = int(np.ceil((east - west) / FIXTURE_RES))
+    height = int(np.ceil((north - south) / FIXTURE_RES))
+    transform = from_origin(west, north, FIXTURE_RES, FIXTURE_RES)
+
+    # dem, laid out as the copernicus-dem-30m bucket
+    dem_id = "Copernicus_DSM_COG_fixture"
+    dem = (500 + 300 * rng.random((height, width))).astype(np.float32)
+    _write_cog(os.path.join(root, "dem", dem_id, f"{dem_id}.tif"), dem, transform)
+    cog_footprints = gpd.GeoDataFrame({"id": [dem_id]}, geometry=[box(west, south, east, north)], crs="EPSG:4326")
+
+    landcover = rng.choice(np.arange(10, 101, 10, dtype=np.uint8), size=(height, width))
+    landcover_path = _write_cog(os.path.join(root, "landcover", "worldcover.tif"), landcover, transform)
+
+    # modis bands served by a stub STAC
+    modis_assets = {}
+    for band in ("B01", "B02"):
+        reflectance = (1000 + 3000 * rng.random((height, width))).astype(np.int16)
+        modis_assets[band] = {"href": _write_cog(os.path.join(root, "modis", f"{band}.tif"), reflectance, transform)}
+
+    # era5, laid out as the era5-pds bucket; longitudes are stored shifted by 180 degrees as read by
+    # atmospheric_from_topleft
+    date = pd.Timestamp(FIXTURE_DATE)
+    lats = np.arange(np.ceil(north * 4) / 4, np.floor(south * 4) / 4 - 0.25, -0.25)
+    lons = np.arange(np.floor(west * 4) / 4, np.ceil(east * 4) / 4 + 0.25, 0.25) + 180
+    hours = pd.date_range(date, periods=24, freq="H")
+    era5_root = os.path.join(root, "era5")
+    for param in FIXTURE_PARAMS:
+        # hourly aggregates (accumulations, minima and maxima) are on time1, instantaneous variables on time0
+        time_dim = "time1" if "_1hour_" in param else "time0"
+        values = rng.random((len(hours), len(lats), len(lons))).astype(np.float32)
+        dataset = xarr.Dataset({param: ((time_dim, "lat", "lon"), values)},
+                               coords={time_dim: hours, "lat": lats, "lon": lons})
+        if time_dim == "time1":
+            dataset["time1_bounds"] = (("time1", "nv"), np.stack([hours - pd.Timedelta("1H"), hours], axis=1))
+        else:
+            dataset = dataset.assign_coords(time1=hours)
+        dataset.to_zarr(os.path.join(era5_root, f"{date.year}", f"{date.month:02}", "data", f"{param}.zarr"))
+
+    # fire points scattered over the chips
+    n_fires = 50 * len(chips)
+    fires = gpd.GeoDataFrame(
+        {"acq_date": FIXTURE_DATE, "frp": rng.gamma(2.0, 5.0, n_fires)},
+        geometry=gpd.points_from_xy(rng.uniform(left, right, n_fires), rng.uniform(bottom, top, n_fires)),
+        crs=FIXTURE_EPSG,
+    ).to_crs(4326)
+
+    return {
+        "root": root,
+        "dem_root": os.path.join(root, "dem"),
+        "landcover_path": landcover_path,
+        "era5_root": era5_root,
+        "modis_assets": modis_assets,
+        "cog_footprints": cog_footprints,
+        "fires": fires,
+    }
+
+
+class StubStac:
+    """
+    Local stand-in for the MODIS STAC search endpoint, answering every search with the same item
+    """
+
+    def __init__(self, assets):
+        item = json.dumps({"type": "FeatureCollection", "features": [{"type": "Feature", "assets": assets}]}).encode()
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                self.send_response(200)
+                self.send_header("Content-Type", "application/geo+json")
+                self.send_header("Content-Length", str(len(item)))
+                self.end_headers()
+                self.wfile.write(item)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_port}/search"
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class LocalBucket:
+    """
+    Local directory standing in for an S3 bucket, through the async s3fs methods used by AsyncClient
+    Paths are "bucket/key" with or without the s3:// prefix, as with s3fs
+    """
+
+    def __init__(self, root, bucket=FIXTURE_BUCKET):
+        """
+        :param root: local directory holding the keys of the bucket
+        :param bucket: name of the bucket
+        """
+        self.root = root
+        self.bucket = bucket
+
+    def _local(self, path):
+        bucket, _, key = path.replace("s3://", "", 1).rstrip("/").partition("/")
+        if bucket != self.bucket:
+            raise FileNotFoundError(path)
+        return os.path.join(self.root, key)
+
+    async def _ls(self, path, refresh=False):
+        local = self._local(path)
+        if not os.path.isdir(local):
+            raise FileNotFoundError(path)
+        prefix = path.replace("s3://", "", 1).rstrip("/")
+        return [f"{prefix}/{name}" for name in sorted(os.listdir(local))]
+
+    async def _cat_file(self, path):
+        local = self._local(path)
+        if not os.path.isfile(local):
+            raise FileNotFoundError(path)
+        with open(local, "rb") as f:
+            return f.read()
+
+    async def _put(self, local_path, path, recursive=False):
+        if os.path.isdir(local_path):
+            shutil.copytree(local_path, self._local(path), dirs_exist_ok=True)
+        else:
+            os.makedirs(os.path.dirname(self._local(path)), exist_ok=True)
+            shutil.copy(local_path, self._local(path))
+
+
+def process_fixture_chip(chip, fixtures, stac_url):
+    """
+    Load every layer of a chip from the fixtures, as process_chip does from the data sources
+    :param chip: chip dict from fixture_chips
+    :param fixtures: dict from build_fixtures
+    :param stac_url: search endpoint of the stub STAC
+    :return: True if every layer was loaded
+    """
+    top_left, epsg, date = [chip["top"], chip["left"]], chip["epsg"], chip["date"]
+    with chip_context(chip["idx"]):
+        try:
+            ndvi_from_topleft(top_left, epsg, date, stac_url=stac_url)
+            fires_from_topleft(top_left, epsg, date, fires=fixtures["fires"])
+            elevation_from_topleft(top_left, epsg, fixtures["cog_footprints"], dem_root=fixtures["dem_root"])
+            landcover_from_topleft(top_left, epsg, landcover_path=fixtures["landcover_path"])
+            atmospheric_from_topleft(top_left, epsg, date, FIXTURE_PARAMS, era5_root=fixtures["era5_root"])
+        except Exception:
+            # the failure is recorded in the span of the data source
+            return False
+    return True
+
+
+async def process_fixture_chip_async(chip, fixtures, stac_url, client):
+    """
+    process_fixture_chip on the event loop of an AsyncClient, with every data source of the chip loaded concurrently
+    :param chip: chip dict from fixture_chips
+    :param fixtures: dict from build_fixtures
+    :param stac_url: search endpoint of the stub STAC
+    :param client: AsyncClient
+    :return: True if every layer was loaded
+    """
+    top_left, epsg, date = [chip["top"], chip["left"]], chip["epsg"], chip["date"]
+    try:
+        await asyncio.gather(
+            fetch_ndvi(top_left, epsg, date, client, stac_url=stac_url),
+            client.run(fires_from_topleft, top_left, epsg, date, fires=fixtures["fires"]),
+            client.run(elevation_from_topleft, top_left, epsg, fixtures["cog_footprints"],
+                       dem_root=fixtures["dem_root"]),
+            client.run(landcover_from_topleft, top_left, epsg, landcover_path=fixtures["landcover_path"]),
+            # era5 is read from the stand-in bucket, so that only the zarr chunks of the chip are fetched
+            fetch_atmospheric(top_left, epsg, date, FIXTURE_PARAMS, client, era5_root=f"s3://{FIXTURE_BUCKET}/era5"),
+        )
+    except Exception:
+        # the failure is recorded in the span of the data source
+        return False
+    return True
+
+
+async def _run_async(chips, fixtures, stac_url, workers):
+    async with AsyncClient(workers=workers, fs=LocalBucket(fixtures["root"])) as client:
+        results = await map_chips(
+            lambda chip: process_fixture_chip_async(chip, fixtures, stac_url, client), chips, concurrency=len(chips)
+        )
+    return [result is True for result in results]
+
+
+def run_benchmark(n_chips=16, workers=4, trace_path=None, block_cache=False, use_async=False):
+    """
+    Run the chip pipeline against local fixtures, without network access
+    :param n_chips: number of chips to process
+    :param workers: number of chips processed concurrently
+    :param trace_path: if set, the spans of every data source call are written to this JSON file
+    :param block_cache: read rasters through a BlockCache, shared by the chips as they overlap
+    :param use_async: load chips with an AsyncClient, workers being the threads of its thread pool
+    :return: dict with chips per second, failed chips, block cache statistics and the time spent in each data source
+    """
+    chips = fixture_chips(n_chips)
+    tracer = Tracer(network_stats=False)
+    previous_cache = get_block_cache()
+    with tempfile.TemporaryDirectory() as root:
+        fixtures = build_fixtures(root, chips)
+        cache = BlockCache(os.path.join(root, "block_cache")) if block_cache else None
+        with StubStac(fixtures["modis_assets"]) as stac:
+            set_tracer(tracer)
+            set_block_cache(cache)
+            start = time.perf_counter()
+            try:
+                if use_async:
+                    succeeded = asyncio.run(_run_async(chips, fixtures, stac.url, workers))
+                else:
+                    with ThreadPoolExecutor(max_workers=workers) as executor:
+                        succeeded = list(
+                            executor.map(lambda chip: process_fixture_chip(chip, fixtures, stac.url), chips)
+                        )
+            finally:
+                set_block_cache(previous_cache)
+            elapsed = time.perf_counter() - start
+        block_cache_stats = cache.stats() if cache is not None else None
+
+    if trace_path:
+        tracer.to_json(trace_path)
+    summary = tracer.summary()
+    return {
+        "chips": n_chips,
+        "workers": workers,
+        "async": use_async,
+        "seconds": elapsed,
+        "chips_per_sec": n_chips / elapsed,
+        "failed": len(chips) - sum(succeeded),
+        "block_cache": block_cache_stats,
+        "stages": {
+            source: {
+                "seconds": sum(t["seconds"] for t in outcomes.values()),
+                "seconds_per_chip": sum(t["seconds"] for t in outcomes.values()) / n_chips,
+                "share": sum(t["seconds"] for t in outcomes.values())
+                / max(sum(s["seconds"] for o in summary.values() for s in o.values()), 1e-9),
+                "outcomes": {outcome: t["calls"] for outcome, t in outcomes.items()},
+            }
+            for source, outcomes in summary.items()
+        },
+    }
+
+
+def benchmark_failed(results, min_chips_per_sec=None):
+    """
+    Whether a benchmark run should fail CI
+    :param results: dict from run_benchmark
+    :param min_chips_per_sec: minimum throughput, not checked if None
+    :return: True if a chip failed or throughput is below min_chips_per_sec
+    """
+    return bool(results["failed"]) or (
+        min_chips_per_sec is not None and results["chips_per_sec"] < min_chips_per_sec
+    )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark chip generation against local fixtures")
+    parser.add_argument("--chips", type=int, default=16)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--trace", help="write the spans of every data source call to this JSON file")
+    parser.add_argument("--output", help="write the results as JSON to this path")
+    parser.add_argument("--block-cache", action="store_true", help="read rasters through a BlockCache")
+    parser.add_argument("--async", dest="use_async", action="store_true", help="load chips with an AsyncClient")
+    parser.add_argument("--min-chips-per-sec", type=float,
+                        help="exit with an error if throughput is below this, e.g. to catch regressions in CI")
+    args = parser.parse_args(argv)
+
+    results = run_benchmark(args.chips, args.workers, args.trace, args.block_cache, args.use_async)
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    if benchmark_failed(results, args.min_chips_per_sec):
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
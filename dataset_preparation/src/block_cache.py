@@ -0,0 +1,244 @@
+import hashlib
+import math
+import os
+import sqlite3
+import threading
+import time
+
+import numpy as np
+from affine import Affine
+from rasterio.vrt import WarpedVRT
+from shapely.geometry import shape as geometry_shape
+
+from src.constants import BLOCK_CACHE_DIR, BLOCK_CACHE_MAX_BYTES
+from src.tracing import add_cache_hits
+
+# blocks are BLOCK_SIZE x BLOCK_SIZE pixels of the chip grid, i.e. 8km at 500m, aligned on multiples of their size
+BLOCK_SIZE = 16
+
+
+class BlockCache:
+    """
+    Size bounded on-disk cache of warped raster blocks, shared by threads and processes
+    Blocks are stored as .npy files and indexed in sqlite with their size and last access time, the least recently
+    used blocks are evicted once the cache grows over max_bytes.
+    """
+
+    def __init__(self, cache_dir, max_bytes=BLOCK_CACHE_MAX_BYTES):
+        """
+        :param cache_dir: local directory of the cache
+        :param max_bytes: maximum size of the cached blocks
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.db_path = os.path.join(cache_dir, "index.sqlite")
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        os.makedirs(os.path.join(cache_dir, "blocks"), exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS blocks (key TEXT PRIMARY KEY, size INTEGER, last_access REAL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS blocks_last_access ON blocks (last_access)")
+
+    def _connect(self):
+        # sqlite connections cannot be shared between threads, and the timeout lets processes wait for each other
+        return sqlite3.connect(self.db_path, timeout=60)
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, "blocks", key[:2], f"{key}.npy")
+
+    def get(self, key):
+        """
+        Read a block
+        :param key: key of the block
+        :return: numpy array, or None if the block is not cached
+        """
+        try:
+            block = np.load(self._path(key))
+        except (FileNotFoundError, ValueError):
+            # never cached, evicted, or evicted while being read by another process
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._connect() as conn:
+            conn.execute("UPDATE blocks SET last_access = ? WHERE key = ?", (time.time(), key))
+        with self._lock:
+            self.hits += 1
+        return block
+
+    def put(self, key, block):
+        """
+        Write a block, evicting the least recently used blocks if the cache is full
+        :param key: key of the block
+        :param block: numpy array
+        """
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # write to a temporary file first, so that readers never see a partial block
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.save(f, block)
+        os.replace(tmp_path, path)
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO blocks (key, size, last_access) VALUES (?, ?, ?)",
+                (key, os.path.getsize(path), time.time()),
+            )
+            self._evict(conn)
+
+    def _evict(self, conn):
+        total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM blocks").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        # evict down to 90% of the limit, so that a full cache does not evict on every write
+        target = total - 0.9 * self.max_bytes
+        evicted = []
+        for key, size in conn.execute("SELECT key, size FROM blocks ORDER BY last_access"):
+            evicted.append(key)
+            target -= size
+            if target <= 0:
+                break
+        conn.executemany("DELETE FROM blocks WHERE key = ?", [(key,) for key in evicted])
+        for key in evicted:
+            try:
+                os.remove(self._path(key))
+            except FileNotFoundError:
+                pass
+
+    def stats(self):
+        """
+        Hit and miss counts of this process, and the size of the cache shared by all processes
+        :return: dict of hits, misses, hit_rate, blocks and bytes
+        """
+        with self._connect() as conn:
+            blocks, size = conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM blocks").fetchone()
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "blocks": blocks,
+            "bytes": size,
+        }
+
+
+_BLOCK_CACHE = BlockCache(BLOCK_CACHE_DIR) if BLOCK_CACHE_DIR else None
+
+
+def get_block_cache():
+    """
+    The block cache used by read_geospatial_file, set with the BLOCK_CACHE_DIR environment variable or set_block_cache
+    :return: BlockCache or None if caching is disabled
+    """
+    return _BLOCK_CACHE
+
+
+def set_block_cache(block_cache):
+    """
+    Set the block cache used by read_geospatial_file
+    :param block_cache: BlockCache, or None to disable caching
+    """
+    global _BLOCK_CACHE
+    _BLOCK_CACHE = block_cache
+
+
+def source_key(src):
+    """
+    Stable identifier of an open raster; the path of remote files, or the contents of local VRTs as the VRTs built
+    for each chip have random names
+    :param src: open rasterio file handler
+    :return: str key
+    """
+    if src.driver == "VRT" and os.path.exists(src.name):
+        with open(src.name, "rb") as f:
+            return hashlib.sha1(f.read()).hexdigest()
+    return src.name
+
+
+def is_block_aligned(aoi, dst_transform, shape):
+    """
+    Check that a chip transform is north up with its origin on its own pixel grid, so that it is made of whole
+    pixels of the cached blocks, and that the aoi is the whole chip, so that no pixel is masked
+    :param aoi: geojson of the aoi to clip to
+    :param dst_transform: affine transform of the chip
+    :param shape: (height, width) of the chip
+    :return: bool
+    """
+    res = dst_transform.a
+    chip_bounds = (
+        dst_transform.c,
+        dst_transform.f - shape[0] * res,
+        dst_transform.c + shape[1] * res,
+        dst_transform.f,
+    )
+    return (
+        all(math.isclose(a, b) for a, b in zip(geometry_shape(aoi).bounds, chip_bounds))
+        and dst_transform.b == 0
+        and dst_transform.d == 0
+        and dst_transform.e == -res
+        and math.isclose(dst_transform.c / res, round(dst_transform.c / res))
+        and math.isclose(dst_transform.f / res, round(dst_transform.f / res))
+    )
+
+
+def read_blocks(block_cache, src, dst_crs, dst_transform, shape):
+    """
+    Read a chip from cached blocks; if any block is missing, the block aligned extent of the chip is warped once and
+    the missing blocks are cached. Every pixel is warped as when warping the whole chip, as blocks share its pixel grid
+    :param block_cache: BlockCache
+    :param src: open rasterio file handler
+    :param dst_crs: destination crs
+    :param dst_transform: destination transform, see is_block_aligned
+    :param shape: (height, width) of the chip
+    :return: array of shape (bands, height, width)
+    """
+    res = dst_transform.a
+    block_m = BLOCK_SIZE * res
+    left, top = dst_transform.c, dst_transform.f
+    height, width = shape
+    # block (bx, by) has its top left corner at (bx * block_m, by * block_m)
+    bx_range = range(math.floor(left / block_m + 1e-9), math.ceil((left + width * res) / block_m - 1e-9))
+    by_range = range(math.ceil(top / block_m - 1e-9), math.floor((top - height * res) / block_m + 1e-9), -1)
+    crs_key = dst_crs.to_epsg() or hashlib.sha1(dst_crs.to_wkt().encode()).hexdigest()
+    src_key = source_key(src)
+
+    keys = {
+        (bx, by): hashlib.sha1(f"{src_key}|{crs_key}|{res}|{bx}|{by}".encode()).hexdigest()
+        for by in by_range
+        for bx in bx_range
+    }
+    blocks = {position: block_cache.get(key) for position, key in keys.items()}
+    hits = sum(block is not None for block in blocks.values())
+    if hits < len(blocks):
+        # warp the whole block aligned extent of the chip at once, rather than one warp and source read per block
+        extent_transform = Affine(res, 0.0, bx_range[0] * block_m, 0.0, -res, by_range[0] * block_m)
+        with WarpedVRT(
+            src,
+            crs=dst_crs,
+            transform=extent_transform,
+            width=len(bx_range) * BLOCK_SIZE,
+            height=len(by_range) * BLOCK_SIZE,
+        ) as vrt:
+            extent = vrt.read()
+        for (bx, by), block in blocks.items():
+            if block is None:
+                row, col = (by_range[0] - by) * BLOCK_SIZE, (bx - bx_range[0]) * BLOCK_SIZE
+                block = extent[:, row:row + BLOCK_SIZE, col:col + BLOCK_SIZE].copy()
+                block_cache.put(keys[(bx, by)], block)
+                blocks[(bx, by)] = block
+
+    data = None
+    for (bx, by), block in blocks.items():
+        if data is None:
+            data = np.empty((block.shape[0], height, width), dtype=block.dtype)
+        # offsets of the block in the chip, clipped to the chip
+        col = int(round((bx * block_m - left) / res))
+        row = int(round((top - by * block_m) / res))
+        c0, r0 = max(col, 0), max(row, 0)
+        c1, r1 = min(col + BLOCK_SIZE, width), min(row + BLOCK_SIZE, height)
+        data[:, r0:r1, c0:c1] = block[:, r0 - row:r1 - row, c0 - col:c1 - col]
+    add_cache_hits(hits)
+    return data
@@ -0,0 +1,214 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+# modules each command imports when it runs, timed by the startup-time command
+COMMAND_MODULES = {
+    "build-manifest": ["src.pipeline", "src.firms"],
+    "process-chips": ["src.pipeline"],
+    "compute-stats": ["numpy"],
+}
+# modules that must not be loaded by importing the CLI itself
+HEAVY_MODULES = ["geopandas", "rasterio", "osgeo", "xarray", "geocube", "sklearn", "pyproj", "requests"]
+# HEAVY_MODULES each command may load when importing its COMMAND_MODULES, the others are imported where they are used
+COMMAND_HEAVY_MODULES = {
+    "build-manifest": ["geopandas", "rasterio", "osgeo", "pyproj", "requests"],
+    "process-chips": ["geopandas", "rasterio", "osgeo", "pyproj"],
+    "compute-stats": [],
+}
+
+
+def build_manifest(args):
+    from src.pipeline import build_manifest as build
+
+    fires = args.fires
+    if str(fires).endswith(".csv"):
+        import pandas as pd
+
+        from src.firms import to_geodataframe
+
+        fires = to_geodataframe(pd.read_csv(fires))
+    _, manifest = build(fires, min_cluster_points=args.min_cluster_points)
+    manifest.to_csv(args.output, index=False)
+    print(f"Wrote {len(manifest)} chips to {args.output}")
+
+
+def process_chips(args):
+    from concurrent.futures import ThreadPoolExecutor
+    from pathlib import Path
+
+    import geopandas as gpd
+    import pandas as pd
+
+    from src.block_cache import BlockCache, set_block_cache
+    from src.incremental import LayerCache
+    from src.pipeline import LAYER_GROUPS, chip_layers, save_chip
+
+    manifest = pd.read_csv(args.manifest, dtype={"date": str})
+    fires = gpd.read_file(args.fires, layer="merge")
+    features = args.features or [name for names in LAYER_GROUPS.values() for name in names]
+    cog_footprints = None
+    if "elevation" in features:
+        os.environ["AWS_NO_SIGN_REQUEST"] = "True"
+        cog_footprints = gpd.GeoDataFrame.from_file(args.dem_footprints)
+    layer_cache = LayerCache(args.cache_dir)
+    block_cache = None
+    if args.block_cache_dir:
+        block_cache = BlockCache(args.block_cache_dir, max_bytes=int(args.block_cache_gb * 1024**3))
+        set_block_cache(block_cache)
+
+    def process(chip):
+        output_dir = Path(args.output_dir).joinpath(str(chip["idx"]))
+        if output_dir.exists():
+            return True
+        try:
+            layers = chip_layers(chip, features, fires, cog_footprints, layer_cache)
+        except Exception as e:
+            print(f"Chip {chip['idx']} failed: {e!r}")
+            return False
+        save_chip(output_dir, chip, layers)
+        return True
+
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        processed = list(executor.map(process, manifest.T.to_dict().values()))
+    print(f"Processed {sum(processed)} of {len(processed)} chips")
+    print(f"Layer cache: {layer_cache.hits} hits, {layer_cache.misses} misses")
+    if block_cache is not None:
+        print(f"Block cache: {json.dumps(block_cache.stats())}")
+
+
+def compute_stats(args):
+    import glob
+
+    import numpy as np
+
+    # per chip statistics averaged over chips, as in data-stats.ipynb
+    stats = {}
+    for feature in args.features:
+        chip_stats = []
+        for path in glob.glob(os.path.join(args.chips_dir, "*", f"{feature}.npy")):
+            data = np.load(path).astype(np.float64)
+            data = data[np.isfinite(data)]
+            if data.size:
+                chip_stats.append(
+                    [np.percentile(data, 0.1), np.percentile(data, 99.9), data.mean(), data.std()]
+                )
+        if chip_stats:
+            stats[feature] = [float(v) for v in np.mean(chip_stats, axis=0)]
+    # (min, max, mean, std) per feature, the layout of DATA_STATS in deep_learning/config.py
+    print(json.dumps(stats, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(stats, f, indent=2)
+
+
+def _import_seconds(modules):
+    """Time a cold import of the CLI and modules in a fresh interpreter"""
+    code = (
+        "import time; start = time.perf_counter(); import src.cli; "
+        + "".join(f"import {module}; " for module in modules)
+        + "print(time.perf_counter() - start)"
+    )
+    result = subprocess.run(
+        [sys.executable, "-c", code],
+        capture_output=True,
+        text=True,
+        check=True,
+        cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    )
+    return float(result.stdout.strip().splitlines()[-1])
+
+
+def heavy_modules_loaded(modules=()):
+    """
+    Import the CLI and modules in a fresh interpreter
+    :param modules: modules to import after the CLI, e.g. the COMMAND_MODULES of a command
+    :return: list of the HEAVY_MODULES they loaded
+    """
+    code = (
+        "import sys, src.cli; "
+        + "".join(f"import {module}; " for module in modules)
+        + "print(','.join(m for m in src.cli.HEAVY_MODULES if m in sys.modules))"
+    )
+    loaded = subprocess.run(
+        [sys.executable, "-c", code],
+        capture_output=True,
+        text=True,
+        check=True,
+        cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    ).stdout.strip()
+    return [m for m in loaded.split(",") if m]
+
+
+def unexpected_heavy_modules(command):
+    """
+    Import the COMMAND_MODULES of a command in a fresh interpreter
+    :param command: name of the command
+    :return: list of the HEAVY_MODULES they loaded that are not in its COMMAND_HEAVY_MODULES
+    """
+    return [m for m in heavy_modules_loaded(COMMAND_MODULES[command]) if m not in COMMAND_HEAVY_MODULES[command]]
+
+
+def startup_time(args):
+    results = {
+        "cli_seconds": _import_seconds([]),
+        "commands_seconds": {command: _import_seconds(modules) for command, modules in COMMAND_MODULES.items()},
+        "heavy_modules_loaded_by_cli": heavy_modules_loaded(),
+    }
+    unexpected = {command: unexpected_heavy_modules(command) for command in COMMAND_MODULES}
+    results["unexpected_heavy_modules_by_command"] = {command: mods for command, mods in unexpected.items() if mods}
+    print(json.dumps(results, indent=2))
+    if (
+        results["heavy_modules_loaded_by_cli"]
+        or results["unexpected_heavy_modules_by_command"]
+        or (args.max_seconds and results["cli_seconds"] > args.max_seconds)
+    ):
+        sys.exit(1)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Dataset preparation commands")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    manifest_parser = subparsers.add_parser("build-manifest", help="cluster fire points into chip bounds")
+    manifest_parser.add_argument("--fires", required=True, help="fire point geopackage or FIRMS csv")
+    manifest_parser.add_argument("--output", required=True, help="path of the records csv to write")
+    manifest_parser.add_argument("--min-cluster-points", type=int, default=25)
+    manifest_parser.set_defaults(func=build_manifest)
+
+    chips_parser = subparsers.add_parser("process-chips", help="load the layers of every chip of a manifest")
+    chips_parser.add_argument("--manifest", required=True)
+    chips_parser.add_argument("--fires", required=True, help="fire point geopackage")
+    chips_parser.add_argument("--output-dir", required=True)
+    chips_parser.add_argument("--features", nargs="+", help="layers to load, defaults to all of them")
+    chips_parser.add_argument("--dem-footprints", default="s3://copernicus-dem-30m/grid.zip")
+    chips_parser.add_argument("--cache-dir", help="LayerCache directory for layers that do not depend on fires")
+    chips_parser.add_argument("--block-cache-dir", help="BlockCache directory for raster blocks, shared by processes")
+    chips_parser.add_argument("--block-cache-gb", type=float, default=10, help="maximum size of the block cache")
+    chips_parser.add_argument("--workers", type=int, default=os.cpu_count())
+    chips_parser.set_defaults(func=process_chips)
+
+    stats_parser = subparsers.add_parser("compute-stats", help="compute the DATA_STATS of processed chips")
+    stats_parser.add_argument("--chips-dir", required=True)
+    stats_parser.add_argument(
+        "--features", nargs="+", default=["todays_frp", "elevation", "landcover", "todays_fires", "tomorrows_fires"]
+    )
+    stats_parser.add_argument("--output", help="write the stats as JSON to this path")
+    stats_parser.set_defaults(func=compute_stats)
+
+    startup_parser = subparsers.add_parser("startup-time", help="measure the cold start time of each command")
+    startup_parser.add_argument("--max-seconds", type=float, help="fail if importing the CLI takes longer")
+    startup_parser.set_defaults(func=startup_time)
+
+    args = parser.parse_args(argv)
+    start = time.perf_counter()
+    args.func(args)
+    if args.command != "startup-time":
+        print(f"{args.command} took {time.perf_counter() - start:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
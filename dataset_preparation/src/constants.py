@@ -20,3 +20,14 @@ DEFAULT_PARAMS = [
 
 CHIP_SIZE = (64, 64)
 FIRMS_API_KEY = os.environ.get("FIRMS_API_KEY")
+FIRMS_URL = os.environ.get("FIRMS_URL", "https://firms.modaps.eosdis.nasa.gov")
+
+# roots of the data sources, overridden to run against local fixtures
+DEM_ROOT = "/vsis3/copernicus-dem-30m"
+LANDCOVER_PATH = "s3://esa-worldcover/v100/2020/ESA_WorldCover_10m_2020_v100_Map_AWS.vrt"
+MODIS_STAC_URL = "https://eod-catalog-svc-prod.astraea.earth/search"
+ERA5_ROOT = "s3://era5-pds/zarr"
+
+# shared on-disk cache of warped raster blocks, disabled if BLOCK_CACHE_DIR is not set
+BLOCK_CACHE_DIR = os.environ.get("BLOCK_CACHE_DIR")
+BLOCK_CACHE_MAX_BYTES = int(os.environ.get("BLOCK_CACHE_MAX_BYTES", 10 * 1024**3))
@@ -3,22 +3,28 @@ import os
 from datetime import datetime
 from zipfile import ZipFile
 
+# geopandas, pandas, pyproj, rasterio and shapely are used by most data sources and by src.geospatial, so every
+# command importing this module needs them anyway; the CLI only imports it in the commands that read chips, and the
+# libraries used by a few data sources (sklearn, geocube, requests, xarray) are imported where they are used
 import affine
 import geopandas as gpd
 import pandas as pd
 import pyproj
 import rasterio
-import requests
-import xarray as xarr
-from geocube.api.core import make_geocube
 from pyproj import CRS
 from rasterio.enums import Resampling
 from shapely.geometry import mapping, MultiPoint, shape
 from shapely.ops import transform, nearest_points
 from shapely.ops import transform as shapely_tf
-from sklearn.cluster import DBSCAN
 
-from src.constants import DEFAULT_PARAMS, CHIP_SIZE
+from src.constants import (
+    DEFAULT_PARAMS,
+    CHIP_SIZE,
+    DEM_ROOT,
+    LANDCOVER_PATH,
+    MODIS_STAC_URL,
+    ERA5_ROOT,
+)
 from src.geospatial import (
     build_vrt,
     buffer_point,
@@ -26,6 +32,7 @@ from src.geospatial import (
     bounds_to_geojson,
     read_geospatial_file,
 )
+from src.tracing import traced
 
 
 def unzip_csvs(zip_file):
@@ -50,6 +57,8 @@ def cluster_fires(fire_dataframe, min_cluster_points=25):
     :param min_cluster_points: minimum number of fire points in a cluster for it to be kept
     :return: geodataframe of fire points that belong to a cluster
     """
+    from sklearn.cluster import DBSCAN
+
     clustered_fires_for_dates = []
     number_of_clusters = 0
     for date in fire_dataframe["acq_date"].unique().tolist():
@@ -85,9 +94,10 @@ def create_chip_bounds(clustered_fires):
     """
     Given a geodataframe of clustered fire points create chip bbox and save metadata to csv
     :param clustered_fires: geodataframe of clustered fire points
-    :param output_fp: directory for output file to be written to
-    :return: filepath of the records.csv created/updated
+    :return: pd.DataFrame of chip bounds, with the number of fire points in each cluster
     """
+    from geocube.api.core import make_geocube
+
     chip_bounds = []
     for cluster in clustered_fires["label"].unique().tolist():
         clustered_fire = clustered_fires[clustered_fires["label"] == cluster]
@@ -116,10 +126,13 @@ def create_chip_bounds(clustered_fires):
             geom=bbox_4326_geojson,
         )
 
-        chip_bounds.append([cluster, *chip.rio.bounds(), utm_crs.to_epsg(), date])
+        chip_bounds.append(
+            [cluster, *chip.rio.bounds(), utm_crs.to_epsg(), date, len(clustered_fire)]
+        )
 
     return pd.DataFrame(
-        chip_bounds, columns=["idx", "left", "bottom", "right", "top", "epsg", "date"]
+        chip_bounds,
+        columns=["idx", "left", "bottom", "right", "top", "epsg", "date", "n_points"],
     )
 
 
@@ -157,6 +170,7 @@ def read_modis_bands(results, bands, epsg, topleft, aoi):
     return band_data
 
 
+@traced("fires")
 def fires_from_topleft(top_left, epsg_code, date_to_query, fires):
     """
     Given input chip parameters, load fire data and rasterize the points
@@ -166,6 +180,8 @@ def fires_from_topleft(top_left, epsg_code, date_to_query, fires):
     :param fires : gpd.GeoDataFrame or filename
     :return: xarray.Dataset containing rasterized fire points
     """
+    from geocube.api.core import make_geocube
+
     aoi = bounds_to_geojson(
         rasterio.coords.BoundingBox(
             left=top_left[1],
@@ -215,12 +231,14 @@ def fires_from_topleft(top_left, epsg_code, date_to_query, fires):
     return fire_array
 
 
-def elevation_from_topleft(top_left, epsg, cog_footprints):
+@traced("elevation")
+def elevation_from_topleft(top_left, epsg, cog_footprints, dem_root=DEM_ROOT):
     """
     Given input chip parameters, load elevation data and reproject to the chip CRS
     :param top_left: list of the top left coordinates of the chip
     :param epsg_code: EPSG code for top_left
     :param cog_footprints: gpd.GeoDataFrame of the dem footprints
+    :param dem_root: directory of the dem COGs
     :return: numpy array of the elevation data
     """
     aoi = bounds_to_geojson(
@@ -234,7 +252,6 @@ def elevation_from_topleft(top_left, epsg, cog_footprints):
 
     aoi_4326 = reproject_coordinates(aoi, epsg, 4326)
     cog_intersections = cog_footprints[cog_footprints.intersects(shape(aoi_4326))]
-    dem_root = "/vsis3/copernicus-dem-30m"
     file_paths = []
     for cog_filename in cog_intersections.id:
         file_paths.append(f"{dem_root}/{cog_filename}/{cog_filename}.tif")
@@ -249,11 +266,13 @@ def elevation_from_topleft(top_left, epsg, cog_footprints):
     return elevation_data[0]
 
 
-def landcover_from_topleft(top_left, epsg):
+@traced("landcover")
+def landcover_from_topleft(top_left, epsg, landcover_path=LANDCOVER_PATH):
     """
     Given input chip parameters, load landcover data and reproject to the chip CRS
     :param top_left: list of the top left coordinates of the chip
     :param epsg_code: EPSG code for top_left
+    :param landcover_path: path of the landcover raster
     :return: numpy array of the landcover data
     """
     aoi = bounds_to_geojson(
@@ -265,23 +284,55 @@ def landcover_from_topleft(top_left, epsg):
         )
     )
 
-    with rasterio.open(
-        "s3://esa-worldcover/v100/2020/ESA_WorldCover_10m_2020_v100_Map_AWS.vrt"
-    ) as src:
+    with rasterio.open(landcover_path) as src:
         dst_crs = CRS.from_epsg(epsg)
         dst_transform = affine.Affine(500, 0.0, top_left[1], 0.0, -500, top_left[0])
         landcover_data, tf = read_geospatial_file(aoi, dst_crs, dst_transform, src)
     return landcover_data[0]
 
 
-def ndvi_from_topleft(top_left, epsg, date_to_query):
+def modis_search_body(aoi_4326, date_to_query):
+    """
+    STAC search for the MODIS MCD43A4 items of a chip
+    :param aoi_4326: geojson of the chip in EPSG:4326
+    :param date_to_query: datetime of the chip
+    :return: dict of the search request body
+    """
+    return {
+        "intersects": aoi_4326,
+        "collections": ["mcd43a4"],
+        "datetime": f"{date_to_query.strftime('%Y-%m-%d')}T00:00:00Z/{date_to_query.strftime('%Y-%m-%d')}T23:59:59Z",
+        "limit": 100,
+    }
+
+
+def public_modis_items(features):
+    """
+    Update STAC search results to point to the non requester-pays bucket
+    :param features: features of the STAC search response
+    :return: list of the updated features
+    """
+    results_updated_links = [dict(feature) for feature in features]
+    for result in results_updated_links:
+        result["assets"] = {
+            band: {**asset, "href": asset["href"].replace("astraea-opendata", "modis-pds")}
+            for band, asset in result["assets"].items()
+        }
+    return results_updated_links
+
+
+@traced("ndvi")
+def ndvi_from_topleft(top_left, epsg, date_to_query, stac_url=MODIS_STAC_URL):
     """
     Given input chip parameters, load MODIS MCD43A4 data, reproject to the chip CRS and calculate NDVI
     :param top_left: list of the top left coordinates of the chip
     :param epsg_code: EPSG code for top_left
     :param date_to_query: date to load data for as string '2021-05-01'
+    :param stac_url: search endpoint of the STAC holding the MODIS items
     :return: numpy array of the NDVI data derived from MODIS bands
     """
+    import requests
+
     date_to_query = datetime.strptime(date_to_query, "%Y-%m-%d")
     aoi = bounds_to_geojson(
         rasterio.coords.BoundingBox(
@@ -294,62 +345,58 @@ def ndvi_from_topleft(top_left, epsg, date_to_query):
     aoi_4326 = reproject_coordinates(aoi, epsg, 4326)
 
     results_from_astrea_stac = requests.post(
-        f"https://eod-catalog-svc-prod.astraea.earth/search",
-        json={
-            "intersects": aoi_4326,
-            "collections": ["mcd43a4"],
-            "datetime": f"{date_to_query.strftime('%Y-%m-%d')}T00:00:00Z/{date_to_query.strftime('%Y-%m-%d')}T23:59:59Z",
-            "limit": 100,
-        },
+        stac_url, json=modis_search_body(aoi_4326, date_to_query)
     )
+    results_updated_links = public_modis_items(results_from_astrea_stac.json()["features"])
+    return ndvi_from_items(results_updated_links, epsg, top_left, aoi)
 
-    # Update the results to point to the non requester-pays bucket
-    results_updated_links = results_from_astrea_stac.json()["features"].copy()
-    for i in range(len(results_from_astrea_stac.json()["features"])):
-        for band in list(
-            results_from_astrea_stac.json()["features"][i]["assets"].keys()
-        ):
-            results_updated_links[i]["assets"][band][
-                "href"
-            ] = results_from_astrea_stac.json()["features"][i]["assets"][band][
-                "href"
-            ].replace(
-                "astraea-opendata", "modis-pds"
-            )
-
-    bands = read_modis_bands(results_updated_links, ["B01", "B02"], epsg, top_left, aoi)
+
+def ndvi_from_items(results, epsg, top_left, aoi):
+    """
+    Read the red and near infrared MODIS bands of STAC items for a chip and calculate NDVI
+    :param results: STAC items pointing to the public bucket, see public_modis_items
+    :param epsg: integer EPSG code
+    :param top_left: list of the top left coordinates of the chip
+    :param aoi: geojson of the chip
+    :return: numpy array of the NDVI data derived from MODIS bands
+    """
+    bands = read_modis_bands(results, ["B01", "B02"], epsg, top_left, aoi)
     ndvi = (bands[1] - bands[0]) / (bands[1] + bands[0])
     return ndvi[0]
 
 
-def atmospheric_from_topleft(topleft, epsg_code, date, params):
+@traced("atmospheric")
+def atmospheric_from_topleft(topleft, epsg_code, date, params, era5_root=ERA5_ROOT):
     """
     Given input chip and desired era5 variables, load data, reproject to the chip CRS and resample
     :param sample: chip parameters
     :param params: list of era5 variables to load
+    :param era5_root: root of the era5 zarr stores
     :return: xarray.Dataset of atmospheric data
     """
+    import xarray as xarr
+
     date_to_query = datetime.strptime(date, "%Y-%m-%d")
     datasets = []
     for param in DEFAULT_PARAMS:
         datasets.append(
-            f"s3://era5-pds/zarr/{date_to_query.year}/{str.zfill(str(date_to_query.month), 2)}/data/{param}.zarr/"
+            f"{era5_root}/{date_to_query.year}/{str.zfill(str(date_to_query.month), 2)}/data/{param}.zarr/"
         )
     stacked_dataset = xarr.open_mfdataset(
-        datasets, engine="zarr", storage_options={"anon": True}
-    )
-
-    dataset_for_date = stacked_dataset.sel(
-        time0=date_to_query.strftime("%Y-%m-%d"),
-        time1=date_to_query.strftime("%Y-%m-%d"),
+        datasets,
+        engine="zarr",
+        storage_options={"anon": True} if era5_root.startswith("s3://") else {},
     )
+    return atmospheric_from_dataset(stacked_dataset, topleft, epsg_code, date, params)
 
-    # We use rio-xarray here to add geospatial data to the xarray
-    dataset_for_date = dataset_for_date.rename(lon="x", lat="y")
-    dataset_for_date["x"] = dataset_for_date["x"] - 180
-    dataset_for_date = dataset_for_date.drop_vars("time1_bounds")
-    wgs84_crs = CRS.from_epsg(4326)
 
+def era5_bounds(topleft, epsg_code):
+    """
+    Bounds of a chip in EPSG:4326
+    :param topleft: list of the top left coordinates of the chip
+    :param epsg_code: EPSG code for topleft
+    :return: tuple of left, bottom, right, top
+    """
     utm_to_wgs84_transformer = pyproj.Transformer.from_crs(
         epsg_code, 4326, always_xy=True
     ).transform
@@ -368,7 +415,33 @@ def atmospheric_from_topleft(topleft, epsg_code, date, params):
     }
 
     filtered_wgs84 = shapely_tf(utm_to_wgs84_transformer, shape(aoi))
-    left84, bottom84, right84, top84 = shape(filtered_wgs84).bounds
+    return shape(filtered_wgs84).bounds
+
+
+def atmospheric_from_dataset(stacked_dataset, topleft, epsg_code, date, params):
+    """
+    Select the day of a chip from the era5 variables, reproject to the chip CRS and resample
+    :param stacked_dataset: xarray.Dataset of the era5 variables for the month of the chip
+    :param topleft: list of the top left coordinates of the chip
+    :param epsg_code: EPSG code for topleft
+    :param date: date of the chip as string '2021-05-01'
+    :param params: list of era5 variables to load
+    :return: xarray.Dataset of atmospheric data
+    """
+    import rioxarray  # noqa: F401, registers the .rio accessor
+
+    date_to_query = datetime.strptime(date, "%Y-%m-%d")
+    dataset_for_date = stacked_dataset.sel(
+        time0=date_to_query.strftime("%Y-%m-%d"),
+        time1=date_to_query.strftime("%Y-%m-%d"),
+    )
+
+    # We use rio-xarray here to add geospatial data to the xarray
+    dataset_for_date = dataset_for_date.rename(lon="x", lat="y")
+    dataset_for_date["x"] = dataset_for_date["x"] - 180
+    dataset_for_date = dataset_for_date.drop_vars("time1_bounds")
+    wgs84_crs = CRS.from_epsg(4326)
+    left84, bottom84, right84, top84 = era5_bounds(topleft, epsg_code)
 
     # We do a rough crop in the first instance as rioxarray doesn't need to reproject the whole globe!
     cropped_dataset = dataset_for_date.sel(
@@ -0,0 +1,155 @@
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+from shapely.geometry import box
+
+POLICIES = ("largest_cluster", "max_iou", "first")
+
+
+class UnionFind:
+    """
+    Disjoint sets over the integers 0..n-1, with path compression and union by size
+    """
+
+    def __init__(self, n):
+        self.parent = np.arange(n)
+        self.size = np.ones(n, dtype=int)
+
+    def find(self, i):
+        root = i
+        while self.parent[root] != root:
+            root = self.parent[root]
+        while self.parent[i] != root:
+            self.parent[i], i = root, self.parent[i]
+        return root
+
+    def union(self, i, j):
+        root_i, root_j = self.find(i), self.find(j)
+        if root_i == root_j:
+            return
+        if self.size[root_i] < self.size[root_j]:
+            root_i, root_j = root_j, root_i
+        self.parent[root_j] = root_i
+        self.size[root_i] += self.size[root_j]
+
+    def labels(self):
+        return np.array([self.find(i) for i in range(len(self.parent))])
+
+
+def chip_footprints(manifest):
+    """
+    Given a chip manifest from create_chip_bounds, create the chip footprints in EPSG:4326
+    Chips are reprojected in one call per UTM zone
+    :param manifest: pd.DataFrame with left, bottom, right, top, epsg and date columns
+    :return: gpd.GeoDataFrame of the manifest with chip footprint geometries, in manifest order
+    """
+    footprints = []
+    for epsg, chips in manifest.groupby("epsg"):
+        boxes = [box(*bounds) for bounds in chips[["left", "bottom", "right", "top"]].values]
+        footprints.append(gpd.GeoSeries(boxes, index=chips.index, crs=int(epsg)).to_crs(4326))
+    geometry = pd.concat(footprints).loc[manifest.index] if footprints else []
+    return gpd.GeoDataFrame(manifest, geometry=gpd.GeoSeries(geometry, crs=4326), crs=4326)
+
+
+def pair_iou(footprints, left, right):
+    """
+    Intersection over union of pairs of chip footprints, computed in UTM rather than in EPSG:4326
+    Chips of the same zone are compared on their bounds, and chips of different zones in the zone of the first chip
+    :param footprints: gpd.GeoDataFrame from chip_footprints
+    :param left: positional indexes of the first chip of each pair
+    :param right: positional indexes of the second chip of each pair
+    :return: np.ndarray of the iou of each pair
+    """
+    bounds = footprints[["left", "bottom", "right", "top"]].values.astype(float)
+    epsg = footprints["epsg"].values
+    intersection = np.zeros(len(left))
+    union = np.zeros(len(left))
+
+    same_zone = epsg[left] == epsg[right]
+    bounds_left, bounds_right = bounds[left[same_zone]], bounds[right[same_zone]]
+    overlap = np.clip(
+        np.minimum(bounds_left[:, 2:], bounds_right[:, 2:]) - np.maximum(bounds_left[:, :2], bounds_right[:, :2]),
+        0,
+        None,
+    )
+    intersection[same_zone] = overlap[:, 0] * overlap[:, 1]
+    areas_left = (bounds_left[:, 2] - bounds_left[:, 0]) * (bounds_left[:, 3] - bounds_left[:, 1])
+    areas_right = (bounds_right[:, 2] - bounds_right[:, 0]) * (bounds_right[:, 3] - bounds_right[:, 1])
+    union[same_zone] = areas_left + areas_right - intersection[same_zone]
+
+    for zone in np.unique(epsg[left[~same_zone]]):
+        in_zone = ~same_zone & (epsg[left] == zone)
+        geoms_left = footprints.geometry.iloc[left[in_zone]].to_crs(int(zone)).values
+        geoms_right = footprints.geometry.iloc[right[in_zone]].to_crs(int(zone)).values
+        intersection[in_zone] = geoms_left.intersection(geoms_right).area
+        union[in_zone] = geoms_left.area + geoms_right.area - intersection[in_zone]
+    return np.divide(intersection, union, out=np.zeros_like(intersection), where=union > 0)
+
+
+def overlap_components(footprints, min_iou=0.0):
+    """
+    Group chips whose footprints overlap on the same date, using an R-tree per date and union-find
+    Chips that only touch along an edge or at a corner are not grouped
+    :param footprints: gpd.GeoDataFrame from chip_footprints
+    :param min_iou: only chips overlapping by more than this intersection over union are grouped
+    :return: tuple of component label per chip (aligned with footprints) and pd.DataFrame of overlapping pairs
+        with positional indexes i, j and their iou
+    """
+    uf = UnionFind(len(footprints))
+    positions = np.arange(len(footprints))
+    pairs = []
+    for date, chips in footprints.groupby("date"):
+        chip_positions = positions[(footprints["date"] == date).values]
+        # "intersects" rather than "overlaps" keeps chips contained in others, touching chips have an iou of 0
+        left, right = chips.sindex.query_bulk(chips.geometry, predicate="intersects")
+        keep = left < right
+        left, right = left[keep], right[keep]
+        iou = pair_iou(chips, left, right)
+        overlapping = iou > min_iou
+        for i, j in zip(chip_positions[left[overlapping]], chip_positions[right[overlapping]]):
+            uf.union(i, j)
+        pairs.append(pd.DataFrame({
+            "i": chip_positions[left[overlapping]],
+            "j": chip_positions[right[overlapping]],
+            "iou": iou[overlapping],
+        }))
+    pairs = pd.concat(pairs, ignore_index=True) if pairs else pd.DataFrame(columns=["i", "j", "iou"])
+    return uf.labels(), pairs
+
+
+def deduplicate_chips(manifest, policy="largest_cluster", min_iou=0.0):
+    """
+    Given a chip manifest from create_chip_bounds, keep one chip per group of chips overlapping on the same date
+    This runs on the manifest alone, so that duplicate chips are never downloaded
+    :param manifest: pd.DataFrame with left, bottom, right, top, epsg and date columns
+    :param policy: which chip of an overlapping group to keep,
+        "largest_cluster": the chip built from the most fire points (n_points column),
+        "max_iou": the chip with the largest total overlap with the rest of its group,
+        "first": the first chip in manifest order
+    :param min_iou: only chips overlapping by more than this intersection over union are grouped
+    :return: pd.DataFrame, the manifest rows that were kept
+    """
+    if policy not in POLICIES:
+        raise ValueError(f'"policy" must be one of {POLICIES}')
+    if policy == "largest_cluster" and "n_points" not in manifest.columns:
+        raise ValueError('"largest_cluster" policy needs the "n_points" column written by create_chip_bounds')
+    if manifest.empty:
+        return manifest
+
+    manifest = manifest.reset_index(drop=True)
+    footprints = chip_footprints(manifest)
+    components, pairs = overlap_components(footprints, min_iou=min_iou)
+
+    if policy == "largest_cluster":
+        score = manifest["n_points"].values.astype(float)
+    elif policy == "max_iou":
+        score = np.zeros(len(manifest))
+        np.add.at(score, pairs["i"].values.astype(int), pairs["iou"].values.astype(float))
+        np.add.at(score, pairs["j"].values.astype(int), pairs["iou"].values.astype(float))
+    else:
+        score = np.zeros(len(manifest))
+
+    # highest score per component, ties go to the first chip in manifest order
+    order = pd.DataFrame({"component": components, "score": -score, "position": np.arange(len(manifest))})
+    keep = order.sort_values(["component", "score", "position"]).drop_duplicates("component")["position"]
+    return manifest.iloc[np.sort(keep.values)]
@@ -0,0 +1,309 @@
+import hashlib
+import io
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from pathlib import Path
+
+import geopandas as gpd
+import pandas as pd
+import requests
+from osgeo import gdal
+
+from src.constants import FIRMS_API_KEY, FIRMS_URL
+
+MAX_DAY_RANGE = 10  # firms api allows max of 10 day range see https://firms.modaps.eosdis.nasa.gov/api/area/
+NRT_PRODUCT = "VIIRS_SNPP_NRT"
+SP_PRODUCT = "VIIRS_SNPP_SP"
+STORE_LAYER = "merge"
+STORE_COLUMNS = ["acq_date", "frp", "geometry"]
+FIRE_KEY = ["latitude", "longitude", "acq_date", "acq_time"]
+
+
+class FirmsClient:
+    """
+    Client for the FIRMS area API that fetches date windows concurrently, within the transaction limit of the
+    map key, and caches the raw CSV responses of windows that can no longer change
+    """
+
+    def __init__(
+        self,
+        api_key=FIRMS_API_KEY,
+        base_url=FIRMS_URL,
+        cache_dir=None,
+        max_workers=4,
+        transaction_limit=None,
+        retries=3,
+        backoff=2.0,
+        timeout=60,
+    ):
+        """
+        :param api_key: FIRMS map key
+        :param base_url: root of the FIRMS API, e.g. a local stand-in server for testing
+        :param cache_dir: directory of cached CSV responses, no caching if None
+        :param max_workers: number of windows fetched concurrently
+        :param transaction_limit: transactions allowed per interval, defaults to the limit reported for the key
+        :param retries: attempts per request on connection errors, timeouts, 429 and 5xx responses
+        :param backoff: seconds to wait before the first retry, doubled on every retry
+        :param timeout: request timeout in seconds
+        """
+        if not api_key:
+            raise ValueError("FIRMS_API_KEY empty, please ensure your environment variable set")
+        self.api_key = api_key
+        self.base_url = base_url.rstrip("/")
+        self.cache_dir = Path(cache_dir) if cache_dir else None
+        self.max_workers = max_workers
+        self.transaction_limit = transaction_limit
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _session(self):
+        # requests sessions are not thread safe, so each worker thread keeps its own connection pool
+        if not hasattr(self._local, "session"):
+            self._local.session = requests.Session()
+        return self._local.session
+
+    def _get(self, path, params=None):
+        url = f"{self.base_url}/{path}"
+        wait = self.backoff
+        for attempt in range(self.retries):
+            try:
+                response = self._session().get(url, params=params, timeout=self.timeout)
+                if response.status_code != 429 and response.status_code < 500:
+                    response.raise_for_status()
+                    return response
+            except (requests.ConnectionError, requests.Timeout):
+                if attempt == self.retries - 1:
+                    raise
+            if attempt < self.retries - 1:
+                time.sleep(wait)
+                wait *= 2
+        response.raise_for_status()
+
+    def data_availability(self, product=NRT_PRODUCT):
+        """
+        Get the date range a FIRMS product is available for
+        :param product: FIRMS product, e.g. VIIRS_SNPP_NRT
+        :return: tuple of datetime; min date and max date
+        """
+        response = self._get(f"api/data_availability/csv/{self.api_key}/{product}")
+        availability = pd.read_csv(io.StringIO(response.text))
+        return (
+            datetime.strptime(availability.iloc[0].min_date, "%Y-%m-%d"),
+            datetime.strptime(availability.iloc[0].max_date, "%Y-%m-%d"),
+        )
+
+    def reserve_transactions(self, n_transactions, max_wait=600, poll=30):
+        """
+        Wait until the map key has enough free transactions for the next requests
+        :param n_transactions: number of requests about to be made
+        :param max_wait: seconds to wait for the transaction interval to reset before giving up
+        :param poll: seconds between checks of the map key status
+        """
+        waited = 0
+        while True:
+            status = self._get("mapserver/mapkey_status/", params={"MAP_KEY": self.api_key}).json()
+            limit = self.transaction_limit or status.get("transaction_limit", 5000)
+            if status["current_transactions"] + n_transactions <= limit:
+                return
+            if waited >= max_wait:
+                raise ValueError("Not enough free transactions left with FIRMS API for given key")
+            time.sleep(poll)
+            waited += poll
+
+    def _cache_path(self, product, bbox, day_range, window_end):
+        bbox_hash = hashlib.md5(",".join(str(i) for i in bbox).encode()).hexdigest()[:12]
+        return self.cache_dir.joinpath(product, bbox_hash, f"{window_end:%Y-%m-%d}_{day_range}.csv")
+
+    def fetch_window(self, product, bbox, window_end, day_range=MAX_DAY_RANGE):
+        """
+        Fetch the fire points of one date window, from the cache if the window is complete and was fetched before
+        As in the FIRMS area API, the window is the day_range days up to window_end
+        :param product: FIRMS product
+        :param bbox: list of floats; left, bottom, right, top
+        :param window_end: datetime of the last day of the window
+        :param day_range: int for the number of days in the window
+        :return: pd.DataFrame of fire points, as returned by the API
+        """
+        # a window ending before yesterday will not receive any new acquisitions
+        final = window_end.date() < (datetime.utcnow() - timedelta(days=1)).date()
+        cache_path = self._cache_path(product, bbox, day_range, window_end) if self.cache_dir else None
+        if final and cache_path is not None and cache_path.exists():
+            text = cache_path.read_text()
+        else:
+            bbox_str = ",".join([str(i) for i in bbox])
+            response = self._get(
+                f"api/area/csv/{self.api_key}/{product}/{bbox_str}/{day_range}/{window_end.strftime('%Y-%m-%d')}"
+            )
+            text = response.text
+            if not text.startswith("latitude"):
+                raise ValueError(f"Unexpected response from FIRMS API: {text[:200]}")
+            if final and cache_path is not None:
+                cache_path.parent.mkdir(parents=True, exist_ok=True)
+                tmp_path = cache_path.with_suffix(".tmp")
+                tmp_path.write_text(text)
+                os.replace(tmp_path, cache_path)
+        return pd.read_csv(io.StringIO(text))
+
+    def fetch(self, begin_date, end_date, bbox, day_range=MAX_DAY_RANGE):
+        """
+        Fetch all fire points between two dates, splitting the range into windows that are fetched concurrently
+        Dates after the start of VIIRS_SNPP_NRT are fetched from the NRT product and earlier dates from VIIRS_SNPP_SP
+        :param begin_date: datetime
+        :param end_date: datetime
+        :param bbox: list of floats; left, bottom, right, top
+        :param day_range: int for the number of days in each window
+        :return: pd.DataFrame of fire points with a product column, between begin_date and end_date
+        """
+        if day_range > MAX_DAY_RANGE:
+            raise ValueError(f'"day_range" must be less than or equal to {MAX_DAY_RANGE}')
+
+        window_ends = (
+            (pd.date_range(start=begin_date, end=end_date, freq=f"{day_range}D") + pd.Timedelta(f"{day_range - 1}d"))
+            .to_pydatetime()
+            .tolist()
+        )
+        if len(window_ends) == 0:
+            raise ValueError('No dates to search for, check "begin_date" and "end_date" are formated correctly')
+
+        # split requests by date for VIIRS_SNPP_SP/VIIRS_SNPP_NRT
+        nrt_start, _ = self.data_availability(NRT_PRODUCT)
+        requests_to_make = []
+        for window_end in window_ends:
+            if window_end >= nrt_start:
+                requests_to_make.append((NRT_PRODUCT, window_end))
+            if window_end - timedelta(days=day_range - 1) < nrt_start:
+                requests_to_make.append((SP_PRODUCT, window_end))
+
+        self.reserve_transactions(len(requests_to_make))
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            frames = list(
+                executor.map(
+                    lambda request: self.fetch_window(request[0], bbox, request[1], day_range).assign(
+                        product=request[0]
+                    ),
+                    requests_to_make,
+                )
+            )
+
+        df_fires = pd.concat(frames, ignore_index=True)
+        acq_date = pd.to_datetime(df_fires["acq_date"])
+        df_fires = df_fires[(acq_date >= pd.Timestamp(begin_date).normalize()) & (acq_date <= pd.Timestamp(end_date))]
+        return df_fires.drop_duplicates(FIRE_KEY).reset_index(drop=True)
+
+
+def to_geodataframe(df_fires):
+    """
+    Convert FIRMS fire points to a GeoDataFrame
+    :param df_fires: pd.DataFrame with latitude and longitude columns
+    :return: gpd.GeoDataFrame of fire points
+    """
+    return gpd.GeoDataFrame(
+        df_fires, geometry=gpd.points_from_xy(df_fires.longitude, df_fires.latitude), crs="EPSG:4326"
+    )
+
+
+def load_fires(begin_date, end_date, bbox, day_range=MAX_DAY_RANGE, client=None):
+    """
+    Given input parameters, search NASA firms API for fires and return GeoDataFrame of fire points
+    :param begin_date: datetime
+    :param end_date: datetime
+    :param bbox: list of floats; left, bottom, right, top
+    :param day_range: int for the number of days to search API for
+    :param client: FirmsClient, defaults to a client using the FIRMS_API_KEY environment variable
+    :return: gpd.GeoDataFrame of fire points
+    """
+    client = client or FirmsClient()
+    return to_geodataframe(client.fetch(begin_date, end_date, bbox, day_range))
+
+
+def _acquired(df_fires):
+    # acq_time is HHMM in UTC
+    acq_time = df_fires["acq_time"].astype(int)
+    return pd.to_datetime(df_fires["acq_date"]) + pd.to_timedelta(acq_time // 100 * 60 + acq_time % 100, unit="min")
+
+
+def read_state(state_path):
+    """
+    Read the high-water marks of previous ingestion runs
+    :param state_path: path of the state json
+    :return: dict of "product/bbox" to the last acquisition time ingested, as an ISO string
+    """
+    if not os.path.exists(state_path):
+        return {}
+    with open(state_path) as f:
+        return json.load(f)
+
+
+def _write_state(state, state_path):
+    tmp_path = f"{state_path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(state, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, state_path)
+
+
+def append_to_store(gdf_fires, store_path, layer=STORE_LAYER):
+    """
+    Append fire points to the fire point geopackage, creating it if it does not exist
+    :param gdf_fires: gpd.GeoDataFrame of fire points
+    :param store_path: path of the geopackage read by fires_from_topleft
+    :param layer: layer to append to
+    """
+    if not os.path.exists(store_path):
+        gdf_fires[STORE_COLUMNS].to_file(store_path, layer=layer, driver="GPKG")
+        return
+    # write the new points alongside the store and append them with ogr2ogr, as when the store is first merged
+    new_path = f"{os.path.splitext(store_path)[0]}_new.gpkg"
+    gdf_fires[STORE_COLUMNS].to_file(new_path, layer=layer, driver="GPKG")
+    gdal.VectorTranslate(store_path, new_path, accessMode="append", layerName=layer)
+    os.remove(new_path)
+
+
+def ingest_fires(store_path, state_path, bbox, begin_date, end_date=None, client=None, day_range=MAX_DAY_RANGE):
+    """
+    Fetch only the fire points acquired since the last run and append them to the fire point store
+    The last acquisition time ingested is kept per product and bbox, so a daily run only fetches the latest window
+    :param store_path: path of the fire point geopackage
+    :param state_path: path of the state json holding the high-water marks
+    :param bbox: list of floats; left, bottom, right, top
+    :param begin_date: datetime to ingest from on the first run
+    :param end_date: datetime to ingest up to, defaults to now
+    :param client: FirmsClient, defaults to a client using the FIRMS_API_KEY environment variable
+    :param day_range: int for the number of days in each window
+    :return: gpd.GeoDataFrame of the fire points appended to the store
+    """
+    client = client or FirmsClient()
+    end_date = end_date or datetime.utcnow()
+    state = read_state(state_path)
+    region = ",".join(str(i) for i in bbox)
+    marks = {
+        product: pd.Timestamp(state[f"{product}/{region}"])
+        for product in (NRT_PRODUCT, SP_PRODUCT)
+        if f"{product}/{region}" in state
+    }
+
+    # the day of the oldest high-water mark is fetched again, as later acquisitions of that day may be new
+    fetch_from = min(marks.values()).normalize() if marks else pd.Timestamp(begin_date)
+    fetch_from = max(fetch_from, pd.Timestamp(begin_date))
+    if fetch_from > pd.Timestamp(end_date):
+        return to_geodataframe(pd.DataFrame(columns=FIRE_KEY + ["frp", "product"]))
+    df_fires = client.fetch(fetch_from.to_pydatetime(), end_date, bbox, day_range)
+
+    acquired = _acquired(df_fires)
+    new = pd.Series(True, index=df_fires.index)
+    for product, mark in marks.items():
+        new &= ~((df_fires["product"] == product) & (acquired <= mark))
+    gdf_new = to_geodataframe(df_fires[new].reset_index(drop=True))
+
+    if not gdf_new.empty:
+        append_to_store(gdf_new, store_path)
+        for product, last in acquired[new].groupby(df_fires.loc[new, "product"]).max().items():
+            state[f"{product}/{region}"] = last.isoformat()
+        # the state is only moved on once the points are in the store
+        _write_state(state, state_path)
+    return gdf_new
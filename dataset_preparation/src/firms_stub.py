@@ -0,0 +1,151 @@
+import argparse
+import csv
+import io
+import json
+import threading
+import time
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+from src.firms import NRT_PRODUCT, SP_PRODUCT
+
+AREA_COLUMNS = ["latitude", "longitude", "acq_date", "acq_time", "frp", "confidence"]
+
+
+class StubFirms:
+    """
+    Local stand-in for the FIRMS area API, serving a fixed list of fire points
+    Serves the data availability, map key status and area endpoints used by FirmsClient, and records the path of
+    every request so that windowing and caching can be checked
+    """
+
+    def __init__(self, fires, nrt_start="2021-01-01", max_date=None, fail_first=0, delay_first=0.0):
+        """
+        :param fires: list of dicts with latitude, longitude, acq_date (YYYY-MM-DD), acq_time (HHMM) and frp
+        :param nrt_start: first date of the NRT product, earlier fires are served by the SP product
+        :param max_date: last date reported as available, defaults to today
+        :param fail_first: number of requests answered with a 503 before serving normally
+        :param delay_first: seconds the first request waits before answering, e.g. to trigger client timeouts
+        """
+        self.fires = list(fires)
+        self.nrt_start = nrt_start
+        self.max_date = max_date or datetime.utcnow().strftime("%Y-%m-%d")
+        self.fail_first = fail_first
+        self.delay_first = delay_first
+        self.requests = []
+        self._lock = threading.Lock()
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                with stub._lock:
+                    n_request = len(stub.requests)
+                    stub.requests.append(urlparse(self.path).path)
+                if n_request == 0 and stub.delay_first:
+                    time.sleep(stub.delay_first)
+                if n_request < stub.fail_first:
+                    self._send(503, "text/plain", b"Service Unavailable")
+                    return
+                status, content_type, body = stub.respond(urlparse(self.path).path)
+                self._send(status, content_type, body.encode())
+
+            def _send(self, status, content_type, body):
+                try:
+                    self.send_response(status)
+                    self.send_header("Content-Type", content_type)
+                    self.send_header("Content-Length", str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+                except (BrokenPipeError, ConnectionResetError):
+                    # the client gave up waiting, e.g. on a delayed request
+                    pass
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_port}"
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def area_requests(self):
+        """
+        Area requests received so far
+        :return: list of (product, bbox, day_range, date) tuples
+        """
+        with self._lock:
+            paths = list(self.requests)
+        return [tuple(path.split("/")[5:9]) for path in paths if path.startswith("/api/area/")]
+
+    def respond(self, path):
+        """
+        Answer a request path like the FIRMS API
+        :param path: path of the request URL
+        :return: tuple of status code, content type and body
+        """
+        parts = path.strip("/").split("/")
+        if parts[:3] == ["api", "data_availability", "csv"]:
+            product = parts[4]
+            min_date = self.nrt_start if product == NRT_PRODUCT else "2012-01-20"
+            return 200, "text/csv", f"data_id,min_date,max_date\n{product},{min_date},{self.max_date}\n"
+        if parts[:2] == ["mapserver", "mapkey_status"]:
+            with self._lock:
+                current = len(self.requests)
+            status = {"transaction_limit": 5000, "current_transactions": current, "transaction_interval": "10 minutes"}
+            return 200, "application/json", json.dumps(status)
+        if parts[:3] == ["api", "area", "csv"] and len(parts) == 8:
+            product, bbox, day_range, date = parts[4:8]
+            return 200, "text/csv", self.area_csv(product, bbox, int(day_range), date)
+        return 404, "text/plain", "Invalid API call."
+
+    def area_csv(self, product, bbox, day_range, date):
+        """
+        Fire points of a product in a bbox, over the day_range days up to date
+        :return: str CSV in the column order of the FIRMS area API
+        """
+        left, bottom, right, top = [float(i) for i in bbox.split(",")]
+        end = datetime.strptime(date, "%Y-%m-%d")
+        start = end - timedelta(days=day_range - 1)
+        nrt_start = datetime.strptime(self.nrt_start, "%Y-%m-%d")
+        out = io.StringIO()
+        writer = csv.writer(out, lineterminator="\n")
+        writer.writerow(AREA_COLUMNS)
+        for fire in self.fires:
+            acq_date = datetime.strptime(fire["acq_date"], "%Y-%m-%d")
+            # the products do not overlap, so every fire is served by exactly one of them
+            served = acq_date >= nrt_start if product == NRT_PRODUCT else (product == SP_PRODUCT and acq_date < nrt_start)
+            if (
+                served
+                and start <= acq_date <= end
+                and left <= fire["longitude"] <= right
+                and bottom <= fire["latitude"] <= top
+            ):
+                writer.writerow([fire.get(column, "n") for column in AREA_COLUMNS])
+        return out.getvalue()
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve fire points from a CSV as a local stand-in FIRMS API")
+    parser.add_argument("--fires", required=True, help="CSV with latitude, longitude, acq_date, acq_time and frp")
+    parser.add_argument("--nrt-start", default="2021-01-01")
+    args = parser.parse_args()
+
+    with open(args.fires) as f:
+        fires = [
+            {**row, "latitude": float(row["latitude"]), "longitude": float(row["longitude"])}
+            for row in csv.DictReader(f)
+        ]
+    with StubFirms(fires, nrt_start=args.nrt_start) as stub:
+        print(f"FIRMS_URL={stub.url}")
+        try:
+            threading.Event().wait()
+        except KeyboardInterrupt:
+            pass
@@ -4,11 +4,13 @@ import uuid
 import pyproj
 from osgeo import gdal
 from pyproj import CRS
+from rasterio.features import geometry_mask
 from rasterio.mask import mask
 from rasterio.vrt import WarpedVRT
 from shapely.geometry import box, shape, mapping
 from shapely.ops import transform
 
+from src.block_cache import get_block_cache, is_block_aligned, read_blocks
 from src.constants import CHIP_SIZE
 
 
@@ -121,12 +123,20 @@ def bounds_to_geojson(bounds):
 def read_geospatial_file(aoi, dst_crs, dst_transform, src):
     """
     Reads a geospatial raster in the desired transform
+    Chips are read from the block cache if one is set, see src.block_cache
     :param aoi: aoi to clip to
     :param dst_crs: destination crs
     :param dst_transform: destination transform
     :param src: open rasterio file handler
     :return: the data
     """
+    block_cache = get_block_cache()
+    if block_cache is not None and is_block_aligned(aoi, dst_transform, CHIP_SIZE):
+        data = read_blocks(block_cache, src, dst_crs, dst_transform, CHIP_SIZE)
+        # mask as below; the aoi is the whole chip, so cropping keeps every pixel
+        outside = geometry_mask([aoi], out_shape=CHIP_SIZE, transform=dst_transform)
+        data[:, outside] = src.nodata if src.nodata is not None else 0
+        return data, dst_transform
     with WarpedVRT(
         src,
         **{
@@ -0,0 +1,239 @@
+import os
+import threading
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from src.constants import CHIP_SIZE
+from src.data_sources import cluster_fires
+from src.tracing import record_cached
+
+PIXEL_RES = 500
+CHIP_EXTENT = CHIP_SIZE[0] * PIXEL_RES
+# 8km, chips usually move by at most 4km from their cluster (see snap_chip_bounds for the fires near their edges), and
+# the location of a fire only changes when its centroid drifts by kilometres; it is also the block grid of
+# src/block_cache.py
+SNAP_GRID = CHIP_EXTENT // 4
+MANIFEST_COLUMNS = ["idx", "left", "bottom", "right", "top", "epsg", "date", "n_points", "location", "chip_key"]
+
+
+def location_key(epsg, left, top):
+    """
+    Key of a chip location, shared by every chip with the same snapped top left corner and CRS
+    :param epsg: EPSG code of the chip
+    :param left: snapped left bound of the chip
+    :param top: snapped top bound of the chip
+    :return: str location key
+    """
+    return f"{int(epsg)}_{int(round(left))}_{int(round(top))}"
+
+
+def _snap_candidates(value, grid):
+    """Grid values to try for a bound, the nearest first"""
+    nearest = round(value / grid) * grid
+    return [nearest] + [v for v in (np.floor(value / grid) * grid, np.ceil(value / grid) * grid) if v != nearest]
+
+
+def _chip_fire_points(manifest, clustered_fires):
+    """
+    Fire points of each chip's cluster in the chip CRS
+    :return: dict of manifest index to (n, 2) array of x, y
+    """
+    points = {}
+    for epsg, chips in manifest.groupby("epsg"):
+        fires = clustered_fires[clustered_fires["label"].isin(chips["idx"])].to_crs(int(epsg))
+        xy = np.column_stack([fires.geometry.x, fires.geometry.y])
+        labels = fires["label"].values
+        for index, cluster in chips["idx"].items():
+            points[index] = xy[labels == cluster]
+    return points
+
+
+def snap_chip_bounds(manifest, grid=SNAP_GRID, clustered_fires=None):
+    """
+    Snap chip bounds to a grid in their UTM zone, so that a fire burning over several days keeps the same chip
+    location and its static layers can be reused
+    If the clustered fire points are given, the fire points inside a chip are kept inside it: the nearest grid
+    corner is used if it keeps them, otherwise the grid corner on the other side of each bound, and the chip keeps
+    its unsnapped bounds if no grid corner does
+    :param manifest: pd.DataFrame of chip bounds from create_chip_bounds
+    :param grid: grid spacing in metres, chips are moved by at most half of it, or less than a grid step to keep
+        their fire points
+    :param clustered_fires: geodataframe of the clustered fire points the chips were created from, with the cluster
+        of each point in the label column matching the chip idx
+    :return: pd.DataFrame of the snapped chip bounds with location and chip_key columns
+    """
+    manifest = manifest.copy()
+    points = _chip_fire_points(manifest, clustered_fires) if clustered_fires is not None else {}
+    lefts, tops = [], []
+    for index, left, bottom, right, top in manifest[["left", "bottom", "right", "top"]].itertuples():
+        xy = points.get(index, np.empty((0, 2)))
+        # only the points inside the chip before snapping, clusters can be larger than a chip
+        xy = xy[(xy[:, 0] >= left) & (xy[:, 0] <= right) & (xy[:, 1] >= bottom) & (xy[:, 1] <= top)]
+        snapped = next(
+            (
+                (snapped_left, snapped_top)
+                for snapped_left in _snap_candidates(left, grid)
+                for snapped_top in _snap_candidates(top, grid)
+                if np.all((xy[:, 0] >= snapped_left) & (xy[:, 0] <= snapped_left + CHIP_EXTENT))
+                and np.all((xy[:, 1] <= snapped_top) & (xy[:, 1] >= snapped_top - CHIP_EXTENT))
+            ),
+            (left, top),
+        )
+        lefts.append(snapped[0])
+        tops.append(snapped[1])
+    manifest["left"] = np.asarray(lefts, dtype=float)
+    manifest["top"] = np.asarray(tops, dtype=float)
+    manifest["right"] = manifest["left"] + CHIP_EXTENT
+    manifest["bottom"] = manifest["top"] - CHIP_EXTENT
+    manifest["location"] = [
+        location_key(epsg, left, top) for epsg, left, top in manifest[["epsg", "left", "top"]].values
+    ]
+    manifest["chip_key"] = manifest["location"] + "_" + manifest["date"].astype(str)
+    # clusters snapped onto the same location and date are the same chip, keep the largest
+    if "n_points" in manifest.columns:
+        manifest = manifest.sort_values("n_points", ascending=False, kind="stable")
+    return manifest.drop_duplicates("chip_key").sort_index()
+
+
+def read_history(history_csv):
+    """
+    Read the chips of previous runs
+    :param history_csv: path of the manifest history written by write_history
+    :return: pd.DataFrame of previously processed chips, empty on the first run
+    """
+    if not os.path.exists(history_csv):
+        return pd.DataFrame(columns=MANIFEST_COLUMNS)
+    return pd.read_csv(history_csv, dtype={"date": str})
+
+
+def write_history(history_csv, manifest, previous_manifest):
+    """
+    Write the chips of this run to the manifest history, replacing previous chips with the same key
+    :param history_csv: path of the manifest history
+    :param manifest: pd.DataFrame of chips from diff_manifest
+    :param previous_manifest: pd.DataFrame of chips from read_history
+    """
+    history = pd.concat([previous_manifest, manifest[MANIFEST_COLUMNS]], ignore_index=True)
+    history = history.drop_duplicates("chip_key", keep="last")
+    tmp_csv = f"{history_csv}.tmp"
+    history.to_csv(tmp_csv, index=False)
+    os.replace(tmp_csv, history_csv)
+
+
+def dates_to_cluster(fire_dates, previous_manifest, refresh_days=1):
+    """
+    Find the fire dates that need clustering; dates not seen in a previous run, and the latest dates of the previous
+    run as near real-time fires for those days may have arrived since
+    :param fire_dates: iterable of acq_date strings
+    :param previous_manifest: pd.DataFrame of chips from read_history
+    :param refresh_days: number of days up to the latest previous date that are clustered again
+    :return: sorted list of acq_date strings
+    """
+    fire_dates = sorted(set(fire_dates))
+    if previous_manifest.empty:
+        return fire_dates
+    seen = set(previous_manifest["date"].astype(str))
+    refresh_from = pd.Timestamp(max(seen)) - pd.Timedelta(days=refresh_days - 1)
+    return [date for date in fire_dates if date not in seen or pd.Timestamp(date) >= refresh_from]
+
+
+def cluster_new_fires(fire_dataframe, previous_manifest, refresh_days=1, min_cluster_points=25):
+    """
+    Cluster only the fire points of the dates that need clustering, see dates_to_cluster
+    :param fire_dataframe: geodataframe of fire points
+    :param previous_manifest: pd.DataFrame of chips from read_history
+    :param refresh_days: number of days up to the latest previous date that are clustered again
+    :param min_cluster_points: minimum number of fire points in a cluster for it to be kept
+    :return: geodataframe of fire points that belong to a cluster, empty if no dates need clustering
+    """
+    dates = dates_to_cluster(fire_dataframe["acq_date"].astype(str), previous_manifest, refresh_days)
+    new_fires = fire_dataframe[fire_dataframe["acq_date"].astype(str).isin(dates)]
+    if new_fires.empty:
+        return new_fires.assign(label=pd.Series(dtype=int))
+    # cluster_fires expects the points of each date to have consecutive index values
+    new_fires = new_fires.sort_values("acq_date", kind="stable").reset_index(drop=True)
+    return cluster_fires(new_fires, min_cluster_points=min_cluster_points)
+
+
+def diff_manifest(manifest, previous_manifest):
+    """
+    Compare the chips of this run to previous runs
+    Chips with the same location, date and number of fire points as before keep their idx and are "unchanged".
+    Chips whose cluster grew are "changed" and new chip keys are "new", both get a new idx so their fires are
+    rasterized again, while their other layers can be read from a LayerCache.
+    :param manifest: pd.DataFrame of snapped chip bounds from snap_chip_bounds
+    :param previous_manifest: pd.DataFrame of chips from read_history
+    :return: pd.DataFrame of the manifest with idx and status columns
+    """
+    manifest = manifest.reset_index(drop=True)
+    previous = previous_manifest.set_index("chip_key")
+    known = manifest["chip_key"].isin(previous.index)
+    previous_points = previous["n_points"].reindex(manifest["chip_key"]).values
+    unchanged = known & (previous_points == manifest["n_points"].values)
+
+    manifest["status"] = np.where(unchanged, "unchanged", np.where(known, "changed", "new"))
+    next_idx = int(previous_manifest["idx"].max()) + 1 if not previous_manifest.empty else 0
+    manifest["idx"] = next_idx + np.arange(len(manifest))
+    manifest.loc[unchanged, "idx"] = previous["idx"].reindex(manifest.loc[unchanged, "chip_key"]).values
+    manifest["idx"] = manifest["idx"].astype(int)
+    return manifest
+
+
+class LayerCache:
+    """
+    Cache of chip layers that do not depend on fire activity; static layers (elevation, landcover) are keyed by
+    chip location and dynamic layers (ndvi, atmospheric) by chip location and date
+    """
+
+    def __init__(self, cache_dir=None):
+        """
+        :param cache_dir: local directory of the cached layers, layers are always computed if None
+        """
+        self.cache_dir = Path(cache_dir) if cache_dir else None
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def _get(self, path, compute, group, location, date=None):
+        if self.cache_dir is None:
+            return compute()
+        if path.exists():
+            with self._lock:
+                self.hits += 1
+            record_cached(group, location, date)
+            with np.load(path) as cached:
+                return {name: cached[name] for name in cached.files}
+        with self._lock:
+            self.misses += 1
+        layers = compute()
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # write to a temporary file first, so a crashed run never leaves a partial layer behind
+        tmp_path = path.with_name(f"{path.stem}_{threading.get_ident()}.tmp.npz")
+        np.savez(tmp_path, **{name: np.asarray(layer) for name, layer in layers.items()})
+        os.replace(tmp_path, path)
+        return layers
+
+    def static(self, location, group, compute):
+        """
+        Get layers that only depend on the chip location
+        :param location: location key of the chip
+        :param group: name of the layer group, e.g. elevation
+        :param compute: function returning a dict of layer name to array, called on a cache miss
+        :return: dict of layer name to array
+        """
+        path = self.cache_dir.joinpath("static", location, f"{group}.npz") if self.cache_dir else None
+        return self._get(path, compute, group, location)
+
+    def dynamic(self, location, date, group, compute):
+        """
+        Get layers that depend on the chip location and date
+        :param location: location key of the chip
+        :param date: date of the chip
+        :param group: name of the layer group, e.g. atmospheric
+        :param compute: function returning a dict of layer name to array, called on a cache miss
+        :return: dict of layer name to array
+        """
+        path = self.cache_dir.joinpath("dynamic", location, str(date), f"{group}.npz") if self.cache_dir else None
+        return self._get(path, compute, group, location, str(date))
@@ -0,0 +1,300 @@
+import os
+import queue
+import threading
+import time
+from pathlib import Path
+
+import geopandas as gpd
+import numpy as np
+import rasterio
+from shapely.geometry import box
+
+from src.constants import DEFAULT_PARAMS
+from src.data_sources import (
+    cluster_fires,
+    create_chip_bounds,
+    ndvi_from_topleft,
+    landcover_from_topleft,
+    atmospheric_from_topleft,
+    fires_from_topleft,
+    elevation_from_topleft,
+)
+from src.deduplication import deduplicate_chips
+from src.incremental import LayerCache
+from src.tracing import chip_context
+
+# layers produced by each data source, a source is only queried if one of its layers is a model input
+LAYER_GROUPS = {
+    "fires": ("todays_fires", "todays_frp"),
+    "elevation": ("elevation",),
+    "landcover": ("landcover",),
+    "ndvi": ("ndvi",),
+    "atmospheric": tuple(DEFAULT_PARAMS),
+}
+STATIC_GROUPS = ("elevation", "landcover")
+DYNAMIC_GROUPS = ("ndvi", "atmospheric")
+_DONE = object()
+
+
+def build_manifest(fires, min_cluster_points=25):
+    """
+    Given fire points, cluster them and create the bounds of the chips to predict
+    :param fires: gpd.GeoDataFrame of fire points or path to the fire point geopackage
+    :param min_cluster_points: minimum number of fire points in a cluster for it to be kept
+    :return: tuple of the fire points as a gpd.GeoDataFrame and the pd.DataFrame of chip bounds
+    """
+    if isinstance(fires, (str, Path)):
+        fires = gpd.read_file(fires, layer="merge")
+    if "longitude" not in fires.columns:
+        fires = fires.assign(longitude=fires.geometry.x, latitude=fires.geometry.y)
+    fires = fires.sort_values("acq_date", kind="stable").reset_index(drop=True)
+    manifest = create_chip_bounds(cluster_fires(fires, min_cluster_points=min_cluster_points))
+    return fires, deduplicate_chips(manifest, policy="largest_cluster")
+
+
+def chip_layers(chip, features, fires, cog_footprints=None, layer_cache=None):
+    """
+    Load the layers of a chip, only querying the data sources needed for the requested features
+    :param chip: chip bounds, a row of the manifest as a dict
+    :param features: names of the layers to load
+    :param fires: gpd.GeoDataFrame of fire points
+    :param cog_footprints: gpd.GeoDataFrame of the dem footprints, needed for elevation
+    :param layer_cache: LayerCache for the layers that do not depend on fire activity
+    :return: dict of layer name to 2D array
+    """
+    layer_cache = layer_cache or LayerCache()
+    top_left, epsg, date = [chip["top"], chip["left"]], chip["epsg"], chip["date"]
+    location = chip.get("location", f"{int(epsg)}_{int(chip['left'])}_{int(chip['top'])}")
+
+    def load_fires():
+        fire_array = fires_from_topleft(top_left, epsg, date, fires=fires)
+        return {"todays_fires": fire_array.bool.values, "todays_frp": fire_array.frp.values}
+
+    def load_atmospheric():
+        atmos = atmospheric_from_topleft(top_left, epsg, date, DEFAULT_PARAMS)
+        return {var: getattr(atmos, var).values[0] for var in list(atmos.data_vars)}
+
+    loaders = {
+        "fires": load_fires,
+        "elevation": lambda: {"elevation": elevation_from_topleft(top_left, epsg, cog_footprints)},
+        "landcover": lambda: {"landcover": landcover_from_topleft(top_left, epsg)},
+        "ndvi": lambda: {"ndvi": ndvi_from_topleft(top_left, epsg, date)},
+        "atmospheric": load_atmospheric,
+    }
+
+    layers = {}
+    for group, names in LAYER_GROUPS.items():
+        if not set(names) & set(features):
+            continue
+        if group in STATIC_GROUPS:
+            layers.update(layer_cache.static(location, group, loaders[group]))
+        elif group in DYNAMIC_GROUPS:
+            layers.update(layer_cache.dynamic(location, date, group, loaders[group]))
+        else:
+            layers.update(loaders[group]())
+    missing = set(features) - set(layers)
+    if missing:
+        raise ValueError(f"No data source for features: {sorted(missing)}")
+    return {name: np.asarray(layers[name]) for name in features}
+
+
+def normalize_layers(layers, features, data_stats, features_not_norm=()):
+    """
+    Stack chip layers into a model input, clipping and rescaling them as when parsing TFRecords for training
+    :param layers: dict of layer name to 2D array
+    :param features: names of the input layers, in model input order
+    :param data_stats: dict of layer name to (min, max, mean, std), e.g. DATA_STATS from deep_learning/config.py
+    :param features_not_norm: names of the layers that are not rescaled, e.g. FEATURES_NOT_NORM
+    :return: float32 array of shape (height, width, len(features))
+    """
+    channels = []
+    for feature in features:
+        layer = layers[feature].astype(np.float32)
+        if feature not in features_not_norm:
+            if feature not in data_stats:
+                raise ValueError(f"No data statistics available for the requested key: {feature}.")
+            min_val, max_val, _, _ = data_stats[feature]
+            layer = np.clip(layer, min_val, max_val)
+            layer = (layer - min_val) / (max_val - min_val) if max_val != min_val else np.zeros_like(layer)
+        channels.append(np.nan_to_num(layer, nan=0.0))
+    return np.stack(channels, axis=-1)
+
+
+def save_chip(output_dir, chip, layers, probabilities=None):
+    """
+    Write the layers and predictions of a chip in the layout of process_chip
+    :param output_dir: directory of the chip
+    :param chip: chip bounds, a row of the manifest as a dict
+    :param layers: dict of layer name to 2D array
+    :param probabilities: 2D array of fire probabilities, not written if None
+    """
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    bounds_utm = rasterio.coords.BoundingBox(
+        left=chip["left"], right=chip["right"], bottom=chip["bottom"], top=chip["top"]
+    )
+    gpd.GeoSeries([box(*bounds_utm)]).set_crs(chip["epsg"]).to_file(output_dir.joinpath("bbox.geojson"))
+    for name, layer in layers.items():
+        np.save(output_dir.joinpath(f"{name}.npy"), layer)
+    if probabilities is not None:
+        np.save(output_dir.joinpath("probabilities.npy"), probabilities)
+
+
+class PredictionPipeline:
+    """
+    Streaming prediction from fire points to fire probability maps, without writing intermediates to disk
+    Chips are fed to a pool of threads loading and normalizing their layers, and normalized chips are batched for
+    the model as they arrive. Queues between the stages are bounded, so memory use does not grow with the number of
+    chips.
+    """
+
+    def __init__(
+        self,
+        model,
+        input_features,
+        data_stats,
+        features_not_norm=(),
+        cog_footprints=None,
+        batch_size=64,
+        workers=None,
+        queue_size=None,
+        layer_cache=None,
+        output_dir=None,
+    ):
+        """
+        :param model: model returning fire probabilities of shape (batch, height, width, 1) for a batch of inputs,
+            e.g. a tf.keras.Model
+        :param input_features: names of the model input layers, e.g. INPUT_FEATURES from deep_learning/config.py
+        :param data_stats: dict of layer name to (min, max, mean, std), e.g. DATA_STATS from deep_learning/config.py
+        :param features_not_norm: names of the layers that are not rescaled, e.g. FEATURES_NOT_NORM
+        :param cog_footprints: gpd.GeoDataFrame of the dem footprints, needed if elevation is an input
+        :param batch_size: number of chips per model call
+        :param workers: number of threads loading chip layers, defaults to the number of CPUs
+        :param queue_size: maximum number of chips waiting between stages, defaults to two batches
+        :param layer_cache: LayerCache for the layers that do not depend on fire activity
+        :param output_dir: if set, the layers and probabilities of each chip are also written here
+        """
+        self.model = model
+        self.input_features = list(input_features)
+        self.data_stats = data_stats
+        self.features_not_norm = set(features_not_norm)
+        self.cog_footprints = cog_footprints
+        self.batch_size = batch_size
+        self.workers = workers or os.cpu_count()
+        self.queue_size = queue_size or 2 * batch_size
+        self.layer_cache = layer_cache or LayerCache()
+        self.output_dir = output_dir
+        self.errors = {}
+        self.timings = {"load": 0.0, "predict": 0.0}
+        self._lock = threading.Lock()
+
+    def _put(self, q, item, stop):
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _guard(self, target, failures, *args):
+        # exceptions escaping a thread are only printed, so they are kept for run to re-raise
+        try:
+            target(*args)
+        except BaseException as e:
+            failures.append(e)
+
+    def _feed(self, chips, chip_queue, stop):
+        for chip in chips:
+            if not self._put(chip_queue, chip, stop):
+                return
+        for _ in range(self.workers):
+            self._put(chip_queue, _DONE, stop)
+
+    def _load(self, fires, chip_queue, ready_queue, stop):
+        while not stop.is_set():
+            try:
+                chip = chip_queue.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            if chip is _DONE:
+                self._put(ready_queue, _DONE, stop)
+                return
+            start = time.perf_counter()
+            try:
+                with chip_context(chip["idx"]):
+                    layers = chip_layers(chip, self.input_features, fires, self.cog_footprints, self.layer_cache)
+                inputs = normalize_layers(layers, self.input_features, self.data_stats, self.features_not_norm)
+            except Exception as e:
+                # e.g. RasterioIOError for missing source data, the chip is skipped as in process_chip
+                with self._lock:
+                    self.errors[chip["idx"]] = repr(e)
+                continue
+            with self._lock:
+                self.timings["load"] += time.perf_counter() - start
+            self._put(ready_queue, (chip, layers, inputs), stop)
+
+    def _predict(self, batch):
+        start = time.perf_counter()
+        probabilities = np.asarray(self.model(np.stack([inputs for _, _, inputs in batch]), training=False))
+        self.timings["predict"] += time.perf_counter() - start
+        for (chip, layers, _), chip_probabilities in zip(batch, probabilities):
+            if self.output_dir is not None:
+                save_chip(Path(self.output_dir).joinpath(str(chip["idx"])), chip, layers, chip_probabilities)
+            yield chip, chip_probabilities[..., 0]
+
+    def run(self, fires, manifest=None):
+        """
+        Predict fire probabilities for the chips of a set of fire points
+        :param fires: gpd.GeoDataFrame of fire points or path to the fire point geopackage
+        :param manifest: pd.DataFrame of chip bounds, built from the fire points if None
+        :return: generator of (chip, 2D array of fire probabilities), in the order chips finish loading
+        """
+        if manifest is None:
+            fires, manifest = build_manifest(fires)
+        elif isinstance(fires, (str, Path)):
+            fires = gpd.read_file(fires, layer="merge")
+        chips = list(manifest.T.to_dict().values())
+
+        stop = threading.Event()
+        chip_queue = queue.Queue(maxsize=self.queue_size)
+        ready_queue = queue.Queue(maxsize=self.queue_size)
+        failures = []
+        threads = [
+            threading.Thread(target=self._guard, args=(self._feed, failures, chips, chip_queue, stop), daemon=True)
+        ]
+        threads += [
+            threading.Thread(
+                target=self._guard, args=(self._load, failures, fires, chip_queue, ready_queue, stop), daemon=True
+            )
+            for _ in range(self.workers)
+        ]
+        for thread in threads:
+            thread.start()
+
+        try:
+            batch, finished = [], 0
+            while finished < self.workers:
+                if failures:
+                    raise failures[0]
+                try:
+                    item = ready_queue.get(timeout=0.1)
+                except queue.Empty:
+                    # a thread that died without raising would otherwise leave run waiting forever
+                    if not any(thread.is_alive() for thread in threads) and ready_queue.empty() and not failures:
+                        raise RuntimeError("Chip loading threads stopped before loading every chip")
+                    continue
+                if item is _DONE:
+                    finished += 1
+                    continue
+                batch.append(item)
+                if len(batch) == self.batch_size:
+                    yield from self._predict(batch)
+                    batch = []
+            if batch:
+                yield from self._predict(batch)
+        finally:
+            # also stops the threads if the caller stops iterating early
+            stop.set()
+            for thread in threads:
+                thread.join()
@@ -0,0 +1,216 @@
+import asyncio
+import contextvars
+import functools
+import json
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+from osgeo import gdal
+
+# idx of the chip being processed by the current thread, attached to every span it records
+_current_chip = contextvars.ContextVar("current_chip", default=None)
+_current_span = contextvars.ContextVar("current_span", default=None)
+
+
+def _network_bytes():
+    """Bytes downloaded by GDAL over the network so far, zero unless network stats are enabled"""
+    stats = json.loads(gdal.NetworkStatsGetAsSerializedJSON() or "{}")
+    return sum(method.get("downloaded_bytes", 0) for method in stats.get("methods", {}).values())
+
+
+class Tracer:
+    """
+    Collects one span per call to a data source, with its chip, duration, bytes read, cache hits and outcome
+    """
+
+    def __init__(self, network_stats=True):
+        """
+        :param network_stats: enable GDAL network statistics to record the bytes read by each span. GDAL counts bytes
+            for the whole process, so with chips processed in parallel the bytes of a span include those read by other
+            threads over the same period
+        """
+        self.spans = []
+        self._lock = threading.Lock()
+        if network_stats:
+            gdal.SetConfigOption("CPL_VSIL_NETWORK_STATS_ENABLED", "YES")
+
+    def record(self, span):
+        with self._lock:
+            self.spans.append(span)
+
+    def reset(self):
+        with self._lock:
+            self.spans = []
+
+    def summary(self):
+        """
+        Aggregate the spans per source and outcome
+        :return: dict of source to dict of outcome to calls, seconds, bytes_read and cache_hits
+        """
+        summary = defaultdict(lambda: defaultdict(lambda: {"calls": 0, "seconds": 0.0, "bytes_read": 0,
+                                                           "cache_hits": 0}))
+        with self._lock:
+            spans = list(self.spans)
+        for span in spans:
+            totals = summary[span["source"]][span["outcome"]]
+            totals["calls"] += 1
+            totals["seconds"] += span["duration_s"]
+            totals["bytes_read"] += span["bytes_read"]
+            totals["cache_hits"] += span["cache_hits"]
+        return {source: dict(outcomes) for source, outcomes in summary.items()}
+
+    def to_json(self, path=None):
+        """
+        Export the spans as JSON
+        :param path: file to write to, the JSON is only returned if None
+        :return: JSON string of the list of spans
+        """
+        with self._lock:
+            spans_json = json.dumps(self.spans, indent=2, default=str)
+        if path is not None:
+            with open(path, "w") as f:
+                f.write(spans_json)
+        return spans_json
+
+    def to_prometheus(self, prefix="chip_source"):
+        """
+        Export the aggregated spans in the Prometheus text exposition format
+        :param prefix: prefix of the metric names
+        :return: str of the metrics
+        """
+        metrics = [
+            ("calls", "Number of calls to the data source"),
+            ("seconds", "Time spent in the data source"),
+            ("bytes_read", "Bytes read over the network by the data source"),
+            ("cache_hits", "Layers or raster blocks read from a cache"),
+        ]
+        summary = self.summary()
+        lines = []
+        for name, help_text in metrics:
+            lines.append(f"# HELP {prefix}_{name}_total {help_text}")
+            lines.append(f"# TYPE {prefix}_{name}_total counter")
+            for source, outcomes in sorted(summary.items()):
+                for outcome, totals in sorted(outcomes.items()):
+                    lines.append(f'{prefix}_{name}_total{{source="{source}",outcome="{outcome}"}} {totals[name]}')
+        return "\n".join(lines) + "\n"
+
+
+TRACER = Tracer(network_stats=False)
+
+
+def set_tracer(tracer):
+    """
+    Replace the tracer recording the spans of the data sources
+    :param tracer: Tracer
+    """
+    global TRACER
+    TRACER = tracer
+
+
+@contextmanager
+def chip_context(chip_idx):
+    """
+    Attach the spans recorded inside the context to a chip
+    :param chip_idx: idx of the chip in the manifest
+    """
+    token = _current_chip.set(chip_idx)
+    try:
+        yield
+    finally:
+        _current_chip.reset(token)
+
+
+def add_cache_hits(n=1):
+    """
+    Count cache hits towards the span of the data source being called, if any
+    :param n: number of cache hits
+    """
+    span = _current_span.get()
+    if span is not None:
+        span["cache_hits"] += n
+
+
+def record_cached(source, chip=None, date=None):
+    """
+    Record a span for a data source call answered entirely from a cache, e.g. a LayerCache hit
+    :param source: name of the data source
+    :param chip: location of the chip
+    :param date: date of the chip
+    """
+    TRACER.record({
+        "source": source,
+        "chip_idx": _current_chip.get(),
+        "chip": chip,
+        "date": date,
+        "start": time.time(),
+        "duration_s": 0.0,
+        "bytes_read": 0,
+        "cache_hits": 1,
+        "outcome": "cached",
+        "error": None,
+    })
+
+
+def traced(source):
+    """
+    Decorate a *_from_topleft function, or a coroutine function with the same arguments, to record a span for every
+    call
+    The chip is identified from the top_left, epsg and date arguments, errors are recorded and raised again
+    :param source: name of the data source
+    """
+    def start_span(args):
+        top_left, epsg = args[0], args[1]
+        date = args[2] if len(args) > 2 and isinstance(args[2], str) else None
+        span = {
+            "source": source,
+            "chip_idx": _current_chip.get(),
+            "chip": f"{int(epsg)}_{int(top_left[1])}_{int(top_left[0])}",
+            "date": date,
+            "start": time.time(),
+            "duration_s": 0.0,
+            "bytes_read": 0,
+            "cache_hits": 0,
+            "outcome": "ok",
+            "error": None,
+        }
+        return span, _current_span.set(span), _network_bytes(), time.perf_counter()
+
+    def end_span(span, token, bytes_before, start):
+        span["duration_s"] = time.perf_counter() - start
+        span["bytes_read"] = _network_bytes() - bytes_before
+        _current_span.reset(token)
+        TRACER.record(span)
+
+    def decorator(func):
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                span, *state = start_span(args)
+                try:
+                    return await func(*args, **kwargs)
+                except Exception as e:
+                    span["outcome"] = type(e).__name__
+                    span["error"] = str(e)
+                    raise
+                finally:
+                    end_span(span, *state)
+
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            span, *state = start_span(args)
+            try:
+                return func(*args, **kwargs)
+            except Exception as e:
+                span["outcome"] = type(e).__name__
+                span["error"] = str(e)
+                raise
+            finally:
+                end_span(span, *state)
+
+        return wrapper
+
+    return decorator
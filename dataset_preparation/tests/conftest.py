@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the tests import the dataset preparation code as the src package, as when run from dataset_preparation
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
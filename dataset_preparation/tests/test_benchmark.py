@@ -0,0 +1,38 @@
+import json
+
+import pytest
+
+from src.benchmark import benchmark_failed, main, run_benchmark
+
+SOURCES = {"ndvi", "fires", "elevation", "landcover", "atmospheric"}
+
+
+@pytest.fixture(scope="module")
+def results():
+    # synthetic COGs, ERA5 zarrs and a stub STAC server, no network access
+    return run_benchmark(n_chips=2, workers=2)
+
+
+def test_run_benchmark_offline(results):
+    assert results["chips"] == 2
+    assert results["failed"] == 0
+    assert results["chips_per_sec"] > 0
+    assert SOURCES <= set(results["stages"])
+    assert all(sum(results["stages"][source]["outcomes"].values()) >= 2 for source in SOURCES)
+
+
+def test_benchmark_failed(results):
+    assert not benchmark_failed(results)
+    assert not benchmark_failed(results, min_chips_per_sec=results["chips_per_sec"] / 2)
+    assert benchmark_failed(results, min_chips_per_sec=results["chips_per_sec"] * 2)
+    assert benchmark_failed(dict(results, failed=1))
+
+
+def test_min_chips_per_sec_exit_code(tmp_path, capsys):
+    output = tmp_path / "benchmark.json"
+    main(["--chips", "1", "--workers", "1", "--output", str(output)])
+    assert json.loads(output.read_text())["failed"] == 0
+
+    with pytest.raises(SystemExit) as exit_info:
+        main(["--chips", "1", "--workers", "1", "--min-chips-per-sec", "1e9"])
+    assert exit_info.value.code == 1
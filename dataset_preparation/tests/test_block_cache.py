@@ -0,0 +1,126 @@
+import multiprocessing
+import sqlite3
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import affine
+import numpy as np
+import pytest
+import rasterio
+from rasterio.crs import CRS
+from rasterio.transform import from_origin
+
+from src.block_cache import BlockCache, set_block_cache
+from src.geospatial import bounds_to_geojson, read_geospatial_file
+
+TOP_LEFT = [4300000, 500000]
+EPSG = 32610
+# 16 x 16 uint8 blocks are 384 bytes as .npy files, with the 128 byte header
+BLOCK = np.zeros((1, 16, 16), dtype=np.uint8)
+BLOCK_BYTES = 384
+
+
+@pytest.fixture
+def cog(tmp_path):
+    # a 100m raster in the chip CRS around the chip, warped to the 500m chip grid
+    path = str(tmp_path / "source.tif")
+    data = np.random.default_rng(0).integers(0, 255, (480, 480), dtype=np.uint8)
+    profile = {
+        "driver": "GTiff",
+        "dtype": "uint8",
+        "count": 1,
+        "height": data.shape[0],
+        "width": data.shape[1],
+        "crs": CRS.from_epsg(EPSG),
+        "transform": from_origin(TOP_LEFT[1] - 4000, TOP_LEFT[0] + 4000, 100, 100),
+        "tiled": True,
+        "blockxsize": 256,
+        "blockysize": 256,
+        "nodata": 0,
+    }
+    with rasterio.open(path, "w", **profile) as dst:
+        dst.write(data, 1)
+    return path
+
+
+def read_chip(path, top_left):
+    aoi = bounds_to_geojson(
+        rasterio.coords.BoundingBox(
+            left=top_left[1], right=top_left[1] + 32000, bottom=top_left[0] - 32000, top=top_left[0]
+        )
+    )
+    dst_transform = affine.Affine(500, 0.0, top_left[1], 0.0, -500, top_left[0])
+    with rasterio.open(path) as src:
+        return read_geospatial_file(aoi, CRS.from_epsg(EPSG), dst_transform, src)
+
+
+def test_cached_reads_equal_uncached_reads(cog, tmp_path):
+    set_block_cache(None)
+    # chips are on the 500m grid but not on the 8km block grid, so blocks are clipped to them
+    shifted = [TOP_LEFT[0] - 1500, TOP_LEFT[1] + 2500]
+    uncached = [read_chip(cog, top_left) for top_left in [TOP_LEFT, shifted]]
+
+    block_cache = BlockCache(str(tmp_path / "cache"))
+    set_block_cache(block_cache)
+    try:
+        cold = [read_chip(cog, top_left) for top_left in [TOP_LEFT, shifted]]
+        warm = [read_chip(cog, top_left) for top_left in [TOP_LEFT, shifted]]
+    finally:
+        set_block_cache(None)
+
+    for (expected, expected_tf), (data, tf) in zip(uncached * 2, cold + warm):
+        assert tf == expected_tf
+        np.testing.assert_array_equal(data, expected)
+    assert block_cache.stats()["hits"] > 0
+
+
+def test_evicts_least_recently_used_down_to_90_percent(tmp_path):
+    block_cache = BlockCache(str(tmp_path), max_bytes=10 * BLOCK_BYTES)
+    for idx in range(10):
+        block_cache.put(f"{idx:02d}", BLOCK)
+        time.sleep(0.01)
+    assert block_cache.stats()["bytes"] == 10 * BLOCK_BYTES
+
+    # reading the oldest block makes it the most recently used
+    assert block_cache.get("00") is not None
+    time.sleep(0.01)
+    block_cache.put("10", BLOCK)
+
+    stats = block_cache.stats()
+    assert stats["bytes"] <= 0.9 * block_cache.max_bytes
+    assert stats["blocks"] == 9
+    assert block_cache.get("01") is None and block_cache.get("02") is None
+    assert block_cache.get("00") is not None and block_cache.get("10") is not None
+
+
+def test_stats(tmp_path):
+    block_cache = BlockCache(str(tmp_path))
+    assert block_cache.stats() == {"hits": 0, "misses": 0, "hit_rate": 0.0, "blocks": 0, "bytes": 0}
+
+    assert block_cache.get("a0") is None
+    block_cache.put("a0", BLOCK)
+    np.testing.assert_array_equal(block_cache.get("a0"), BLOCK)
+    block_cache.get("a0")
+    assert block_cache.stats() == {"hits": 2, "misses": 1, "hit_rate": 2 / 3, "blocks": 1, "bytes": BLOCK_BYTES}
+
+
+def _put_blocks(cache_dir, worker, n_blocks):
+    block_cache = BlockCache(cache_dir)
+    for idx in range(n_blocks):
+        block_cache.put(f"{worker}{idx:03d}", np.full((1, 16, 16), worker, dtype=np.uint8))
+    return block_cache.stats()["misses"]
+
+
+def test_cache_is_shared_by_processes(tmp_path):
+    cache_dir = str(tmp_path)
+    block_cache = BlockCache(cache_dir)
+    with sqlite3.connect(block_cache.db_path) as conn:
+        assert conn.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+
+    with ProcessPoolExecutor(4, mp_context=multiprocessing.get_context("fork")) as pool:
+        assert list(pool.map(_put_blocks, [cache_dir] * 4, range(1, 5), [50] * 4)) == [0] * 4
+
+    # every block written by the other processes is indexed and readable here
+    assert block_cache.stats()["blocks"] == 200
+    for worker in range(1, 5):
+        assert block_cache.get(f"{worker}049")[0, 0, 0] == worker
@@ -0,0 +1,63 @@
+import pandas as pd
+import pytest
+
+from src.deduplication import UnionFind, chip_footprints, deduplicate_chips, overlap_components
+
+EXTENT = 32000
+
+
+def chip(left, bottom=4000000, date="2021-08-01", n_points=25, epsg=32610):
+    return {"left": left, "bottom": bottom, "right": left + EXTENT, "top": bottom + EXTENT, "epsg": epsg,
+            "date": date, "n_points": n_points}
+
+
+def test_union_find():
+    uf = UnionFind(6)
+    uf.union(0, 1)
+    uf.union(2, 3)
+    uf.union(1, 3)
+    uf.union(3, 0)
+    labels = uf.labels()
+    assert len({labels[i] for i in range(4)}) == 1
+    assert len(set(labels)) == 3
+    assert uf.size[uf.find(0)] == 4
+    assert uf.find(4) == 4 and uf.find(5) == 5
+
+
+def test_touching_chips_are_not_grouped():
+    manifest = pd.DataFrame([chip(500000), chip(500000 + EXTENT), chip(500000, bottom=4000000 + EXTENT),
+                             chip(500000 + EXTENT, bottom=4000000 + EXTENT)])
+    components, pairs = overlap_components(chip_footprints(manifest))
+    assert len(set(components)) == 4
+    assert pairs.empty
+    assert len(deduplicate_chips(manifest)) == 4
+
+
+def test_overlapping_chips_are_grouped_with_utm_iou():
+    manifest = pd.DataFrame([chip(500000), chip(500000 + 8000), chip(500000 + 8000, date="2021-08-02")])
+    components, pairs = overlap_components(chip_footprints(manifest))
+    assert components[0] == components[1] != components[2]
+    # 24km of overlap out of 40km, exactly as the chips are rectangles in their UTM zone
+    assert pairs[["i", "j"]].values.tolist() == [[0, 1]]
+    assert pairs["iou"].iloc[0] == pytest.approx(24 / 40, abs=1e-9)
+
+    components, pairs = overlap_components(chip_footprints(manifest), min_iou=0.7)
+    assert len(set(components)) == 3
+
+
+@pytest.mark.parametrize("policy, kept", [("largest_cluster", 2), ("max_iou", 1), ("first", 0)])
+def test_policies(policy, kept):
+    # a chain of chips, each overlapping the next by 24km, and a chip on another date
+    manifest = pd.DataFrame([
+        chip(500000, n_points=5),
+        chip(500000 + 8000, n_points=1),
+        chip(500000 + 16000, n_points=9),
+        chip(500000, date="2021-08-02", n_points=1),
+    ])
+    deduplicated = deduplicate_chips(manifest, policy=policy)
+    assert deduplicated.index.tolist() == [kept, 3]
+
+
+def test_largest_cluster_needs_n_points():
+    with pytest.raises(ValueError):
+        deduplicate_chips(pd.DataFrame([chip(500000)]).drop(columns="n_points"))
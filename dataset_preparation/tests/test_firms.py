@@ -0,0 +1,86 @@
+from datetime import datetime
+
+import geopandas as gpd
+import pytest
+
+from src.firms import NRT_PRODUCT, SP_PRODUCT, STORE_LAYER, FirmsClient, ingest_fires, read_state
+from src.firms_stub import StubFirms
+
+BBOX = [-121.0, 38.0, -120.0, 39.0]
+REGION = ",".join(str(i) for i in BBOX)
+
+
+def fire(acq_date, acq_time, longitude=-120.5, latitude=38.5):
+    return {"latitude": latitude, "longitude": longitude, "acq_date": acq_date, "acq_time": acq_time, "frp": 10.0}
+
+
+def client(stub, **kwargs):
+    return FirmsClient(api_key="test", base_url=stub.url, backoff=0, **kwargs)
+
+
+def test_fetch_splits_windows_by_product():
+    fires = [fire(f"2021-08-{day:02d}", "1030") for day in range(1, 26)] + [fire("2021-08-12", "1030", longitude=0)]
+    with StubFirms(fires, nrt_start="2021-08-15") as stub:
+        df_fires = client(stub).fetch(datetime(2021, 8, 1), datetime(2021, 8, 25), BBOX, day_range=10)
+        area_requests = stub.area_requests()
+
+    assert sorted((product, date) for product, _, _, date in area_requests) == [
+        (SP_PRODUCT, "2021-08-10"),
+        (SP_PRODUCT, "2021-08-20"),
+        (NRT_PRODUCT, "2021-08-20"),
+        (NRT_PRODUCT, "2021-08-30"),
+    ]
+    assert all(bbox == REGION and day_range == "10" for _, bbox, day_range, _ in area_requests)
+    # every fire in the bbox and date range once, from the product covering its date
+    assert len(df_fires) == 25
+    assert set(df_fires.loc[df_fires["acq_date"] < "2021-08-15", "product"]) == {SP_PRODUCT}
+    assert set(df_fires.loc[df_fires["acq_date"] >= "2021-08-15", "product"]) == {NRT_PRODUCT}
+
+
+def test_fetch_reads_complete_windows_from_cache(tmp_path):
+    fires = [fire("2021-08-03", "1030"), fire("2021-08-13", "0130")]
+    with StubFirms(fires) as stub:
+        firms = client(stub, cache_dir=tmp_path)
+        first = firms.fetch(datetime(2021, 8, 1), datetime(2021, 8, 20), BBOX)
+        n_area_requests = len(stub.area_requests())
+        second = firms.fetch(datetime(2021, 8, 1), datetime(2021, 8, 20), BBOX)
+
+        assert n_area_requests == 2
+        assert len(stub.area_requests()) == n_area_requests
+        assert second.equals(first)
+
+        # a different bbox is a different cache entry
+        firms.fetch(datetime(2021, 8, 1), datetime(2021, 8, 20), [-122.0, 38.0, -120.0, 39.0])
+        assert len(stub.area_requests()) == 2 * n_area_requests
+
+
+@pytest.mark.parametrize("stub_kwargs", [{"fail_first": 2}, {"delay_first": 2.0}])
+def test_requests_are_retried(stub_kwargs):
+    with StubFirms([fire("2021-08-03", "1030")], **stub_kwargs) as stub:
+        df_fires = client(stub, timeout=0.5).fetch(datetime(2021, 8, 1), datetime(2021, 8, 5), BBOX)
+    assert len(df_fires) == 1
+
+
+def test_ingest_fires_only_appends_new_acquisitions(tmp_path):
+    store_path = str(tmp_path / "fires.gpkg")
+    state_path = str(tmp_path / "state.json")
+    fires = [fire("2021-08-01", "0930"), fire("2021-08-03", "2145"), fire("2021-08-05", "1330")]
+    with StubFirms(fires) as stub:
+        firms = client(stub)
+        first = ingest_fires(store_path, state_path, BBOX, datetime(2021, 8, 1), datetime(2021, 8, 5), client=firms)
+        assert len(first) == 3
+        assert read_state(state_path) == {f"{NRT_PRODUCT}/{REGION}": "2021-08-05T13:30:00"}
+
+        # nothing new since the high-water mark
+        again = ingest_fires(store_path, state_path, BBOX, datetime(2021, 8, 1), datetime(2021, 8, 5), client=firms)
+        assert again.empty
+        # the window of the second run starts on the day of the mark
+        assert stub.area_requests()[1][3] == "2021-08-14"
+
+        # a later acquisition on the day of the mark and one on the next day
+        stub.fires += [fire("2021-08-05", "2200"), fire("2021-08-06", "0100")]
+        third = ingest_fires(store_path, state_path, BBOX, datetime(2021, 8, 1), datetime(2021, 8, 6), client=firms)
+        assert sorted(third["acq_time"].astype(int)) == [100, 2200]
+        assert read_state(state_path) == {f"{NRT_PRODUCT}/{REGION}": "2021-08-06T01:00:00"}
+
+    assert len(gpd.read_file(store_path, layer=STORE_LAYER)) == 5
@@ -0,0 +1,82 @@
+import geopandas as gpd
+import pandas as pd
+import pytest
+from shapely.geometry import Point
+
+from src.incremental import CHIP_EXTENT, SNAP_GRID, MANIFEST_COLUMNS, diff_manifest, snap_chip_bounds
+
+EPSG = 32610
+LEFT, TOP = 504000, 4032000  # on the snap grid
+
+
+def chip(idx, left, top, date="2021-08-01", n_points=25):
+    return {"idx": idx, "left": left, "bottom": top - CHIP_EXTENT, "right": left + CHIP_EXTENT, "top": top,
+            "epsg": EPSG, "date": date, "n_points": n_points}
+
+
+def clustered_fires(points):
+    """Fire points given as (label, x, y) in the chip CRS, in EPSG:4326 as from cluster_fires"""
+    return gpd.GeoDataFrame(
+        {"label": [label for label, _, _ in points]},
+        geometry=[Point(x, y) for _, x, y in points],
+        crs=EPSG,
+    ).to_crs(4326)
+
+
+@pytest.mark.parametrize("drift", range(-3500, 3501, 500))
+def test_snapping_is_stable_under_centroid_drift(drift):
+    first = snap_chip_bounds(pd.DataFrame([chip(0, LEFT, TOP)]))
+    drifted = snap_chip_bounds(pd.DataFrame([chip(0, LEFT + drift, TOP - drift, date="2021-08-02")]))
+    assert drifted["location"].iloc[0] == first["location"].iloc[0]
+    assert drifted["left"].iloc[0] == LEFT and drifted["top"].iloc[0] == TOP
+
+
+def test_snapping_moves_chips_less_than_half_a_grid_step():
+    snapped = snap_chip_bounds(pd.DataFrame([chip(0, LEFT + SNAP_GRID / 2 + 500, TOP)]))
+    assert snapped["left"].iloc[0] == LEFT + SNAP_GRID
+    assert snapped["right"].iloc[0] - snapped["left"].iloc[0] == CHIP_EXTENT
+
+
+def test_snapping_keeps_fires_inside_chips():
+    # the nearest grid corner would move the chip 3km right, past a fire 1km inside its left edge
+    left = LEFT - 3000
+    fires = clustered_fires([(0, left + 1000, TOP - 16000), (0, left + 16000, TOP - 16000)])
+    manifest = pd.DataFrame([chip(0, left, TOP)])
+    assert snap_chip_bounds(manifest)["left"].iloc[0] == LEFT
+
+    snapped = snap_chip_bounds(manifest, clustered_fires=fires).iloc[0]
+    assert snapped["left"] == LEFT - SNAP_GRID
+    assert snapped["left"] <= left + 1000 <= snapped["right"]
+
+
+def test_snapping_falls_back_to_the_chip_bounds():
+    # fires on both edges of the chip, no grid corner keeps them all
+    left = LEFT - 3000
+    fires = clustered_fires([(0, left + 100, TOP - 16000), (0, left + CHIP_EXTENT - 100, TOP - 16000)])
+    snapped = snap_chip_bounds(pd.DataFrame([chip(0, left, TOP)]), clustered_fires=fires).iloc[0]
+    assert (snapped["left"], snapped["top"]) == (left, TOP)
+
+
+def test_diff_manifest_statuses():
+    previous = snap_chip_bounds(pd.DataFrame([
+        chip(0, LEFT, TOP, n_points=30),
+        chip(1, LEFT + CHIP_EXTENT, TOP, n_points=40),
+    ]))
+    previous["idx"] = [3, 7]
+    manifest = snap_chip_bounds(pd.DataFrame([
+        chip(0, LEFT + 1000, TOP, n_points=30),  # same location, date and points
+        chip(1, LEFT + CHIP_EXTENT, TOP, n_points=55),  # the cluster grew
+        chip(2, LEFT, TOP, date="2021-08-02"),  # a new date
+    ]))
+
+    diffed = diff_manifest(manifest, previous[MANIFEST_COLUMNS])
+    assert diffed["status"].tolist() == ["unchanged", "changed", "new"]
+    # unchanged chips keep their idx, the others get new ones after the previous runs
+    assert diffed["idx"].tolist() == [3, 9, 10]
+
+
+def test_diff_manifest_first_run():
+    manifest = snap_chip_bounds(pd.DataFrame([chip(0, LEFT, TOP), chip(1, LEFT, TOP, date="2021-08-02")]))
+    diffed = diff_manifest(manifest, pd.DataFrame(columns=MANIFEST_COLUMNS))
+    assert diffed["status"].tolist() == ["new", "new"]
+    assert diffed["idx"].tolist() == [0, 1]
@@ -0,0 +1,50 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from src import pipeline
+from src.pipeline import PredictionPipeline
+
+FEATURES = ["elevation", "landcover"]
+DATA_STATS = {"elevation": (0.0, 100.0, 50.0, 10.0)}
+
+
+class LoaderCrashed(BaseException):
+    """Not an Exception, so it is not caught per chip and ends the loading thread"""
+
+
+def model(inputs, training=False):
+    return inputs[..., :1]
+
+
+def manifest(n_chips):
+    return pd.DataFrame({"idx": range(n_chips)})
+
+
+def run(monkeypatch, n_chips, chip_layers):
+    monkeypatch.setattr(pipeline, "chip_layers", chip_layers)
+    prediction = PredictionPipeline(
+        model, FEATURES, DATA_STATS, features_not_norm=["landcover"], batch_size=4, workers=2
+    )
+    return prediction, list(prediction.run(fires=None, manifest=manifest(n_chips)))
+
+
+def test_run_predicts_every_chip(monkeypatch):
+    def chip_layers(chip, features, fires, cog_footprints, layer_cache):
+        if chip["idx"] == 3:
+            raise ValueError("missing source data")
+        return {"elevation": np.full((8, 8), 50.0), "landcover": np.zeros((8, 8))}
+
+    prediction, results = run(monkeypatch, 10, chip_layers)
+    assert sorted(chip["idx"] for chip, _ in results) == [0, 1, 2, 4, 5, 6, 7, 8, 9]
+    assert all(np.allclose(probabilities, 0.5) for _, probabilities in results)
+    assert list(prediction.errors) == [3]
+
+
+def test_run_reraises_thread_failures(monkeypatch):
+    def chip_layers(chip, features, fires, cog_footprints, layer_cache):
+        raise LoaderCrashed()
+
+    # without a timeout on the ready queue, run would wait forever for the crashed threads
+    with pytest.raises(LoaderCrashed):
+        run(monkeypatch, 10, chip_layers)
@@ -0,0 +1,32 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+from src import cli
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_cli_import_loads_no_heavy_modules():
+    assert cli.heavy_modules_loaded() == []
+
+
+def test_cli_import_time():
+    # the CLI only imports the standard library, a slow import means a heavy module crept in
+    assert cli._import_seconds([]) < 1.0
+
+
+def test_help_lists_commands():
+    result = subprocess.run(
+        [sys.executable, "-m", "src.cli", "--help"], capture_output=True, text=True, check=True, cwd=ROOT
+    )
+    assert all(command in result.stdout for command in ["build-manifest", "process-chips", "compute-stats"])
+
+
+@pytest.mark.parametrize("command", sorted(cli.COMMAND_MODULES))
+def test_command_imports_no_unexpected_heavy_modules(command):
+    for module in cli.COMMAND_MODULES[command]:
+        pytest.importorskip(module)
+    assert cli.unexpected_heavy_modules(command) == []
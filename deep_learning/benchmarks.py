@@ -0,0 +1,526 @@
+# Benchmarks for the training input pipeline and the model architectures
+
+import argparse
+import json
+import os
+import tempfile
+import time
+from typing import Dict, List, Optional, Text
+
+import numpy as np
+import tensorflow as tf
+
+from config import dataset_config, training_config, model_config
+from datagen import (batch_examples, get_dataset, get_indexed_dataset, normalize_example, parse_example,
+                     read_records)
+from metrics import dice_coef, get_loss_function
+from models import get_model
+from records import RecordIndex, write_arrays
+
+
+class EpochTimer(tf.keras.callbacks.Callback):
+    """Records the wall clock time at the end of each epoch."""
+
+    def on_train_begin(self, logs=None):
+        self.start = time.perf_counter()
+        self.times = []
+
+    def on_epoch_end(self, epoch, logs=None):
+        self.times.append(time.perf_counter() - self.start)
+
+
+def _train_dataset(train_pattern: Text, sampling: Text, steps_per_epoch: int, seed: int) -> tf.data.Dataset:
+    if sampling == "shuffle":
+        return get_dataset(
+            train_pattern,
+            data_size=model_config["IMG_SIZE"][0],
+            sample_size=model_config["IMG_SIZE"][0],
+            batch_size=training_config["BATCH_SIZE"],
+            num_in_channels=len(dataset_config["INPUT_FEATURES"]),
+            compression_type=None,
+            clip_and_normalize=False,
+            clip_and_rescale=True,
+            random_crop=False,
+            center_crop=False,
+            shuffle=True)
+    return get_indexed_dataset(
+        train_pattern,
+        batch_size=training_config["BATCH_SIZE"],
+        sampling=sampling,
+        num_samples=steps_per_epoch * training_config["BATCH_SIZE"],
+        seed=seed)
+
+
+def _eval_dataset(dataset_pattern: Text) -> tf.data.Dataset:
+    return get_dataset(
+        dataset_pattern,
+        data_size=model_config["IMG_SIZE"][0],
+        sample_size=model_config["IMG_SIZE"][0],
+        batch_size=training_config["BATCH_SIZE"],
+        num_in_channels=len(dataset_config["INPUT_FEATURES"]),
+        compression_type=None,
+        clip_and_normalize=False,
+        clip_and_rescale=True,
+        random_crop=False,
+        center_crop=False,
+        shuffle=False)
+
+
+def compare_sampling(train_pattern: Text, eval_pattern: Text,
+                     samplings: List[Text] = ("shuffle", "fire_weighted", "stratified"),
+                     epochs: int = 20, target_dice: float = 0.3,
+                     model_name: Optional[Text] = None, seed: int = 2048) -> List[Dict]:
+    """Compares convergence of the shuffled dataset against indexed samplers.
+
+    Every sampler trains the same architecture from the same initial weights
+    for the same number of batches per epoch (one pass over the records), and
+    is evaluated on the unchanged validation set after each epoch.
+
+    Args:
+    train_pattern: Training file pattern, with sidecar indexes for the indexed samplers.
+    eval_pattern: Validation file pattern.
+    samplings: "shuffle" for `get_dataset`, otherwise a sampling of `get_indexed_dataset`.
+    epochs: Number of epochs to train each sampler for.
+    target_dice: Validation dice coefficient counted as converged.
+    model_name: Architecture, defaults to model_config["MODEL_NAME"].
+    seed: Random seed for the weights and the samplers.
+
+    Returns:
+    One result per sampler, with the epochs and seconds taken to reach
+    `target_dice` (None if never reached) and the best validation dice.
+    """
+    model_name = model_name or model_config["MODEL_NAME"]
+    steps_per_epoch = -(-len(RecordIndex(train_pattern)) // training_config["BATCH_SIZE"])
+    eval_dataset = _eval_dataset(eval_pattern)
+
+    results = []
+    for sampling in samplings:
+        tf.keras.utils.set_random_seed(seed)
+        model = get_model(model_name)
+        model.compile(
+            optimizer=tf.keras.optimizers.Adam(learning_rate=training_config["INITIAL_LEARNING_RATE"]),
+            loss=get_loss_function(training_config["LOSS_FUNCTION_NAME"]),
+            metrics=[dice_coef])
+        timer = EpochTimer()
+        history = model.fit(
+            _train_dataset(train_pattern, sampling, steps_per_epoch, seed),
+            validation_data=eval_dataset,
+            epochs=epochs,
+            callbacks=[timer],
+            verbose=0)
+        val_dice = history.history["val_dice_coef"]
+        converged = [epoch for epoch, dice in enumerate(val_dice) if dice >= target_dice]
+        results.append({
+            "sampling": sampling,
+            "model": model_name,
+            "epochs_to_target": converged[0] + 1 if converged else None,
+            "seconds_to_target": timer.times[converged[0]] if converged else None,
+            "best_val_dice": max(val_dice),
+            "seconds_per_epoch": timer.times[-1] / len(timer.times),
+            "val_dice": val_dice,
+        })
+    return results
+
+
+def write_synthetic_records(output_dir: Text, num_files: int = 4, records_per_file: int = 512,
+                            seed: int = 2048) -> Text:
+    """Writes synthetic chips in the current TFRecords format, with sidecar indexes.
+
+    Values roughly follow the `DATA_STATS` of each feature, with sparse fires.
+
+    Args:
+    output_dir: Directory to write the files to.
+    num_files: Number of TFRecords files.
+    records_per_file: Number of chips per file.
+    seed: Random seed.
+
+    Returns:
+    The file pattern of the written records.
+    """
+    rng = np.random.default_rng(seed)
+    shape = model_config["IMG_SIZE"]
+    features = dataset_config["INPUT_FEATURES"] + dataset_config["OUTPUT_FEATURES"]
+
+    def sample(sample_id):
+        arrays = {}
+        for feature in features:
+            min_val, max_val, mean, std = dataset_config["DATA_STATS"].get(feature, (0., 1., 0.5, 0.5))
+            if feature.endswith("fires"):
+                arrays[feature] = (rng.random(shape) < 0.02).astype(np.float32)
+            elif feature.endswith("frp"):
+                arrays[feature] = np.where(rng.random(shape) < 0.02, rng.gamma(1.0, 10.0, shape), 0.0)
+            else:
+                arrays[feature] = rng.normal(mean, std, shape)
+        return str(sample_id), arrays
+
+    os.makedirs(output_dir, exist_ok=True)
+    for file_id in range(num_files):
+        write_arrays((sample(file_id * records_per_file + i) for i in range(records_per_file)),
+                     os.path.join(output_dir, "synthetic_{:03d}_train.tfrecords".format(file_id)))
+    return os.path.join(output_dir, "*_train.tfrecords")
+
+
+def _stage_datasets(dataset_pattern: Text, batch_size: int) -> Dict[Text, tf.data.Dataset]:
+    """Prefixes of the `get_dataset` pipeline built from its stage functions, each ending after one more stage."""
+    features = dataset_config["INPUT_FEATURES"] + dataset_config["OUTPUT_FEATURES"]
+    read = read_records(dataset_pattern, compression_type=None)
+    parse = read.map(lambda x: parse_example(x, features), num_parallel_calls=tf.data.experimental.AUTOTUNE)
+    normalize = parse.map(normalize_example, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+    batch = batch_examples(normalize, batch_size, shuffle=True).prefetch(buffer_size=tf.data.experimental.AUTOTUNE)
+    return {"read": read, "parse": parse, "normalize": normalize, "batch": batch}
+
+
+def _examples_per_second(dataset: tf.data.Dataset, batched: bool, warmup: int = 10) -> float:
+    """Iterates over a whole dataset and measures its throughput after a few warmup elements."""
+    examples, start = 0, None
+    for i, element in enumerate(dataset):
+        if i == warmup:
+            examples, start = 0, time.perf_counter()
+        examples += int(tf.shape(tf.nest.flatten(element)[0])[0]) if batched else 1
+    if start is None:
+        raise ValueError("Not enough records to measure throughput, write more synthetic records")
+    return examples / (time.perf_counter() - start)
+
+
+def _model_examples_per_second(model_name: Text, batch_size: int, steps: int = 20, warmup: int = 3) -> float:
+    """Measures the training step time of a model on a batch held in memory."""
+    model = get_model(model_name)
+    model.compile(
+        optimizer=tf.keras.optimizers.Adam(learning_rate=training_config["INITIAL_LEARNING_RATE"]),
+        loss=get_loss_function(training_config["LOSS_FUNCTION_NAME"]),
+        metrics=[dice_coef])
+    size = model_config["IMG_SIZE"]
+    inputs = tf.random.uniform([batch_size, size[0], size[1], len(dataset_config["INPUT_FEATURES"])])
+    targets = tf.cast(tf.random.uniform([batch_size, size[0], size[1], 1]) < 0.02, tf.float32)
+    for _ in range(warmup):
+        model.train_on_batch(inputs, targets)
+    start = time.perf_counter()
+    for _ in range(steps):
+        model.train_on_batch(inputs, targets)
+    return steps * batch_size / (time.perf_counter() - start)
+
+
+def profile_input_pipeline(dataset_pattern: Optional[Text] = None, num_files: int = 4,
+                           records_per_file: int = 512,
+                           model_names: List[Text] = ("resunet", "satunet", "mobileunet"),
+                           batch_size: Optional[int] = None, model_steps: int = 20) -> Dict:
+    """Measures whether training on `get_dataset` is input-bound or compute-bound.
+
+    The throughput of each prefix of the input pipeline (read, parse,
+    normalize, batch) and of the complete `get_dataset` is compared with the
+    training throughput of each model on batches already in memory.
+
+    Args:
+    dataset_pattern: Records to read, synthetic records are written to a
+      temporary directory if None.
+    num_files: Number of synthetic files.
+    records_per_file: Number of synthetic chips per file.
+    model_names: Architectures to time.
+    batch_size: Batch size, defaults to training_config["BATCH_SIZE"].
+    model_steps: Number of training steps timed per model.
+
+    Returns:
+    Throughput in examples per second of each pipeline stage and model, the
+    seconds per example added by each stage, and for each model whether the
+    input pipeline or the model step is the bottleneck.
+    """
+    batch_size = batch_size or training_config["BATCH_SIZE"]
+    synthetic = dataset_pattern is None
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        if synthetic:
+            dataset_pattern = write_synthetic_records(tmp_dir, num_files, records_per_file)
+        stages = {name: _examples_per_second(dataset, batched=name == "batch")
+                  for name, dataset in _stage_datasets(dataset_pattern, batch_size).items()}
+        stages["get_dataset"] = _examples_per_second(get_dataset(
+            dataset_pattern,
+            data_size=model_config["IMG_SIZE"][0],
+            sample_size=model_config["IMG_SIZE"][0],
+            batch_size=batch_size,
+            num_in_channels=len(dataset_config["INPUT_FEATURES"]),
+            compression_type=None,
+            clip_and_normalize=False,
+            clip_and_rescale=True,
+            random_crop=False,
+            center_crop=False,
+            shuffle=True), batched=True)
+
+    # each prefix includes the stages before it, so the cost of a stage is the difference in time per example
+    stage_cost, previous = {}, 0.0
+    for name in ("read", "parse", "normalize", "batch"):
+        stage_cost[name] = max(1.0 / stages[name] - previous, 0.0)
+        previous = 1.0 / stages[name]
+    bottleneck_stage = max(stage_cost, key=stage_cost.get)
+
+    models = {}
+    for model_name in model_names:
+        model_throughput = _model_examples_per_second(model_name, batch_size, steps=model_steps)
+        models[model_name] = {
+            "examples_per_sec": model_throughput,
+            "bound": "input" if stages["get_dataset"] < model_throughput else "compute",
+            "input_to_model_ratio": stages["get_dataset"] / model_throughput,
+        }
+    return {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "tensorflow": tf.__version__,
+        "batch_size": batch_size,
+        "dataset": "synthetic" if synthetic else dataset_pattern,
+        "num_records": num_files * records_per_file if synthetic else None,
+        "stages_examples_per_sec": stages,
+        "stage_seconds_per_example": stage_cost,
+        "slowest_stage": bottleneck_stage,
+        "models": models,
+    }
+
+def compare_augmentation(dataset_pattern: Optional[Text] = None, num_files: int = 4, records_per_file: int = 512,
+                         batch_size: Optional[int] = None, crop_size: Optional[int] = None,
+                         class_weights: List[float] = (1., 10.)) -> Dict:
+    """Measures the throughput of `get_dataset` with and without batch level augmentation.
+
+    Args:
+    dataset_pattern: Records to read, synthetic records are written to a
+      temporary directory if None.
+    num_files: Number of synthetic files.
+    records_per_file: Number of synthetic chips per file.
+    batch_size: Batch size, defaults to training_config["BATCH_SIZE"].
+    crop_size: Side length of the random crops, defaults to three quarters of
+      the tiles.
+    class_weights: Weights of the no-fire and fire classes for the sample
+      weights stage.
+
+    Returns:
+    Examples per second of each variant of `get_dataset`, and their ratio to
+    the throughput without augmentation.
+    """
+    batch_size = batch_size or training_config["BATCH_SIZE"]
+    data_size = model_config["IMG_SIZE"][0]
+    crop_size = crop_size or data_size * 3 // 4
+    variants = {
+        "none": {},
+        "random_crop": {"random_crop": True, "sample_size": crop_size},
+        "flip_rotate": {"augment": True},
+        "flip_rotate_random_crop": {"augment": True, "random_crop": True, "sample_size": crop_size},
+        "flip_rotate_sample_weights": {"augment": True, "class_weights": list(class_weights)},
+    }
+    synthetic = dataset_pattern is None
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        if synthetic:
+            dataset_pattern = write_synthetic_records(tmp_dir, num_files, records_per_file)
+        throughput = {}
+        for name, options in variants.items():
+            kwargs = dict(
+                data_size=data_size,
+                sample_size=data_size,
+                batch_size=batch_size,
+                num_in_channels=len(dataset_config["INPUT_FEATURES"]),
+                compression_type=None,
+                clip_and_normalize=False,
+                clip_and_rescale=True,
+                random_crop=False,
+                center_crop=False,
+                shuffle=True)
+            kwargs.update(options)
+            throughput[name] = _examples_per_second(get_dataset(dataset_pattern, **kwargs), batched=True)
+    return {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "tensorflow": tf.__version__,
+        "batch_size": batch_size,
+        "crop_size": crop_size,
+        "dataset": "synthetic" if synthetic else dataset_pattern,
+        "examples_per_sec": throughput,
+        "relative_to_none": {name: value / throughput["none"] for name, value in throughput.items()},
+    }
+
+
+def _flops(model: tf.keras.Model) -> int:
+    """Counts the floating point operations of one forward pass on a single chip."""
+    from tensorflow.python.framework.convert_to_constants import convert_variables_to_constants_v2
+
+    spec = tf.TensorSpec([1] + list(model.input_shape[1:]), tf.float32)
+    graph = convert_variables_to_constants_v2(
+        tf.function(lambda x: model(x, training=False)).get_concrete_function(spec)).graph
+    options = tf.compat.v1.profiler.ProfileOptionBuilder.float_operation()
+    options["output"] = "none"
+    profile = tf.compat.v1.profiler.profile(graph=graph, run_meta=tf.compat.v1.RunMetadata(), cmd="op",
+                                            options=options)
+    return profile.total_float_ops
+
+
+def _cpu_latency(model: tf.keras.Model, batch_size: int, runs: int = 50, warmup: int = 5) -> Dict:
+    """Measures the median CPU inference time of a batch."""
+    inputs = tf.random.uniform([batch_size] + list(model.input_shape[1:]))
+    with tf.device("/CPU:0"):
+        predict = tf.function(lambda x: model(x, training=False))
+        for _ in range(warmup):
+            predict(inputs).numpy()
+        times = []
+        for _ in range(runs):
+            start = time.perf_counter()
+            predict(inputs).numpy()
+            times.append(time.perf_counter() - start)
+    seconds = float(np.median(times))
+    return {"batch_ms": 1000 * seconds, "chips_per_sec": batch_size / seconds}
+
+
+def _test_scores(model: tf.keras.Model, dataset: tf.data.Dataset, threshold: float = 0.5) -> Dict:
+    """Dice coefficient and F1 score of next day fires over a whole dataset."""
+    intersection = total = tp = fp = fn = 0.
+    for inputs, labels in dataset:
+        probabilities = model(inputs, training=False)
+        predictions = tf.cast(probabilities >= threshold, tf.float32)
+        intersection += float(tf.reduce_sum(labels * probabilities))
+        total += float(tf.reduce_sum(labels) + tf.reduce_sum(probabilities))
+        tp += float(tf.reduce_sum(predictions * labels))
+        fp += float(tf.reduce_sum(predictions * (1 - labels)))
+        fn += float(tf.reduce_sum((1 - predictions) * labels))
+    return {
+        # smoothed as metrics.dice_coef, but over the whole dataset rather than averaged over batches
+        "dice": (2. * intersection + 1.) / (total + 1.),
+        "f1": 2 * tp / (2 * tp + fp + fn) if tp + fp + fn else 0.,
+    }
+
+
+def _pareto_optimal(results: List[Dict], cost: Text, score: Text) -> List[bool]:
+    """Whether each result is not dominated by another with lower or equal cost and higher or equal score."""
+    optimal = []
+    for result in results:
+        dominated = any(
+            other[cost] <= result[cost] and other[score] >= result[score]
+            and (other[cost] < result[cost] or other[score] > result[score])
+            for other in results)
+        optimal.append(not dominated)
+    return optimal
+
+
+def compare_models(test_pattern: Optional[Text] = None,
+                   model_names: List[Text] = ("resunet", "satunet", "mobileunet"),
+                   width_multipliers: List[float] = (1.0, 0.5),
+                   weights: Optional[Dict[Text, Text]] = None,
+                   train_pattern: Optional[Text] = None, eval_pattern: Optional[Text] = None,
+                   epochs: int = 20, batch_sizes: List[int] = (1, 64),
+                   latency_runs: int = 50, seed: int = 2048) -> List[Dict]:
+    """Compares the size, cost, CPU latency and test scores of the architectures.
+
+    Every mobileunet width multiplier is compared as a separate model. Test
+    scores are measured with the given weights, or after training every model
+    from scratch with the same seed when a training pattern is given.
+
+    Args:
+    test_pattern: Test file pattern, test scores are skipped if None.
+    model_names: Architectures to compare.
+    width_multipliers: Width multipliers of mobileunet.
+    weights: Weights (.h5) to load, keyed by the name of the result, e.g.
+      "resunet" or "mobileunet@0.5".
+    train_pattern: Training file pattern, for models without weights.
+    eval_pattern: Validation file pattern used while training.
+    epochs: Number of epochs to train models without weights for.
+    batch_sizes: Batch sizes the CPU latency is measured at.
+    latency_runs: Number of timed forward passes per batch size.
+    seed: Random seed for the weights.
+
+    Returns:
+    One result per model, with the parameter count, FLOPs per chip, CPU
+    latency per batch size, test dice and F1, and whether the model is
+    Pareto-optimal for CPU latency against test dice.
+    """
+    weights = weights or {}
+    specs = []
+    for model_name in model_names:
+        if model_name == "mobileunet":
+            specs += [("mobileunet@{}".format(width), model_name, width) for width in width_multipliers]
+        else:
+            specs.append((model_name, model_name, None))
+
+    results = []
+    for name, model_name, width_multiplier in specs:
+        tf.keras.utils.set_random_seed(seed)
+        model = get_model(model_name, width_multiplier=width_multiplier)
+        result = {
+            "model": name,
+            "params": model.count_params(),
+            "flops_per_chip": _flops(model),
+            "cpu_latency": {str(batch_size): _cpu_latency(model, batch_size, runs=latency_runs)
+                            for batch_size in batch_sizes},
+            "dice": None,
+            "f1": None,
+            "pareto_optimal": None,
+            "weights": weights.get(name),
+        }
+        if test_pattern and (name in weights or train_pattern):
+            if name in weights:
+                model.load_weights(weights[name])
+            else:
+                model.compile(
+                    optimizer=tf.keras.optimizers.Adam(learning_rate=training_config["INITIAL_LEARNING_RATE"]),
+                    loss=get_loss_function(training_config["LOSS_FUNCTION_NAME"]),
+                    metrics=[dice_coef])
+                model.fit(_train_dataset(train_pattern, "shuffle", None, seed),
+                          validation_data=_eval_dataset(eval_pattern) if eval_pattern else None,
+                          epochs=epochs, verbose=0)
+            result.update(_test_scores(model, _eval_dataset(test_pattern)))
+        results.append(result)
+
+    latency_batch = str(batch_sizes[0])
+    scored = [r for r in results if r["dice"] is not None]
+    for result, optimal in zip(scored, _pareto_optimal(
+            [{"ms": r["cpu_latency"][latency_batch]["batch_ms"], "dice": r["dice"]} for r in scored], "ms", "dice")):
+        result["pareto_optimal"] = optimal
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks for the training input pipeline and the model architectures")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    sampling_parser = subparsers.add_parser("sampling", help="compare convergence of chip samplers")
+    sampling_parser.add_argument("--train-pattern", required=True)
+    sampling_parser.add_argument("--eval-pattern", required=True)
+    sampling_parser.add_argument("--epochs", type=int, default=20)
+    sampling_parser.add_argument("--target-dice", type=float, default=0.3)
+    sampling_parser.add_argument("--output", help="write the results as JSON to this path")
+
+    input_parser = subparsers.add_parser("input", help="find whether training is input-bound or compute-bound")
+    input_parser.add_argument("--pattern", help="records to read, synthetic records are written if not set")
+    input_parser.add_argument("--num-files", type=int, default=4)
+    input_parser.add_argument("--records-per-file", type=int, default=512)
+    input_parser.add_argument("--models", nargs="+", default=["resunet", "satunet", "mobileunet"])
+    input_parser.add_argument("--model-steps", type=int, default=20)
+    input_parser.add_argument("--output", help="write the results as JSON to this path")
+
+    augmentation_parser = subparsers.add_parser(
+        "augmentation", help="compare input throughput with and without augmentation")
+    augmentation_parser.add_argument("--pattern", help="records to read, synthetic records are written if not set")
+    augmentation_parser.add_argument("--num-files", type=int, default=4)
+    augmentation_parser.add_argument("--records-per-file", type=int, default=512)
+    augmentation_parser.add_argument("--crop-size", type=int)
+    augmentation_parser.add_argument("--output", help="write the results as JSON to this path")
+
+    models_parser = subparsers.add_parser("models", help="compare size, CPU latency and test scores of the models")
+    models_parser.add_argument("--test-pattern", help="records to score the models on")
+    models_parser.add_argument("--models", nargs="+", default=["resunet", "satunet", "mobileunet"])
+    models_parser.add_argument("--width-multipliers", nargs="+", type=float, default=[1.0, 0.5])
+    models_parser.add_argument("--weights", nargs="+", default=[], metavar="NAME=PATH",
+                               help="weights of a model, e.g. mobileunet@0.5=output/model/fire_model_x.h5")
+    models_parser.add_argument("--train-pattern", help="train models without weights on these records first")
+    models_parser.add_argument("--eval-pattern")
+    models_parser.add_argument("--epochs", type=int, default=20)
+    models_parser.add_argument("--batch-sizes", nargs="+", type=int, default=[1, 64])
+    models_parser.add_argument("--output", help="write the results as JSON to this path")
+
+    args = parser.parse_args()
+    if args.benchmark == "sampling":
+        results = compare_sampling(args.train_pattern, args.eval_pattern,
+                                   epochs=args.epochs, target_dice=args.target_dice)
+    elif args.benchmark == "input":
+        results = profile_input_pipeline(args.pattern, args.num_files, args.records_per_file,
+                                         model_names=args.models, model_steps=args.model_steps)
+    elif args.benchmark == "augmentation":
+        results = compare_augmentation(args.pattern, args.num_files, args.records_per_file,
+                                       crop_size=args.crop_size)
+    elif args.benchmark == "models":
+        results = compare_models(args.test_pattern, args.models, args.width_multipliers,
+                                 dict(weight.split("=", 1) for weight in args.weights),
+                                 args.train_pattern, args.eval_pattern, args.epochs, args.batch_sizes)
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
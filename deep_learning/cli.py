@@ -0,0 +1,117 @@
+# Command line entry points for training data conversion and prediction
+# TensorFlow is only imported by the commands that use it, so the CLI starts without paying for it.
+
+import argparse
+import glob
+import json
+import os
+import subprocess
+import sys
+import time
+from typing import List, Text
+
+# Modules each command imports when it runs, timed by the startup-time command.
+COMMAND_MODULES = {
+    "convert-records": ["records"],
+    "predict": ["datagen", "models"],
+}
+# Modules that must not be loaded by importing the CLI itself.
+HEAVY_MODULES = ["tensorflow", "matplotlib", "PIL", "numpy"]
+
+
+def convert_records(args: argparse.Namespace) -> None:
+    """Writes sample directories of .npy files to TFRecords with a sidecar index."""
+    from records import write_records
+
+    sample_dirs = sorted(glob.glob(args.samples))
+    index = write_records(sample_dirs, args.output, features=args.features)
+    print("Wrote {} samples to {} with index {}".format(len(sample_dirs), args.output, index))
+
+
+def predict(args: argparse.Namespace) -> None:
+    """Predicts the fire probabilities of every record matching a pattern."""
+    import numpy as np
+
+    from config import dataset_config, model_config
+    from datagen import get_dataset
+    from models import get_model
+
+    model = get_model(args.model_name)
+    model.load_weights(args.weights)
+
+    dataset = get_dataset(
+        args.pattern,
+        data_size=model_config["IMG_SIZE"][0],
+        sample_size=model_config["IMG_SIZE"][0],
+        batch_size=args.batch_size,
+        num_in_channels=len(dataset_config["INPUT_FEATURES"]),
+        compression_type=None,
+        clip_and_normalize=False,
+        clip_and_rescale=True,
+        random_crop=False,
+        center_crop=False,
+        shuffle=False)
+    probabilities = model.predict(dataset.map(lambda inputs, _: inputs))
+    np.save(args.output, probabilities[..., 0])
+    print("Wrote probabilities of {} records to {}".format(len(probabilities), args.output))
+
+
+def _import_seconds(modules: List[Text]) -> float:
+    """Times a cold import of the CLI and modules in a fresh interpreter."""
+    code = ("import time; start = time.perf_counter(); import cli; "
+            + "".join("import {}; ".format(module) for module in modules)
+            + "print(time.perf_counter() - start)")
+    result = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True,
+                            cwd=os.path.dirname(os.path.abspath(__file__)))
+    return float(result.stdout.strip().splitlines()[-1])
+
+
+def startup_time(args: argparse.Namespace) -> None:
+    """Measures the cold start time of the CLI and of each command, failing if the CLI loads heavy modules."""
+    code = "import sys, cli; print(','.join(m for m in cli.HEAVY_MODULES if m in sys.modules))"
+    loaded = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True,
+                            cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    results = {
+        "cli_seconds": _import_seconds([]),
+        "commands_seconds": {command: _import_seconds(modules) for command, modules in COMMAND_MODULES.items()},
+        "heavy_modules_loaded_by_cli": [m for m in loaded.split(",") if m],
+    }
+    print(json.dumps(results, indent=2))
+    if results["heavy_modules_loaded_by_cli"] or (args.max_seconds and results["cli_seconds"] > args.max_seconds):
+        sys.exit(1)
+
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(description="Training data conversion and prediction commands")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    convert_parser = subparsers.add_parser("convert-records", help="write sample directories to TFRecords")
+    convert_parser.add_argument("--samples", required=True, help="glob of the sample directories")
+    convert_parser.add_argument("--output", required=True, help="path of the TFRecords file to write")
+    convert_parser.add_argument("--features", nargs="+", help="features to write, defaults to inputs and outputs")
+    convert_parser.set_defaults(func=convert_records)
+
+    predict_parser = subparsers.add_parser("predict", help="predict fire probabilities of TFRecords")
+    predict_parser.add_argument("--pattern", required=True, help="TFRecords file pattern")
+    predict_parser.add_argument("--weights", required=True, help="model weights (.h5)")
+    predict_parser.add_argument("--model-name", default=None, help="defaults to MODEL_NAME of config.py")
+    predict_parser.add_argument("--batch-size", type=int, default=64)
+    predict_parser.add_argument("--output", required=True, help="path of the .npy of probabilities to write")
+    predict_parser.set_defaults(func=predict)
+
+    startup_parser = subparsers.add_parser("startup-time", help="measure the cold start time of each command")
+    startup_parser.add_argument("--max-seconds", type=float, help="fail if importing the CLI takes longer")
+    startup_parser.set_defaults(func=startup_time)
+
+    args = parser.parse_args(argv)
+    if args.command == "predict" and args.model_name is None:
+        from config import model_config
+        args.model_name = model_config["MODEL_NAME"]
+    start = time.perf_counter()
+    args.func(args)
+    if args.command != "startup-time":
+        print("{} took {:.1f}s".format(args.command, time.perf_counter() - start))
+
+
+if __name__ == "__main__":
+    main()
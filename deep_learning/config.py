@@ -37,7 +37,9 @@ training_config = {
     "BATCH_SIZE": 64,
     "INITIAL_LEARNING_RATE": 0.0001,
     "OPTIMIZER_NAME": "adam",
-    "LOSS_FUNCTION_NAME": "dice_coef_loss"
+    "LOSS_FUNCTION_NAME": "dice_coef_loss",
+    "AUGMENT": False,
+    "CLASS_WEIGHTS": None
     }
 
 model_config = {
@@ -45,7 +47,8 @@ model_config = {
     "MODEL_NAME": "resunet",
     "TRAIN_FROM_PARENT_MODEL": False,
     "UNFREEZE_ALL_LAYERS": False,
-    "NB_LAYERS": 4
+    "NB_LAYERS": 4,
+    "WIDTH_MULTIPLIER": 1.0
     }
 
 test_config = {
@@ -4,12 +4,10 @@
 import re
 import numpy as np
 from typing import Dict, List, Optional, Text, Tuple
-from PIL import Image
-import matplotlib.pyplot as plt
-from matplotlib import colors
 import tensorflow as tf
 
 from config import dataset_config
+from records import RecordIndex, read_record
 
 def random_crop_input_and_output_images(
     input_img: tf.Tensor,
@@ -18,24 +16,33 @@ def random_crop_input_and_output_images(
     num_in_channels: int,
     num_out_channels: int,
 ) -> Tuple[tf.Tensor, tf.Tensor]:
-    """Randomly axis-align crop input and output image tensors.
+    """Randomly axis-align crop batches of input and output image tensors.
+
+    Each example of the batch is cropped at its own random offset, the input
+    and output of an example being cropped at the same offset.
 
     Args:
-    input_img: tensor with dimensions HWC.
-    output_img: tensor with dimensions HWC.
+    input_img: tensor with dimensions BHWC.
+    output_img: tensor with dimensions BHWC.
     sample_size: side length (square) to crop to.
     num_in_channels: number of channels in input_img.
     num_out_channels: number of channels in output_img.
     Returns:
-    input_img: tensor with dimensions HWC.
-    output_img: tensor with dimensions HWC.
+    input_img: tensor with dimensions BHWC.
+    output_img: tensor with dimensions BHWC.
     """
-    combined = tf.concat([input_img, output_img], axis=2)
-    combined = tf.image.random_crop(
-        combined,
-        [sample_size, sample_size, num_in_channels + num_out_channels])
-    input_img = combined[:, :, 0:num_in_channels]
-    output_img = combined[:, :, -num_out_channels:]
+    combined = tf.concat([input_img, output_img], axis=3)
+    batch_size = tf.shape(combined)[0]
+    max_offsets = tf.shape(combined)[1:3] - sample_size + 1
+    offsets = tf.cast(
+        tf.random.uniform([batch_size, 2]) * tf.cast(max_offsets, tf.float32), tf.int32)
+    # Gather the rows then the columns of each example's crop
+    rows = offsets[:, 0:1] + tf.range(sample_size)[tf.newaxis]
+    combined = tf.gather(combined, rows, axis=1, batch_dims=1)
+    cols = offsets[:, 1:2] + tf.range(sample_size)[tf.newaxis]
+    combined = tf.gather(combined, cols, axis=2, batch_dims=1)
+    input_img = combined[:, :, :, 0:num_in_channels]
+    output_img = combined[:, :, :, -num_out_channels:]
     return input_img, output_img
 
 def center_crop_input_and_output_images(
@@ -43,24 +50,49 @@ def center_crop_input_and_output_images(
     output_img: tf.Tensor,
     sample_size: int,
 ) -> Tuple[tf.Tensor, tf.Tensor]:
-    """Center crops input and output image tensors.
+    """Center crops batches of input and output image tensors.
 
     Args:
-    input_img: tensor with dimensions HWC.
-    output_img: tensor with dimensions HWC.
+    input_img: tensor with dimensions BHWC.
+    output_img: tensor with dimensions BHWC.
     sample_size: side length (square) to crop to.
     Returns:
-    input_img: tensor with dimensions HWC.
-    output_img: tensor with dimensions HWC.
+    input_img: tensor with dimensions BHWC.
+    output_img: tensor with dimensions BHWC.
     """
-    central_fraction = sample_size / input_img.shape[0]
-    input_img = tf.image.central_crop(input_img, central_fraction)
-    output_img = tf.image.central_crop(output_img, central_fraction)
+    offset = (input_img.shape[1] - sample_size) // 2
+    input_img = input_img[:, offset:offset + sample_size, offset:offset + sample_size, :]
+    output_img = output_img[:, offset:offset + sample_size, offset:offset + sample_size, :]
     return input_img, output_img
 
-data_augmentation = tf.keras.Sequential([
-  tf.keras.layers.RandomFlip("horizontal_and_vertical"),
-    ])
+def random_flip_and_rotate_input_and_output_images(
+    input_img: tf.Tensor,
+    output_img: tf.Tensor,
+) -> Tuple[tf.Tensor, tf.Tensor]:
+    """Randomly flips and rotates by multiples of 90 degrees batches of square images.
+
+    Each example is flipped left-right, flipped up-down and transposed with
+    probability 0.5, which draws each of the 8 flips and rotations of a square
+    equally often. The input and output of an example get the same transform.
+
+    Args:
+    input_img: tensor with dimensions BHWC.
+    output_img: tensor with dimensions BHWC.
+    Returns:
+    input_img: tensor with dimensions BHWC.
+    output_img: tensor with dimensions BHWC.
+    """
+    num_in_channels = input_img.shape[3]
+    combined = tf.concat([input_img, output_img], axis=3)
+    batch_size = tf.shape(combined)[0]
+
+    def apply_randomly(images, transformed):
+        return tf.where(tf.random.uniform([batch_size, 1, 1, 1]) < 0.5, transformed, images)
+
+    combined = apply_randomly(combined, tf.reverse(combined, axis=[2]))
+    combined = apply_randomly(combined, tf.reverse(combined, axis=[1]))
+    combined = apply_randomly(combined, tf.transpose(combined, [0, 2, 1, 3]))
+    return combined[:, :, :, :num_in_channels], combined[:, :, :, num_in_channels:]
 
 def _clip_and_rescale(inputs: tf.Tensor, key: Text) -> tf.Tensor:
     """Clips and rescales inputs with the stats corresponding to `key`.
@@ -143,14 +175,28 @@ def _get_base_key(key: Text) -> Text:
     raise ValueError(
       'The provided key does not match the expected pattern: {}'.format(key))
     
-def add_sample_weights(image, label):
-  # The weights for each class, with the constraint that:
-  #     sum(class_weights) == 1.0
-    class_weights = tf.constant(class_weights_input)
+def add_sample_weights(image: tf.Tensor, label: tf.Tensor,
+                       class_weights: List[float]) -> Tuple[tf.Tensor, tf.Tensor, tf.Tensor]:
+    """Adds a map of per-pixel sample weights to a batch.
+
+    The weights only change the loss if the loss function returns a value
+    per pixel, e.g. binary crossentropy, rather than a value per batch.
+
+    Args:
+    image: Inputs with dimensions BHWC.
+    label: Fire mask with dimensions BHW1.
+    class_weights: Weight of the no-fire and fire classes, normalized to sum
+      to 1.
+
+    Returns:
+    The inputs, the labels and the weight of each pixel, with the dimensions
+    of the labels.
+    """
+    class_weights = tf.constant(class_weights, dtype=tf.float32)
     class_weights = class_weights/tf.reduce_sum(class_weights)
 
-  # Create an image of `sample_weights` by using the label at each pixel as an 
-  # index into the `class weights` .
+    # Create an image of `sample_weights` by using the label at each pixel as an
+    # index into the `class weights` .
     sample_weights = tf.gather(class_weights, indices=tf.cast(label, tf.int32))
 
     return image, label, sample_weights
@@ -176,41 +222,125 @@ def _get_features_dict(
 def replacenan(t):
     return tf.where(tf.math.is_nan(t), tf.zeros_like(t), t)
 
-def _parse_tfr_element(element, features, clip_and_normalize=False,
-    clip_and_rescale=True):
-    data = {}
-    target = {}
-    for feat in features:
-        if feat == 'tomorrows_fires':
-            parse_dic = {
-                feat: tf.io.FixedLenFeature([], tf.string),
-            }
-            example_message = tf.io.parse_single_example(element, parse_dic)
-            b_feature = example_message[feat] 
-            feature = tf.io.parse_tensor(b_feature, out_type=tf.float32)
-            target[feat] = tf.expand_dims(replacenan(feature), axis=-1)
-
-        else:
-            parse_dic = {
-                feat: tf.io.FixedLenFeature([], tf.string),
-            }
-            example_message = tf.io.parse_single_example(element, parse_dic)
-            b_feature = example_message[feat] 
-            feature = tf.io.parse_tensor(b_feature, out_type=tf.float32)
-            if not feat in dataset_config["FEATURES_NOT_NORM"]:
-                feature = _clip_and_rescale(feature, feat)
-            data[feat] = replacenan(feature)
-            
-    input_features = tf.stack([data[key] for key in list(data.keys())], axis=2)
-
-    output_features = tf.clip_by_value(target["tomorrows_fires"], 0, 1)
-    
-    return input_features, output_features
+def parse_example(element: tf.Tensor, features: List[Text]) -> Dict[Text, tf.Tensor]:
+    """Parses the serialized tensors of a record, the parse stage of `get_dataset`.
+
+    Args:
+    element: Serialized example, as written by `records.write_arrays`.
+    features: Names of the features to parse.
+
+    Returns:
+    The tiles of each feature, with dimensions HW.
+    """
+    parse_dic = {feat: tf.io.FixedLenFeature([], tf.string) for feat in features}
+    example_message = tf.io.parse_single_example(element, parse_dic)
+    return {feat: tf.io.parse_tensor(example_message[feat], out_type=tf.float32) for feat in features}
+
+def normalize_example(data: Dict[Text, tf.Tensor]) -> Tuple[tf.Tensor, tf.Tensor]:
+    """Clips and rescales parsed tiles into inputs and targets, the normalize stage of `get_dataset`.
+
+    Args:
+    data: Tiles of each feature, as returned by `parse_example`.
+
+    Returns:
+    input_img: tensor with dimensions HWC, the channels in the order of
+      dataset_config["INPUT_FEATURES"].
+    output_img: tensor with dimensions HW1, tomorrows_fires clipped to [0, 1].
+    """
+    inputs = []
+    for feat in dataset_config["INPUT_FEATURES"]:
+        feature = data[feat]
+        if not feat in dataset_config["FEATURES_NOT_NORM"]:
+            feature = _clip_and_rescale(feature, feat)
+        inputs.append(replacenan(feature))
+    target = tf.expand_dims(replacenan(data['tomorrows_fires']), axis=-1)
+    return tf.stack(inputs, axis=2), tf.clip_by_value(target, 0, 1)
+
+def _ensure_shapes(input_img: tf.Tensor, output_img: tf.Tensor, data_size: int,
+                   num_in_channels: int) -> Tuple[tf.Tensor, tf.Tensor]:
+    """Sets the static shapes of parsed tiles, needed by the batch level crops."""
+    input_img = tf.ensure_shape(input_img, [data_size, data_size, num_in_channels])
+    output_img = tf.ensure_shape(output_img, [data_size, data_size, 1])
+    return input_img, output_img
+
+def read_records(dataset_pattern: Text, compression_type: Text) -> tf.data.Dataset:
+    """Reads the serialized records of the files matching a pattern, the read stage of `get_dataset`.
+
+    Args:
+    dataset_pattern: Input file pattern.
+    compression_type: Type of compression used for the input files.
+
+    Returns:
+    A dataset of serialized examples, files being read in parallel.
+    """
+    dataset = tf.data.Dataset.list_files(dataset_pattern,shuffle=False,seed=2048)
+    dataset = dataset.interleave(
+      lambda x: tf.data.TFRecordDataset(x, compression_type=compression_type),
+      num_parallel_calls=tf.data.experimental.AUTOTUNE)
+    return dataset.prefetch(buffer_size=tf.data.experimental.AUTOTUNE)
+
+def batch_examples(dataset: tf.data.Dataset, batch_size: int, shuffle: bool) -> tf.data.Dataset:
+    """Shuffles and batches examples, the batch stage of `get_dataset`.
+
+    Args:
+    dataset: Dataset of (inputs, targets) examples.
+    batch_size: Batch size.
+    shuffle: True if the examples should be shuffled.
+
+    Returns:
+    A dataset of batches of (inputs, targets).
+    """
+    if shuffle:
+        dataset = dataset.shuffle(2048)
+    return dataset.batch(batch_size)
+
+def crop_and_augment(dataset: tf.data.Dataset, sample_size: int, num_in_channels: int,
+                     random_crop: bool, center_crop: bool, augment: bool = False,
+                     class_weights: Optional[List[float]] = None) -> tf.data.Dataset:
+    """Crops, augments and weights batches, the batch level stages of `get_dataset`.
+
+    Args:
+    dataset: Dataset of batches of (inputs, targets), with static tile shapes.
+    sample_size: Size the tiles (square) when input into the model.
+    num_in_channels: Number of input channels.
+    random_crop: True if the data should be randomly cropped.
+    center_crop: True if the data shoulde be cropped in the center.
+    augment: True if the examples should be randomly flipped and rotated by
+      multiples of 90 degrees.
+    class_weights: Weights of the no-fire and fire classes, if set batches are
+      (inputs, targets, sample weights) with a weight per pixel.
+
+    Returns:
+    The dataset with each of the requested transforms mapped over its batches.
+    """
+    if (random_crop and center_crop):
+        raise ValueError('Cannot have both random and center crop.')
+    if random_crop:
+        dataset = dataset.map(
+            lambda x, y: random_crop_input_and_output_images(x, y, sample_size, num_in_channels, 1),
+            num_parallel_calls=tf.data.experimental.AUTOTUNE)
+    elif center_crop:
+        dataset = dataset.map(
+            lambda x, y: center_crop_input_and_output_images(x, y, sample_size),
+            num_parallel_calls=tf.data.experimental.AUTOTUNE)
+
+    if augment:
+        dataset = dataset.map(
+            random_flip_and_rotate_input_and_output_images,
+            num_parallel_calls=tf.data.experimental.AUTOTUNE)
+
+    if class_weights is not None:
+        dataset = dataset.map(
+            lambda x, y: add_sample_weights(x, y, class_weights),
+            num_parallel_calls=tf.data.experimental.AUTOTUNE)
+    return dataset
 
 def get_dataset(dataset_pattern: Text, data_size: int, sample_size: int,
                 batch_size: int, num_in_channels: int, compression_type: Text,
                 clip_and_normalize: bool, clip_and_rescale: bool,
-                random_crop: bool, center_crop: bool, shuffle: bool) -> tf.data.Dataset:
+                random_crop: bool, center_crop: bool, shuffle: bool,
+                augment: bool = False,
+                class_weights: Optional[List[float]] = None) -> tf.data.Dataset:
     """Gets the dataset from the file pattern.
 
     Args:
@@ -226,6 +356,17 @@ def get_dataset(dataset_pattern: Text, data_size: int, sample_size: int,
       otherwise.
     random_crop: True if the data should be randomly cropped.
     center_crop: True if the data shoulde be cropped in the center.
+    shuffle: True if the examples should be shuffled.
+    augment: True if the examples should be randomly flipped and rotated by
+      multiples of 90 degrees.
+    class_weights: Weights of the no-fire and fire classes, if set batches are
+      (inputs, targets, sample weights) with a weight per pixel.
+
+    The dataset is built from the stages `read_records`, `parse_example`,
+    `normalize_example`, `batch_examples` and `crop_and_augment`, which
+    `benchmarks.py` times one by one. Crops, augmentation and sample weights
+    run on whole batches, the input and target of each example getting the
+    same transforms.
 
     Returns:
     A TensorFlow dataset loaded from the input file pattern, with features
@@ -234,21 +375,69 @@ def get_dataset(dataset_pattern: Text, data_size: int, sample_size: int,
     """
     if (clip_and_normalize and clip_and_rescale):
         raise ValueError('Cannot have both normalize and rescale.')
-    dataset = tf.data.Dataset.list_files(dataset_pattern,shuffle=False,seed=2048)
-    dataset = dataset.interleave(
-      lambda x: tf.data.TFRecordDataset(x, compression_type=compression_type),
+    if (random_crop and center_crop):
+        raise ValueError('Cannot have both random and center crop.')
+    features = dataset_config["INPUT_FEATURES"] + dataset_config["OUTPUT_FEATURES"]
+    dataset = read_records(dataset_pattern, compression_type)
+    # parse and normalize in a single map, rather than one map per stage
+    dataset = dataset.map(
+        lambda x: _ensure_shapes(*normalize_example(parse_example(x, features)), data_size, num_in_channels),
       num_parallel_calls=tf.data.experimental.AUTOTUNE)
+    dataset = batch_examples(dataset, batch_size, shuffle)
+    dataset = crop_and_augment(dataset, sample_size, num_in_channels, random_crop, center_crop,
+                               augment=augment, class_weights=class_weights)
     dataset = dataset.prefetch(buffer_size=tf.data.experimental.AUTOTUNE)
     
-    dataset = dataset.map(
-        lambda x: _parse_tfr_element(x, dataset_config["INPUT_FEATURES"] + dataset_config["OUTPUT_FEATURES"]),
-      num_parallel_calls=tf.data.experimental.AUTOTUNE)
+    return dataset
 
-    if shuffle:
-        dataset = dataset.shuffle(2048)
+def get_indexed_dataset(dataset_pattern: Text, batch_size: int, sampling: Text,
+                        num_samples: Optional[int] = None, alpha: float = 1.0,
+                        seed: Optional[int] = None) -> tf.data.Dataset:
+    """Gets a dataset that draws records by random access using their sidecar index.
 
-    dataset = dataset.batch(batch_size)
+    Unlike `get_dataset`, which sees every chip once per epoch in shuffled
+    order, records are drawn with replacement according to `sampling`, so chips
+    with more fire can be drawn more often. Each record is read with a ranged
+    read instead of reading whole files.
 
+    Args:
+    dataset_pattern: Input file pattern, each file must have an index written by
+      `records.write_records`.
+    batch_size: Batch size.
+    sampling: "uniform", "fire_weighted" or "stratified", see
+      `records.RecordIndex.sampling_weights`.
+    num_samples: Number of records drawn per epoch, defaults to the number of
+      records.
+    alpha: Smoothing of the fire pixel counts for fire weighted sampling.
+    seed: Random seed.
+
+    Returns:
+    A TensorFlow dataset yielding batches of (inputs, targets) as `get_dataset`.
+    """
+    index = RecordIndex(dataset_pattern)
+    probabilities = index.sampling_weights(sampling, alpha=alpha)
+    num_samples = num_samples or len(index)
+    rng = np.random.default_rng(seed)
+
+    def draw():
+        # a new draw every time the dataset is iterated, i.e. every epoch
+        for i in rng.choice(len(index), size=num_samples, p=probabilities):
+            yield index.path_ids[i], index.offsets[i], index.lengths[i]
+
+    def read(path_id, offset, length):
+        return read_record(index.paths[int(path_id)], int(offset), int(length))
+
+    dataset = tf.data.Dataset.from_generator(
+        draw,
+        output_signature=(tf.TensorSpec([], tf.int64),) * 3)
+    dataset = dataset.map(
+        lambda path_id, offset, length: tf.ensure_shape(
+            tf.py_function(read, [path_id, offset, length], Tout=tf.string), []),
+        num_parallel_calls=tf.data.experimental.AUTOTUNE)
+    dataset = dataset.map(
+        lambda x: normalize_example(
+            parse_example(x, dataset_config["INPUT_FEATURES"] + dataset_config["OUTPUT_FEATURES"])),
+        num_parallel_calls=tf.data.experimental.AUTOTUNE)
+    dataset = dataset.batch(batch_size)
     dataset = dataset.prefetch(buffer_size=tf.data.experimental.AUTOTUNE)
-    
-    return dataset
\ No newline at end of file
+    return dataset
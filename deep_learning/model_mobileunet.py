@@ -0,0 +1,60 @@
+"""Definition of MobileUNet architecture"""
+# UNet with the depthwise separable convolutions of MobileNet (https://arxiv.org/abs/1704.04861),
+# the width multiplier scales the number of filters of every layer
+
+from tensorflow import keras
+
+def scale_filters(filters, width_multiplier, divisor=8):
+    # Round to a multiple of divisor, as in MobileNet, keeping at least divisor filters
+    return max(divisor, int(filters * width_multiplier + divisor / 2) // divisor * divisor)
+
+def bn_relu(x):
+    x = keras.layers.BatchNormalization()(x)
+    x = keras.layers.ReLU(6.)(x)
+    return x
+
+def separable_block(x, filters, strides=1):
+    x = keras.layers.DepthwiseConv2D((3, 3), strides=strides, padding="same", use_bias=False)(x)
+    x = bn_relu(x)
+    x = keras.layers.Conv2D(filters, (1, 1), padding="same", use_bias=False)(x)
+    x = bn_relu(x)
+    return x
+
+def encoder_block(x, filters):
+    x = separable_block(x, filters, strides=2)
+    x = separable_block(x, filters)
+    return x
+
+def decoder_block(x, xskip, filters):
+    x = keras.layers.UpSampling2D((2, 2))(x)
+    x = keras.layers.Concatenate()([x, xskip])
+    x = separable_block(x, filters)
+    x = separable_block(x, filters)
+    return x
+
+def get_model(input_shape, width_multiplier=1.0):
+    f = [scale_filters(filters, width_multiplier) for filters in [16, 32, 64, 128, 256]]
+    inputs = keras.layers.Input((input_shape[0], input_shape[1], input_shape[2]))
+
+    ## Stem, a standard convolution as there is little to save on the few input channels
+    e1 = keras.layers.Conv2D(f[0], (3, 3), padding="same", use_bias=False)(inputs)
+    e1 = bn_relu(e1)
+    e1 = separable_block(e1, f[0])
+
+    ## Encoder
+    e2 = encoder_block(e1, f[1])
+    e3 = encoder_block(e2, f[2])
+    e4 = encoder_block(e3, f[3])
+
+    ## Bridge
+    b1 = encoder_block(e4, f[4])
+
+    ## Decoder
+    d1 = decoder_block(b1, e4, f[3])
+    d2 = decoder_block(d1, e3, f[2])
+    d3 = decoder_block(d2, e2, f[1])
+    d4 = decoder_block(d3, e1, f[0])
+
+    outputs = keras.layers.Conv2D(1, (1, 1), padding="same", activation="sigmoid")(d4)
+    model = keras.models.Model(inputs, outputs)
+    return model
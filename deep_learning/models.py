@@ -0,0 +1,39 @@
+# Builds the model architectures by name, for train.ipynb, the CLI, the benchmarks and the sweeps
+
+from typing import List, Optional, Text
+
+from tensorflow import keras
+
+from config import dataset_config, model_config
+import model_mobileunet
+import model_resunet
+import model_satunet
+
+MODEL_NAMES = ["resunet", "satunet", "mobileunet"]
+
+
+def get_model(model_name: Text, input_shape: Optional[List[int]] = None, width_multiplier: Optional[float] = None,
+              num_layers: Optional[int] = None) -> keras.Model:
+    """Builds an uncompiled model.
+
+    Args:
+    model_name: One of MODEL_NAMES.
+    input_shape: [height, width, channels], defaults to model_config["IMG_SIZE"]
+      and the number of dataset_config["INPUT_FEATURES"].
+    width_multiplier: Filter multiplier of mobileunet, defaults to
+      model_config["WIDTH_MULTIPLIER"].
+    num_layers: Number of layers of satunet, defaults to model_config["NB_LAYERS"].
+
+    Returns:
+    The keras model.
+    """
+    if input_shape is None:
+        input_shape = [model_config["IMG_SIZE"][0], model_config["IMG_SIZE"][1], len(dataset_config["INPUT_FEATURES"])]
+    if model_name == "resunet":
+        return model_resunet.get_model(input_shape)
+    elif model_name == "satunet":
+        return model_satunet.get_model(input_shape, num_layers=num_layers or model_config["NB_LAYERS"])
+    elif model_name == "mobileunet":
+        return model_mobileunet.get_model(
+            input_shape, width_multiplier=width_multiplier or model_config["WIDTH_MULTIPLIER"])
+    raise ValueError("Provided wrong model name: {}".format(model_name))
@@ -0,0 +1,163 @@
+# TFRecords writer with a sidecar index for random access
+
+import csv
+import os
+from typing import Dict, Iterable, List, Optional, Text, Tuple
+
+import numpy as np
+import tensorflow as tf
+
+from config import dataset_config
+
+# Each TFRecord is framed as: uint64 length, uint32 masked crc of length, data, uint32 masked crc of data
+RECORD_HEADER_BYTES = 12
+RECORD_FOOTER_BYTES = 4
+INDEX_SUFFIX = ".index.csv"
+INDEX_FIELDS = ["sample_id", "offset", "length", "fire_pixels"]
+
+
+def serialize_sample(arrays: Dict[Text, np.ndarray]) -> bytes:
+    """Serializes the arrays of a sample in the format read by `datagen.parse_example`.
+
+    Args:
+    arrays: feature name to 2D array.
+
+    Returns:
+    The serialized tf.train.Example.
+    """
+    feature = {}
+    for name, array in arrays.items():
+        tensor = tf.io.serialize_tensor(tf.convert_to_tensor(array, dtype=tf.float32))
+        feature[name] = tf.train.Feature(bytes_list=tf.train.BytesList(value=[tensor.numpy()]))
+    example = tf.train.Example(features=tf.train.Features(feature=feature))
+    return example.SerializeToString()
+
+
+def load_sample(sample_dir: Text, features: List[Text]) -> Dict[Text, np.ndarray]:
+    """Loads the .npy files of a sample directory, locally or from any filesystem supported by tf.io.gfile."""
+    arrays = {}
+    for feature in features:
+        with tf.io.gfile.GFile(os.path.join(sample_dir, f"{feature}.npy"), "rb") as f:
+            arrays[feature] = np.load(f)
+    return arrays
+
+
+def index_path(records_path: Text) -> Text:
+    return records_path + INDEX_SUFFIX
+
+
+def write_arrays(samples: Iterable[Tuple[Text, Dict[Text, np.ndarray]]], records_path: Text) -> Text:
+    """Writes samples held in memory to an uncompressed TFRecords file and a sidecar index.
+
+    Args:
+    samples: (sample id, feature name to 2D array) pairs.
+    records_path: path of the TFRecords file to write.
+
+    Returns:
+    The path of the sidecar index.
+    """
+    offset = 0
+    with tf.io.TFRecordWriter(records_path) as writer, \
+            tf.io.gfile.GFile(index_path(records_path), "w") as index_file:
+        index = csv.DictWriter(index_file, fieldnames=INDEX_FIELDS)
+        index.writeheader()
+        for sample_id, arrays in samples:
+            record = serialize_sample(arrays)
+            writer.write(record)
+            fire_pixels = 0
+            if "tomorrows_fires" in arrays:
+                fire_pixels = int(np.nansum(arrays["tomorrows_fires"] > 0))
+            index.writerow({
+                "sample_id": sample_id,
+                "offset": offset,
+                "length": len(record),
+                "fire_pixels": fire_pixels,
+            })
+            offset += RECORD_HEADER_BYTES + len(record) + RECORD_FOOTER_BYTES
+    return index_path(records_path)
+
+
+def write_records(sample_dirs: List[Text], records_path: Text,
+                  features: Optional[List[Text]] = None) -> Text:
+    """Writes samples to an uncompressed TFRecords file and a sidecar index.
+
+    The index has one row per record with the sample id (the name of its
+    directory), the byte offset and length of the record in the file, and the
+    number of tomorrow's fire pixels, so that records can be read and sampled
+    without scanning the file.
+
+    Args:
+    sample_dirs: directories holding one .npy file per feature.
+    records_path: path of the TFRecords file to write.
+    features: features to write, defaults to the input and output features.
+
+    Returns:
+    The path of the sidecar index.
+    """
+    if features is None:
+        features = dataset_config["INPUT_FEATURES"] + dataset_config["OUTPUT_FEATURES"]
+    return write_arrays(
+        ((os.path.basename(os.path.normpath(sample_dir)), load_sample(sample_dir, features))
+         for sample_dir in sample_dirs),
+        records_path)
+
+
+class RecordIndex:
+    """The sidecar indexes of every TFRecords file matching a pattern, as flat arrays."""
+
+    def __init__(self, dataset_pattern: Text):
+        self.paths = sorted(tf.io.gfile.glob(dataset_pattern))
+        path_ids, sample_ids, offsets, lengths, fire_pixels = [], [], [], [], []
+        for path_id, path in enumerate(self.paths):
+            if not tf.io.gfile.exists(index_path(path)):
+                raise FileNotFoundError(
+                    "No index for {}, write the records with records.write_records".format(path))
+            with tf.io.gfile.GFile(index_path(path), "r") as f:
+                for row in csv.DictReader(f):
+                    path_ids.append(path_id)
+                    sample_ids.append(row["sample_id"])
+                    offsets.append(int(row["offset"]))
+                    lengths.append(int(row["length"]))
+                    fire_pixels.append(int(row["fire_pixels"]))
+        self.path_ids = np.array(path_ids, dtype=np.int64)
+        self.sample_ids = np.array(sample_ids)
+        self.offsets = np.array(offsets, dtype=np.int64)
+        self.lengths = np.array(lengths, dtype=np.int64)
+        self.fire_pixels = np.array(fire_pixels, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def sampling_weights(self, sampling: Text, alpha: float = 1.0,
+                         bins: List[int] = (0, 1, 11, 101)) -> np.ndarray:
+        """Probability of drawing each record.
+
+        Args:
+        sampling: "uniform", "fire_weighted" (proportional to fire pixels +
+          alpha) or "stratified" (equal probability for each bin of fire pixel
+          counts, uniform within a bin).
+        alpha: smoothing added to the fire pixel counts so that chips without
+          fire are still drawn.
+        bins: left edges of the fire pixel count bins for stratified sampling.
+
+        Returns:
+        Probabilities summing to 1.
+        """
+        if sampling == "uniform":
+            weights = np.ones(len(self), dtype=np.float64)
+        elif sampling == "fire_weighted":
+            weights = self.fire_pixels + float(alpha)
+        elif sampling == "stratified":
+            strata = np.digitize(self.fire_pixels, bins)
+            counts = np.bincount(strata)
+            weights = 1.0 / counts[strata]
+        else:
+            raise ValueError("Unknown sampling: {}".format(sampling))
+        return weights / weights.sum()
+
+
+def read_record(path: Text, offset: int, length: int) -> bytes:
+    """Reads a single record with a ranged read, skipping the framing."""
+    with tf.io.gfile.GFile(path, "rb") as f:
+        f.seek(offset + RECORD_HEADER_BYTES)
+        return f.read(length)
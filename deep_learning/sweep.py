@@ -0,0 +1,341 @@
+# Hyperparameter sweeps running several trials at once on a dataset loaded once into shared memory
+
+import argparse
+import hashlib
+import itertools
+import json
+import multiprocessing
+import os
+import sqlite3
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import shared_memory
+from typing import Dict, List, Optional, Text, Tuple
+
+import numpy as np
+
+from config import dataset_config, training_config, model_config
+
+# Keys of training_config and model_config a trial can override.
+TRIAL_KEYS = {
+    "training": ["NB_EPOCHS", "BATCH_SIZE", "INITIAL_LEARNING_RATE", "LOSS_FUNCTION_NAME"],
+    "model": ["MODEL_NAME", "NB_LAYERS", "WIDTH_MULTIPLIER"],
+}
+
+
+def expand_grid(grid: Dict[Text, List]) -> List[Dict]:
+    """Expands lists of values per config key into every combination of them."""
+    keys = sorted(grid)
+    return [dict(zip(keys, values)) for values in itertools.product(*(grid[key] for key in keys))]
+
+
+def trial_config(overrides: Dict) -> Dict:
+    """The complete config of a trial, the current config updated with the overrides of the trial."""
+    unknown = set(overrides) - set(TRIAL_KEYS["training"]) - set(TRIAL_KEYS["model"])
+    if unknown:
+        raise ValueError("Config keys not supported by sweeps: {}".format(sorted(unknown)))
+    config = {key: training_config[key] for key in TRIAL_KEYS["training"]}
+    config.update({key: model_config[key] for key in TRIAL_KEYS["model"]})
+    config.update(overrides)
+    return config
+
+
+def config_hash(config: Dict, train_pattern: Text, eval_pattern: Text, patience: int,
+                min_val_dice: Optional[float], seed: int) -> Text:
+    """Identifies a trial by its config, data, early stopping and seed, so that finished trials are not run again."""
+    key = dict(config, train_pattern=train_pattern, eval_pattern=eval_pattern,
+               input_features=dataset_config["INPUT_FEATURES"], patience=patience, min_val_dice=min_val_dice,
+               seed=seed)
+    return hashlib.sha1(json.dumps(key, sort_keys=True).encode()).hexdigest()
+
+
+def load_arrays(dataset_pattern: Text) -> Tuple[np.ndarray, np.ndarray]:
+    """Reads and normalizes a whole dataset with `get_dataset` into memory.
+
+    Args:
+    dataset_pattern: TFRecords file pattern.
+
+    Returns:
+    Inputs of shape (N, height, width, channels) and labels of shape
+    (N, height, width, 1).
+    """
+    from datagen import get_dataset
+
+    dataset = get_dataset(
+        dataset_pattern,
+        data_size=model_config["IMG_SIZE"][0],
+        sample_size=model_config["IMG_SIZE"][0],
+        batch_size=training_config["BATCH_SIZE"],
+        num_in_channels=len(dataset_config["INPUT_FEATURES"]),
+        compression_type=None,
+        clip_and_normalize=False,
+        clip_and_rescale=True,
+        random_crop=False,
+        center_crop=False,
+        shuffle=False)
+    inputs, labels = [], []
+    for batch_inputs, batch_labels in dataset:
+        inputs.append(batch_inputs.numpy())
+        labels.append(batch_labels.numpy())
+    return np.concatenate(inputs).astype(np.float32), np.concatenate(labels).astype(np.float32)
+
+
+class SharedArrays:
+    """Named numpy arrays in shared memory, attached to by name from other processes."""
+
+    def __init__(self, arrays: Dict[Text, np.ndarray]):
+        self.blocks = {}
+        self.specs = {}
+        for name, array in arrays.items():
+            block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+            np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[...] = array
+            self.blocks[name] = block
+            self.specs[name] = (block.name, array.shape, array.dtype.str)
+
+    def close(self):
+        for block in self.blocks.values():
+            block.close()
+            block.unlink()
+
+
+def attach_arrays(specs: Dict[Text, Tuple]) -> Tuple[Dict[Text, np.ndarray], List]:
+    """Attaches to the arrays of a `SharedArrays`, returning them and the blocks to keep open while they are used."""
+    arrays, blocks = {}, []
+    for name, (block_name, shape, dtype) in specs.items():
+        block = shared_memory.SharedMemory(name=block_name)
+        arrays[name] = np.ndarray(shape, dtype=np.dtype(dtype), buffer=block.buf)
+        blocks.append(block)
+    return arrays, blocks
+
+
+def _array_dataset(inputs: np.ndarray, labels: np.ndarray, batch_size: int, shuffle: bool, seed: int):
+    """Batches of shared arrays, copying only the rows of each batch."""
+    import tensorflow as tf
+
+    def gather(indices):
+        indices = np.sort(indices)
+        return inputs[indices], labels[indices]
+
+    dataset = tf.data.Dataset.range(len(inputs))
+    if shuffle:
+        dataset = dataset.shuffle(len(inputs), seed=seed, reshuffle_each_iteration=True)
+    dataset = dataset.batch(batch_size)
+    dataset = dataset.map(
+        lambda indices: tf.numpy_function(gather, [indices], (tf.float32, tf.float32)),
+        num_parallel_calls=tf.data.experimental.AUTOTUNE)
+    dataset = dataset.map(lambda x, y: (tf.ensure_shape(x, (None,) + inputs.shape[1:]),
+                                        tf.ensure_shape(y, (None,) + labels.shape[1:])))
+    return dataset.prefetch(buffer_size=tf.data.experimental.AUTOTUNE)
+
+
+def _init_worker(threads: int) -> None:
+    """Limits the threads of a trial process, before TensorFlow starts its thread pools."""
+    import tensorflow as tf
+
+    tf.config.threading.set_intra_op_parallelism_threads(threads)
+    tf.config.threading.set_inter_op_parallelism_threads(max(1, threads // 2))
+
+
+def run_trial(config: Dict, specs: Dict[Text, Tuple], patience: int = 5, min_val_dice: Optional[float] = None,
+              seed: int = 2048) -> Dict:
+    """Trains one trial on the shared arrays.
+
+    Args:
+    config: Complete config of the trial, see `trial_config`.
+    specs: `SharedArrays.specs` of the train and eval inputs and labels.
+    patience: Epochs without improvement of the validation dice before the
+      trial is stopped.
+    min_val_dice: Validation dice the trial must reach within `patience`
+      epochs, otherwise it is stopped.
+    seed: Random seed for the weights and the shuffling.
+
+    Returns:
+    The best validation dice and its epoch, the number of epochs run, the
+    training time and the history of the trial.
+    """
+    import tensorflow as tf
+
+    from metrics import dice_coef, get_loss_function
+    from models import get_model
+
+    training_config.update({key: config[key] for key in TRIAL_KEYS["training"]})
+    model_config.update({key: config[key] for key in TRIAL_KEYS["model"]})
+    arrays, blocks = attach_arrays(specs)
+    try:
+        tf.keras.utils.set_random_seed(seed)
+        model = get_model(config["MODEL_NAME"], width_multiplier=config["WIDTH_MULTIPLIER"],
+                          num_layers=config["NB_LAYERS"])
+        model.compile(
+            optimizer=tf.keras.optimizers.Adam(learning_rate=config["INITIAL_LEARNING_RATE"]),
+            loss=get_loss_function(config["LOSS_FUNCTION_NAME"]),
+            metrics=[dice_coef])
+        early_stopping = tf.keras.callbacks.EarlyStopping(
+            monitor="val_dice_coef", mode="max", patience=patience, baseline=min_val_dice)
+        start = time.perf_counter()
+        history = model.fit(
+            _array_dataset(arrays["train_inputs"], arrays["train_labels"], config["BATCH_SIZE"], True, seed),
+            validation_data=_array_dataset(arrays["eval_inputs"], arrays["eval_labels"], config["BATCH_SIZE"],
+                                           False, seed),
+            epochs=config["NB_EPOCHS"],
+            callbacks=[early_stopping],
+            verbose=0)
+        seconds = time.perf_counter() - start
+    finally:
+        del arrays
+        for block in blocks:
+            block.close()
+    val_dice = [float(dice) for dice in history.history["val_dice_coef"]]
+    return {
+        "best_val_dice": max(val_dice),
+        "best_epoch": int(np.argmax(val_dice)) + 1,
+        "epochs_run": len(val_dice),
+        "stopped_early": len(val_dice) < config["NB_EPOCHS"],
+        "seconds": seconds,
+        "history": {key: [float(v) for v in values] for key, values in history.history.items()},
+    }
+
+
+class ResultsTable:
+    """Trial results in a local sqlite table keyed by config hash."""
+
+    def __init__(self, path: Text):
+        self.path = path
+        with sqlite3.connect(self.path) as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS trials (config_hash TEXT PRIMARY KEY, config TEXT, status TEXT, "
+                "best_val_dice REAL, best_epoch INTEGER, epochs_run INTEGER, stopped_early INTEGER, "
+                "seconds REAL, history TEXT, error TEXT, finished_at TEXT)")
+
+    def finished(self) -> List[Text]:
+        with sqlite3.connect(self.path) as conn:
+            return [row[0] for row in conn.execute("SELECT config_hash FROM trials WHERE status = 'finished'")]
+
+    def write(self, trial_hash: Text, config: Dict, result: Optional[Dict] = None, error: Optional[Text] = None):
+        result = result or {}
+        with sqlite3.connect(self.path) as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO trials VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (trial_hash, json.dumps(config, sort_keys=True), "failed" if error else "finished",
+                 result.get("best_val_dice"), result.get("best_epoch"), result.get("epochs_run"),
+                 result.get("stopped_early"), result.get("seconds"), json.dumps(result.get("history")), error,
+                 time.strftime("%Y-%m-%dT%H:%M:%S")))
+
+    def best(self, limit: int = 10) -> List[Dict]:
+        with sqlite3.connect(self.path) as conn:
+            rows = conn.execute(
+                "SELECT config_hash, config, best_val_dice, best_epoch, epochs_run, seconds FROM trials "
+                "WHERE status = 'finished' ORDER BY best_val_dice DESC LIMIT ?", (limit,)).fetchall()
+        return [{"config_hash": row[0], "config": json.loads(row[1]), "best_val_dice": row[2],
+                 "best_epoch": row[3], "epochs_run": row[4], "seconds": row[5]} for row in rows]
+
+
+def run_sweep(train_pattern: Text, eval_pattern: Text, grid: Dict[Text, List], results_path: Text = "sweep.sqlite",
+              parallel_trials: Optional[int] = None, threads_per_trial: Optional[int] = None, patience: int = 5,
+              min_val_dice: Optional[float] = None, seed: int = 2048) -> Dict:
+    """Runs every trial of a grid, several at once, on datasets loaded once.
+
+    The train and eval sets are read and normalized once, placed in shared
+    memory, and every trial process reads its batches from there. Trials
+    already finished in the results table are skipped, so an interrupted
+    sweep can be resumed.
+
+    Args:
+    train_pattern: Training file pattern.
+    eval_pattern: Validation file pattern.
+    grid: Values to sweep per config key, e.g. {"INITIAL_LEARNING_RATE":
+      [1e-3, 1e-4], "MODEL_NAME": ["resunet", "mobileunet"]}.
+    results_path: Sqlite file of the results table.
+    parallel_trials: Number of trials run at once, defaults to the number of
+      CPUs divided by threads_per_trial.
+    threads_per_trial: TensorFlow threads of each trial, defaults to the
+      number of CPUs divided by parallel_trials.
+    patience: Epochs without improvement of the validation dice before a
+      trial is stopped.
+    min_val_dice: Validation dice a trial must reach within `patience` epochs.
+    seed: Random seed of every trial.
+
+    Returns:
+    The wall time of the sweep, the summed training time of the trials it
+    ran, failed trials and the best trials of the results table.
+    """
+    cpus = os.cpu_count()
+    if parallel_trials is None:
+        parallel_trials = max(1, cpus // (threads_per_trial or 2))
+    threads_per_trial = threads_per_trial or max(1, cpus // parallel_trials)
+
+    table = ResultsTable(results_path)
+    finished = set(table.finished())
+    trials = []
+    for overrides in expand_grid(grid):
+        config = trial_config(overrides)
+        trial_hash = config_hash(config, train_pattern, eval_pattern, patience, min_val_dice, seed)
+        if trial_hash not in finished:
+            trials.append((trial_hash, config))
+    # the early stopping and seed of the trials are recorded with their config
+    run_settings = {"patience": patience, "min_val_dice": min_val_dice, "seed": seed}
+
+    start = time.perf_counter()
+    failed, trial_seconds = {}, 0.0
+    if trials:
+        train_inputs, train_labels = load_arrays(train_pattern)
+        eval_inputs, eval_labels = load_arrays(eval_pattern)
+        shared = SharedArrays({"train_inputs": train_inputs, "train_labels": train_labels,
+                               "eval_inputs": eval_inputs, "eval_labels": eval_labels})
+        del train_inputs, train_labels, eval_inputs, eval_labels
+        load_seconds = time.perf_counter() - start
+        try:
+            # TensorFlow is not fork safe, trial processes start from a fresh interpreter
+            with ProcessPoolExecutor(max_workers=parallel_trials, mp_context=multiprocessing.get_context("spawn"),
+                                     initializer=_init_worker, initargs=(threads_per_trial,)) as executor:
+                futures = {executor.submit(run_trial, config, shared.specs, patience, min_val_dice, seed):
+                           (trial_hash, config) for trial_hash, config in trials}
+                for future in as_completed(futures):
+                    trial_hash, config = futures[future]
+                    try:
+                        result = future.result()
+                    except Exception as e:
+                        failed[trial_hash] = repr(e)
+                        table.write(trial_hash, dict(config, **run_settings), error=repr(e))
+                        continue
+                    trial_seconds += result["seconds"]
+                    table.write(trial_hash, dict(config, **run_settings), result)
+        finally:
+            shared.close()
+    else:
+        load_seconds = 0.0
+
+    return {
+        "trials_run": len(trials),
+        "trials_skipped": len(expand_grid(grid)) - len(trials),
+        "parallel_trials": parallel_trials,
+        "threads_per_trial": threads_per_trial,
+        "load_seconds": load_seconds,
+        "wall_seconds": time.perf_counter() - start,
+        "trial_seconds": trial_seconds,
+        "failed": failed,
+        "best": table.best(),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run a hyperparameter sweep with trials in parallel")
+    parser.add_argument("--train-pattern", required=True)
+    parser.add_argument("--eval-pattern", required=True)
+    parser.add_argument("--grid", required=True,
+                        help='JSON file or string of values per config key, e.g. {"INITIAL_LEARNING_RATE": [1e-3, 1e-4]}')
+    parser.add_argument("--results", default="sweep.sqlite", help="sqlite file of the results table")
+    parser.add_argument("--parallel-trials", type=int)
+    parser.add_argument("--threads-per-trial", type=int)
+    parser.add_argument("--patience", type=int, default=5)
+    parser.add_argument("--min-val-dice", type=float)
+    parser.add_argument("--seed", type=int, default=2048, help="random seed of every trial")
+    args = parser.parse_args()
+
+    if os.path.exists(args.grid):
+        with open(args.grid) as f:
+            grid = json.load(f)
+    else:
+        grid = json.loads(args.grid)
+    results = run_sweep(args.train_pattern, args.eval_pattern, grid, args.results, args.parallel_trials,
+                        args.threads_per_trial, args.patience, args.min_val_dice, args.seed)
+    print(json.dumps(results, indent=2))
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the deep learning modules are flat modules imported from the deep_learning directory
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
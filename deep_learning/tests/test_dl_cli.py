@@ -0,0 +1,19 @@
+import os
+import subprocess
+import sys
+
+import cli
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_cli_import_loads_no_heavy_modules():
+    code = "import sys, cli; print(','.join(m for m in cli.HEAVY_MODULES if m in sys.modules))"
+    loaded = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True,
+                            cwd=ROOT).stdout.strip()
+    assert loaded == ""
+
+
+def test_cli_import_time():
+    # the CLI only imports the standard library, a slow import means TensorFlow or numpy crept in
+    assert cli._import_seconds([]) < 1.0
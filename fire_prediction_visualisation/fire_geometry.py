@@ -0,0 +1,142 @@
+"""
+Turn chip prediction arrays into fire geometries in WGS84.
+
+Each chip directory holds the arrays (probabilities.npy, classification.npy, todays_fires.npy, ...) and a
+bbox.geojson with the chip footprint in its UTM CRS. Fire pixels are found with one array operation per chip and
+all of their coordinates are reprojected in a single transformer call.
+"""
+import json
+import os
+from pathlib import Path
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import pyproj
+from shapely.geometry import Polygon, box, shape
+from shapely.ops import unary_union
+
+PIXEL_RES = 500
+
+
+def read_bbox(geojson_path):
+    """
+    Read a chip bbox.geojson
+    :param geojson_path: path to the bbox.geojson written with the chip
+    :return: shapely polygon in the chip CRS and the integer EPSG code
+    """
+    with open(geojson_path) as f:
+        gj = json.load(f)
+    poly = shape(gj["features"][0]["geometry"])
+    epsg = int(gj["crs"]["properties"]["name"].split("::")[1])
+    return poly, epsg
+
+
+def load_fire_array(npy_path):
+    """
+    Load a chip array as 2D, dropping the channel axis of model outputs such as probabilities.npy
+    :param npy_path: path of the .npy file
+    :return: 2D numpy array
+    """
+    arr = np.load(npy_path)
+    if arr.ndim == 3:
+        arr = arr[:, :, 0]
+    return arr
+
+
+def fire_pixel_boxes(fire_arr, bounds, threshold=0, pixel_res=PIXEL_RES):
+    """
+    Find the fire pixels of a chip and their extent in the chip CRS
+    :param fire_arr: 2D array of fire masks or probabilities
+    :param bounds: (minx, miny, maxx, maxy) of the chip in its CRS
+    :param threshold: pixels with values above this are fire
+    :param pixel_res: pixel size in metres
+    :return: rows, cols, values and an (n, 4) array of pixel (minx, miny, maxx, maxy)
+    """
+    rows, cols = np.nonzero(np.nan_to_num(fire_arr) > threshold)
+    minx, _, _, maxy = bounds
+    left = minx + cols * pixel_res
+    top = maxy - rows * pixel_res
+    boxes = np.column_stack([left, top - pixel_res, left + pixel_res, top])
+    return rows, cols, fire_arr[rows, cols], boxes
+
+
+def boxes_to_wgs84(boxes, epsg):
+    """
+    Reproject pixel boxes to WGS84 polygons, transforming every corner in one call
+    :param boxes: (n, 4) array of (minx, miny, maxx, maxy) in the chip CRS
+    :param epsg: EPSG code of the chip CRS
+    :return: list of shapely polygons in EPSG:4326
+    """
+    minx, miny, maxx, maxy = boxes.T
+    xs = np.column_stack([minx, maxx, maxx, minx, minx])
+    ys = np.column_stack([miny, miny, maxy, maxy, miny])
+    transformer = pyproj.Transformer.from_crs(epsg, 4326, always_xy=True)
+    lons, lats = transformer.transform(xs.ravel(), ys.ravel())
+    coords = np.stack([lons, lats], axis=-1).reshape(-1, 5, 2)
+    return [Polygon(ring) for ring in coords]
+
+
+def chip_fire_geometries(chip_dir, array_name="probabilities.npy", threshold=None, dissolve=False,
+                         pixel_res=PIXEL_RES):
+    """
+    Fire geometries in WGS84 for a single chip
+    :param chip_dir: directory holding the chip arrays and bbox.geojson, its name is used as the chip id
+    :param array_name: array to read fires from
+    :param threshold: pixels with values above this are fire, defaults to 0.5 for probabilities and 0 otherwise
+    :param dissolve: merge touching fire pixels into fire-front polygons instead of one polygon per pixel
+    :param pixel_res: pixel size in metres
+    :return: gpd.GeoDataFrame in EPSG:4326
+    """
+    if threshold is None:
+        threshold = 0.5 if "probabilities" in array_name else 0
+    bbox, epsg = read_bbox(os.path.join(chip_dir, "bbox.geojson"))
+    fire_arr = load_fire_array(os.path.join(chip_dir, array_name))
+    rows, cols, values, boxes = fire_pixel_boxes(fire_arr, bbox.bounds, threshold, pixel_res)
+    chip_id = Path(chip_dir).name
+
+    if dissolve:
+        # pixel boxes share edges exactly in the chip CRS, so they are merged before reprojecting
+        fronts = gpd.GeoSeries([unary_union([box(*b) for b in boxes])], crs=epsg).explode(index_parts=False)
+        fronts = fronts[~fronts.is_empty]
+        gdf = gpd.GeoDataFrame(geometry=fronts.values, crs=epsg)
+        gdf["chip_id"], gdf["epsg"] = chip_id, epsg
+        gdf["n_pixels"] = (gdf.area / pixel_res ** 2).round().astype(int)
+        return gdf.to_crs(4326).reset_index(drop=True)
+
+    return gpd.GeoDataFrame(
+        {
+            "chip_id": chip_id,
+            "epsg": epsg,
+            "row": rows,
+            "col": cols,
+            "value": values,
+        },
+        geometry=boxes_to_wgs84(boxes, epsg),
+        crs=4326,
+    )
+
+
+def chips_fire_geometries(chip_dirs, array_name="probabilities.npy", threshold=None, dissolve=False,
+                          pixel_res=PIXEL_RES):
+    """
+    Fire geometries in WGS84 for many chips, concatenated once into a single GeoDataFrame
+    See chip_fire_geometries for the parameters
+    :return: gpd.GeoDataFrame in EPSG:4326
+    """
+    gdfs = [chip_fire_geometries(chip_dir, array_name, threshold, dissolve, pixel_res) for chip_dir in chip_dirs]
+    if not gdfs:
+        return gpd.GeoDataFrame(geometry=[], crs=4326)
+    return gpd.GeoDataFrame(pd.concat(gdfs, ignore_index=True), crs=4326)
+
+
+def export_fire_geometries(gdf, output_path):
+    """
+    Write fire geometries to GeoParquet (.parquet) or GeoJSON (any other suffix)
+    :param gdf: gpd.GeoDataFrame from chips_fire_geometries
+    :param output_path: path of the output file
+    """
+    if str(output_path).endswith(".parquet"):
+        gdf.to_parquet(output_path)
+    else:
+        gdf.to_file(output_path, driver="GeoJSON")
@@ -0,0 +1,144 @@
+"""
+Proximity warnings for buildings near predicted fires.
+
+Buildings are read from a local extract of OpenStreetMap (written once with cache_buildings) so that warnings
+can be produced offline. For each UTM zone the building centroids are projected in one call and the distance to
+the closest fire pixel is found for all of them at once with a KD-tree over the fire pixel centres.
+"""
+import os
+import warnings
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+from scipy.spatial import cKDTree
+from shapely.geometry import box
+
+from fire_geometry import fire_pixel_boxes, load_fire_array, read_bbox, PIXEL_RES
+
+DEFAULT_THRESHOLDS = (2000, 5000, 10000)
+
+
+def cache_buildings(poly_wgs84, cache_path):
+    """
+    Query the Overpass API for buildings in a polygon and write them to a local extract
+    :param poly_wgs84: shapely polygon in EPSG:4326
+    :param cache_path: path of the extract, GeoParquet (.parquet) or any vector format supported by to_file
+    :return: gpd.GeoDataFrame of building polygons
+    """
+    import osmnx
+
+    osm_buildings = osmnx.geometries.geometries_from_polygon(poly_wgs84, tags={"building": True})
+    buildings = osm_buildings[osm_buildings["geometry"].geom_type == "Polygon"]
+    columns = [c for c in ("building", "name") if c in buildings.columns]
+    buildings = buildings[columns + ["geometry"]].reset_index(drop=True)
+    if str(cache_path).endswith(".parquet"):
+        buildings.to_parquet(cache_path)
+    else:
+        buildings.to_file(cache_path)
+    return buildings
+
+
+def load_buildings(cache_path, bbox=None):
+    """
+    Read buildings from a local extract
+    :param cache_path: path of the extract written by cache_buildings
+    :param bbox: optional (left, bottom, right, top) in EPSG:4326 to read
+    :return: gpd.GeoDataFrame of building polygons in EPSG:4326
+    """
+    if str(cache_path).endswith(".parquet"):
+        buildings = gpd.read_parquet(cache_path)
+        if bbox is not None:
+            buildings = buildings.iloc[buildings.sindex.query(box(*bbox))]
+    else:
+        buildings = gpd.read_file(cache_path, bbox=bbox)
+    return buildings.to_crs(4326)
+
+
+def fire_pixel_centres(chip_dirs, array_name="probabilities.npy", threshold=None):
+    """
+    Centres of the fire pixels of many chips in their own CRS
+    :param chip_dirs: chip directories holding the arrays and bbox.geojson
+    :param array_name: array to read fires from
+    :param threshold: pixels with values above this are fire, defaults to 0.5 for probabilities and 0 otherwise
+    :return: pd.DataFrame with chip_id, epsg, x and y columns
+    """
+    if threshold is None:
+        threshold = 0.5 if "probabilities" in array_name else 0
+    centres = []
+    for chip_dir in chip_dirs:
+        bbox, epsg = read_bbox(os.path.join(chip_dir, "bbox.geojson"))
+        _, _, _, boxes = fire_pixel_boxes(load_fire_array(os.path.join(chip_dir, array_name)), bbox.bounds, threshold)
+        centres.append(pd.DataFrame({
+            "chip_id": os.path.basename(os.path.normpath(chip_dir)),
+            "epsg": epsg,
+            "x": boxes[:, 0] + PIXEL_RES / 2,
+            "y": boxes[:, 1] + PIXEL_RES / 2,
+        }))
+    if not centres:
+        return pd.DataFrame(columns=["chip_id", "epsg", "x", "y"])
+    return pd.concat(centres, ignore_index=True)
+
+
+def building_label(buildings):
+    """The building name if it has one, else its type, with 'yes' shown as 'building'"""
+    label = buildings["building"].astype(str) if "building" in buildings else pd.Series("building", buildings.index)
+    label = label.replace({"yes": "building", "nan": "building"})
+    if "name" in buildings:
+        label = buildings["name"].where(buildings["name"].notna(), label)
+    return label
+
+
+def proximity_warnings(buildings, fire_centres, thresholds=DEFAULT_THRESHOLDS):
+    """
+    Rank buildings by their distance to the closest fire pixel
+    :param buildings: gpd.GeoDataFrame of building polygons in EPSG:4326
+    :param fire_centres: pd.DataFrame of fire pixel centres from fire_pixel_centres
+    :param thresholds: distances in metres, buildings further than the largest are not warned about
+    :return: pd.DataFrame of warnings sorted by distance, with the smallest threshold each building falls within
+    """
+    thresholds = sorted(thresholds)
+    max_distance = thresholds[-1]
+    with warnings.catch_warnings():
+        # centroids of small building footprints are fine to take in geographic coordinates
+        warnings.simplefilter("ignore", UserWarning)
+        centroids = buildings.geometry.centroid
+
+    nearest = []
+    for epsg, fires in fire_centres.groupby("epsg"):
+        tree = cKDTree(fires[["x", "y"]].values)
+
+        # only project buildings near the fires of this zone
+        fires_wgs84 = gpd.GeoSeries(gpd.points_from_xy(fires.x, fires.y), crs=epsg).to_crs(4326)
+        left, bottom, right, top = fires_wgs84.total_bounds
+        lat_margin = max_distance / 111000
+        lon_margin = lat_margin / np.cos(np.radians(min(max(abs(bottom), abs(top)) + lat_margin, 85)))
+        near = centroids.iloc[centroids.sindex.query(box(left - lon_margin, bottom - lat_margin,
+                                                         right + lon_margin, top + lat_margin))]
+        if near.empty:
+            continue
+        projected = near.to_crs(epsg)
+        distance, fire_idx = tree.query(np.column_stack([projected.x, projected.y]),
+                                        distance_upper_bound=max_distance)
+        found = np.isfinite(distance)
+        nearest.append(pd.DataFrame({
+            "building_idx": near.index[found],
+            "distance_m": distance[found],
+            "chip_id": fires["chip_id"].values[fire_idx[found]],
+        }))
+
+    columns = ["building_idx", "label", "longitude", "latitude", "distance_m", "threshold_m", "chip_id", "message"]
+    if not nearest:
+        return pd.DataFrame(columns=columns)
+    # a building near fires in several zones keeps its closest fire
+    ranked = pd.concat(nearest).sort_values("distance_m").drop_duplicates("building_idx")
+    ranked["threshold_m"] = np.array(thresholds)[np.searchsorted(thresholds, ranked["distance_m"].values)]
+    ranked["label"] = building_label(buildings).loc[ranked["building_idx"]].values
+    ranked["longitude"] = centroids.x.loc[ranked["building_idx"]].values
+    ranked["latitude"] = centroids.y.loc[ranked["building_idx"]].values
+    ranked["message"] = [
+        f"WARNING, {label} at lat/long {round(lat, 3)}/{round(lon, 3)} is {round(distance / 1000, 1)}km away from fire!"
+        for label, lat, lon, distance in zip(ranked["label"], ranked["latitude"], ranked["longitude"],
+                                             ranked["distance_m"])
+    ]
+    return ranked[columns].reset_index(drop=True)
@@ -0,0 +1,300 @@
+"""
+Pre-burn and post-burn Sentinel-2 true colour chips for burned area comparisons, without a tile server.
+
+For each chip and date window the least cloudy Sentinel-2 L2A item covering the chip is picked from the Element84
+STAC. Only the chip window of its visual COG is read, from the overview closest to the requested resolution, so GDAL
+fetches a few byte ranges instead of the whole 100km tile. RGB chips are cached locally by item and bounds, and the
+before/after figures are rendered from the local arrays with the predicted fire pixels on top.
+"""
+import hashlib
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+import numpy as np
+import rasterio
+import requests
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+from rasterio.crs import CRS
+from rasterio.enums import Resampling
+from rasterio.transform import from_bounds
+from rasterio.vrt import WarpedVRT
+from rasterio.warp import transform_bounds
+from shapely.geometry import box, mapping, shape
+
+from fire_geometry import load_fire_array, read_bbox
+from tiles import colourize
+
+STAC_ITEMS_URL = "https://earth-search.aws.element84.com/v0/collections/sentinel-s2-l2a-cogs/items"
+CACHE_DIR = "s2_cache"
+RESOLUTION = 40  # metres, the 4x overview of the 10m visual COGs
+# only fetch the byte ranges of the window, without listing the bucket or reading sidecar files
+GDAL_ENV = {
+    "GDAL_DISABLE_READDIR_ON_OPEN": "EMPTY_DIR",
+    "CPL_VSIL_CURL_ALLOWED_EXTENSIONS": ".tif",
+    "GDAL_HTTP_MERGE_CONSECUTIVE_RANGES": "YES",
+    "GDAL_HTTP_MULTIPLEX": "YES",
+    "VSI_CACHE": "TRUE",
+}
+_local = threading.local()
+
+
+def _thread_session():
+    # requests sessions are not thread safe, so each worker thread keeps its own connection pool
+    if not hasattr(_local, "session"):
+        _local.session = requests.Session()
+    return _local.session
+
+
+def _cache_key(*parts):
+    return hashlib.sha1("|".join(str(p) for p in parts).encode()).hexdigest()[:16]
+
+
+def _window_closed(datetime_range):
+    """Whether no new item can be published for a datetime range, so its search results can be cached"""
+    end = datetime_range.split("/")[-1]
+    if end in ("", ".."):
+        return False
+    end = datetime.fromisoformat(end.replace("Z", "+00:00"))
+    if end.tzinfo is None:
+        end = end.replace(tzinfo=timezone.utc)
+    return end < datetime.now(timezone.utc)
+
+
+def search_items(bbox_wgs84, datetime_range, max_cloud_cover=None, limit=100, cache_dir=CACHE_DIR, session=None):
+    """
+    Search the Sentinel-2 L2A items intersecting a bounding box, results of past date ranges are cached
+    :param bbox_wgs84: (left, bottom, right, top) in EPSG:4326
+    :param datetime_range: STAC datetime range, e.g. "2021-08-01T00:00:00Z/2021-08-20T00:00:00Z"
+    :param max_cloud_cover: only return items with eo:cloud_cover below this percentage
+    :param limit: maximum number of items
+    :param cache_dir: local directory of the cache, None to disable caching
+    :param session: requests session to reuse connections
+    :return: list of STAC item dicts
+    """
+    body = {"intersects": mapping(box(*bbox_wgs84)), "datetime": datetime_range, "limit": limit}
+    if max_cloud_cover is not None:
+        body["query"] = {"eo:cloud_cover": {"lt": max_cloud_cover}}
+    cache_path = None
+    if cache_dir and _window_closed(datetime_range):
+        cache_path = os.path.join(cache_dir, "search", f"{_cache_key(json.dumps(body, sort_keys=True))}.json")
+        if os.path.exists(cache_path):
+            with open(cache_path) as f:
+                return json.load(f)
+    response = (session or requests).post(STAC_ITEMS_URL, json=body, timeout=60)
+    response.raise_for_status()
+    items = response.json()["features"]
+    if cache_path:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        tmp_path = f"{cache_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(items, f)
+        os.replace(tmp_path, cache_path)
+    return items
+
+
+def least_cloudy_item(items, bbox_wgs84=None):
+    """
+    Pick the item with the lowest cloud cover, preferring items whose footprint covers the whole bounding box
+    :param items: list of STAC item dicts
+    :param bbox_wgs84: (left, bottom, right, top) in EPSG:4326, or None to only rank by cloud cover
+    :return: STAC item dict, or None if there are no items
+    """
+    if not items:
+        return None
+    aoi = box(*bbox_wgs84) if bbox_wgs84 is not None else None
+
+    def rank(item):
+        covers = aoi is None or shape(item["geometry"]).contains(aoi)
+        return not covers, item["properties"].get("eo:cloud_cover", 100)
+
+    return min(items, key=rank)
+
+
+def overview_level(src, resolution):
+    """
+    Coarsest overview of a raster that is still at least as fine as a resolution
+    :param src: open rasterio file handler
+    :param resolution: target pixel size in the units of the raster CRS
+    :return: overview_level to open the raster with, or None for full resolution
+    """
+    level = None
+    for i, factor in enumerate(src.overviews(1)):
+        if src.res[0] * factor <= resolution:
+            level = i
+    return level
+
+
+def read_rgb_window(href, bounds, crs, resolution=RESOLUTION):
+    """
+    Read the RGB of a COG over bounds, on a north up grid in the given CRS
+    Only the overview closest to the resolution is read, and only the blocks overlapping the bounds
+    :param href: URL of the visual COG
+    :param bounds: (left, bottom, right, top) in crs
+    :param crs: rasterio CRS of the output grid
+    :param resolution: pixel size of the output grid in the units of crs
+    :return: uint8 array of shape (height, width, 3), 0 outside the item footprint
+    """
+    left, bottom, right, top = bounds
+    width = int(round((right - left) / resolution))
+    height = int(round((top - bottom) / resolution))
+    transform = from_bounds(left, bottom, right, top, width, height)
+    with rasterio.Env(**GDAL_ENV):
+        with rasterio.open(href) as src:
+            level = overview_level(src, resolution)
+        kwargs = {} if level is None else {"overview_level": level}
+        with rasterio.open(href, **kwargs) as src:
+            with WarpedVRT(
+                src, crs=crs, transform=transform, width=width, height=height, resampling=Resampling.bilinear
+            ) as vrt:
+                rgb = vrt.read([1, 2, 3])
+    return np.moveaxis(rgb, 0, -1)
+
+
+def cached_rgb(item, bounds, crs, resolution=RESOLUTION, cache_dir=CACHE_DIR):
+    """
+    RGB of an item over bounds, read once and then loaded from the local cache
+    :param item: STAC item dict with a visual asset
+    :param bounds: (left, bottom, right, top) in crs
+    :param crs: rasterio CRS of the output grid
+    :param resolution: pixel size of the output grid
+    :param cache_dir: local directory of the cache
+    :return: uint8 array of shape (height, width, 3)
+    """
+    key = _cache_key(item["id"], crs.to_string(), [round(b, 3) for b in bounds], resolution)
+    path = os.path.join(cache_dir, "rgb", f"{item['id']}_{key}.npy")
+    if os.path.exists(path):
+        return np.load(path)
+    rgb = read_rgb_window(item["assets"]["visual"]["href"], bounds, crs, resolution)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # write to a temporary file first, so that a crashed run never leaves a partial chip in the cache
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "wb") as f:
+        np.save(f, rgb)
+    os.replace(tmp_path, path)
+    return rgb
+
+
+def window_rgb(bounds, crs, datetime_range, resolution=RESOLUTION, max_cloud_cover=None, cache_dir=CACHE_DIR,
+               session=None):
+    """
+    RGB of the least cloudy item of a date window over bounds
+    :param bounds: (left, bottom, right, top) in crs
+    :param crs: rasterio CRS of the output grid
+    :param datetime_range: STAC datetime range
+    :param resolution: pixel size of the output grid
+    :param max_cloud_cover: only consider items with eo:cloud_cover below this percentage
+    :param cache_dir: local directory of the cache
+    :param session: requests session to reuse connections
+    :return: dict of rgb, item_id, datetime and cloud_cover, or None if no item was found in the window
+    """
+    bbox_wgs84 = transform_bounds(crs, "EPSG:4326", *bounds)
+    items = search_items(bbox_wgs84, datetime_range, max_cloud_cover, cache_dir=cache_dir, session=session)
+    item = least_cloudy_item(items, bbox_wgs84)
+    if item is None:
+        return None
+    return {
+        "rgb": cached_rgb(item, bounds, crs, resolution, cache_dir),
+        "item_id": item["id"],
+        "datetime": item["properties"]["datetime"],
+        "cloud_cover": item["properties"].get("eo:cloud_cover"),
+    }
+
+
+def chip_before_after(chip_dir, preburn_range, postburn_range, buffer=0, resolution=RESOLUTION,
+                      max_cloud_cover=None, cache_dir=CACHE_DIR, session=None):
+    """
+    Pre-burn and post-burn RGB over a chip footprint
+    :param chip_dir: chip directory with a bbox.geojson
+    :param preburn_range: STAC datetime range before the fire
+    :param postburn_range: STAC datetime range after the fire
+    :param buffer: metres added around the chip footprint
+    :param resolution: pixel size of the RGB in metres
+    :param max_cloud_cover: only consider items with eo:cloud_cover below this percentage
+    :param cache_dir: local directory of the cache
+    :param session: requests session to reuse connections
+    :return: dict of the chip bounds and crs, and the before and after results of window_rgb
+    """
+    poly, epsg = read_bbox(os.path.join(chip_dir, "bbox.geojson"))
+    crs = CRS.from_epsg(epsg)
+    left, bottom, right, top = poly.bounds
+    bounds = (left - buffer, bottom - buffer, right + buffer, top + buffer)
+    kwargs = dict(resolution=resolution, max_cloud_cover=max_cloud_cover, cache_dir=cache_dir, session=session)
+    return {
+        "chip_bounds": poly.bounds,
+        "bounds": bounds,
+        "crs": crs,
+        "before": window_rgb(bounds, crs, preburn_range, **kwargs),
+        "after": window_rgb(bounds, crs, postburn_range, **kwargs),
+    }
+
+
+def plot_before_after(chip_dir, images, array_name="probabilities.npy", threshold=0.5, output_path=None):
+    """
+    Side by side figure of the pre-burn and post-burn RGB with the predicted fire pixels on top
+    Uses a Figure without pyplot, so that figures can be made in a loop without keeping them open
+    :param chip_dir: chip directory with the fire array
+    :param images: result of chip_before_after
+    :param array_name: fire array to overlay, None for no overlay
+    :param threshold: fire values above this are drawn
+    :param output_path: path of the PNG to save, None to only return the figure
+    :return: matplotlib Figure
+    """
+    fig = Figure(figsize=(12, 6))
+    FigureCanvasAgg(fig)
+    left, bottom, right, top = images["bounds"]
+    chip_left, chip_bottom, chip_right, chip_top = images["chip_bounds"]
+    fire = None
+    if array_name is not None:
+        fire = colourize(load_fire_array(os.path.join(chip_dir, array_name)), threshold)
+    for ax, name in zip(fig.subplots(1, 2), ("before", "after")):
+        result = images[name]
+        if result is None:
+            ax.set_title(f"{name}: no Sentinel-2 item")
+        else:
+            ax.imshow(result["rgb"], extent=(left, right, bottom, top))
+            cloud = "" if result["cloud_cover"] is None else f", {result['cloud_cover']:.0f}% cloud"
+            ax.set_title(f"{name}: {result['datetime'][:10]}{cloud}")
+        if fire is not None:
+            ax.imshow(fire, extent=(chip_left, chip_right, chip_bottom, chip_top), interpolation="nearest")
+        ax.set_xlim(left, right)
+        ax.set_ylim(bottom, top)
+        ax.set_axis_off()
+    fig.suptitle(os.path.basename(os.path.normpath(chip_dir)))
+    fig.tight_layout()
+    if output_path is not None:
+        fig.savefig(output_path, dpi=100)
+    return fig
+
+
+def render_comparisons(chip_dirs, output_dir, preburn_range, postburn_range, workers=16, array_name="probabilities.npy",
+                       threshold=0.5, **kwargs):
+    """
+    Render before/after figures for many chips, fetching chips concurrently while figures are rendered
+    :param chip_dirs: chip directories
+    :param output_dir: directory of the PNGs, one per chip named after its directory
+    :param preburn_range: STAC datetime range before the fires
+    :param postburn_range: STAC datetime range after the fires
+    :param workers: number of chips fetched at the same time
+    :param array_name: fire array to overlay, None for no overlay
+    :param threshold: fire values above this are drawn
+    :param kwargs: passed to chip_before_after, e.g. buffer, resolution or cache_dir
+    :return: list of PNG paths
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    paths = []
+
+    def fetch(chip_dir):
+        return chip_before_after(chip_dir, preburn_range, postburn_range, session=_thread_session(), **kwargs)
+
+    with ThreadPoolExecutor(workers) as executor:
+        futures = [executor.submit(fetch, chip_dir) for chip_dir in chip_dirs]
+        # figures are rendered in this thread, as matplotlib is not thread safe
+        for chip_dir, future in zip(chip_dirs, futures):
+            path = os.path.join(output_dir, f"{os.path.basename(os.path.normpath(chip_dir))}.png")
+            plot_before_after(chip_dir, future.result(), array_name, threshold, output_path=path)
+            paths.append(path)
+    return paths
@@ -0,0 +1,237 @@
+"""
+Export chip fire probabilities as a Cloud-Optimized GeoTIFF mosaic and a static XYZ tile pyramid.
+
+Chips are georeferenced from their bbox.geojson (UTM, 500m pixels) and reprojected to WebMercator, overlapping
+chips keep the highest value. Rendered tiles are PNGs in {z}/{x}/{y}.png layout that any web map, including
+ipyleaflet's LocalTileLayer, can load without a tile server. A manifest of rendered chips is kept next to the tiles
+so that only the tiles touched by new or changed chips are rendered again.
+"""
+import hashlib
+import json
+import math
+import os
+import shutil
+
+import affine
+import numpy as np
+import rasterio
+from PIL import Image
+from rasterio.crs import CRS
+from rasterio.enums import Resampling
+from rasterio.io import MemoryFile
+from rasterio.shutil import copy as rio_copy
+from rasterio.warp import reproject, transform_bounds
+
+from fire_geometry import load_fire_array, read_bbox, PIXEL_RES
+
+WEB_MERCATOR = CRS.from_epsg(3857)
+ORIGIN = 20037508.342789244  # half the width of the WebMercator world in metres
+TILE_SIZE = 256
+MANIFEST = "manifest.json"
+FIRE_COLOURS = ["#A10100", "#DA1F05", "#F33C04", "#FE650D", "#FFC11F", "#FFF75D"]
+
+
+def chip_raster(chip_dir, array_name="probabilities.npy"):
+    """
+    Read a chip array with its georeferencing
+    :param chip_dir: directory holding the chip arrays and bbox.geojson
+    :param array_name: array to read
+    :return: float32 2D array, affine transform and CRS
+    """
+    bbox, epsg = read_bbox(os.path.join(chip_dir, "bbox.geojson"))
+    minx, _, _, maxy = bbox.bounds
+    data = load_fire_array(os.path.join(chip_dir, array_name)).astype(np.float32)
+    return data, affine.Affine(PIXEL_RES, 0.0, minx, 0.0, -PIXEL_RES, maxy), CRS.from_epsg(epsg)
+
+
+def _warp_into(destination, dst_transform, chips):
+    """
+    Reproject chips into a destination grid of NaN, keeping the max where chips overlap. Max resampling keeps
+    single fire pixels visible on low zoom tiles.
+    """
+    scratch = np.empty_like(destination)
+    for data, src_transform, src_crs in chips:
+        scratch.fill(np.nan)
+        reproject(
+            source=data,
+            destination=scratch,
+            src_transform=src_transform,
+            src_crs=src_crs,
+            src_nodata=np.nan,
+            dst_transform=dst_transform,
+            dst_crs=WEB_MERCATOR,
+            dst_nodata=np.nan,
+            resampling=Resampling.max,
+        )
+        np.fmax(destination, scratch, out=destination)
+    return destination
+
+
+def mosaic_to_cog(chip_dirs, output_path, array_name="probabilities.npy", resolution=PIXEL_RES):
+    """
+    Mosaic chips into a single-band float32 Cloud-Optimized GeoTIFF in WebMercator with overviews
+    :param chip_dirs: chip directories holding the arrays and bbox.geojson
+    :param output_path: path of the COG to write
+    :param array_name: array to mosaic, e.g. probabilities.npy or classification.npy
+    :param resolution: pixel size of the mosaic in WebMercator metres
+    :return: output_path
+    """
+    chips = [chip_raster(chip_dir, array_name) for chip_dir in chip_dirs]
+    bounds = np.array([
+        transform_bounds(crs, WEB_MERCATOR, *rasterio.transform.array_bounds(*data.shape, tf))
+        for data, tf, crs in chips
+    ])
+    left, bottom = bounds[:, 0].min(), bounds[:, 1].min()
+    right, top = bounds[:, 2].max(), bounds[:, 3].max()
+    width = int(math.ceil((right - left) / resolution))
+    height = int(math.ceil((top - bottom) / resolution))
+    dst_transform = affine.Affine(resolution, 0.0, left, 0.0, -resolution, top)
+    mosaic = _warp_into(np.full((height, width), np.nan, dtype=np.float32), dst_transform, chips)
+
+    profile = {
+        "driver": "GTiff",
+        "dtype": "float32",
+        "count": 1,
+        "height": height,
+        "width": width,
+        "crs": WEB_MERCATOR,
+        "transform": dst_transform,
+        "nodata": np.nan,
+    }
+    with MemoryFile() as memfile:
+        with memfile.open(**profile) as dst:
+            dst.write(mosaic, 1)
+        with memfile.open() as src:
+            rio_copy(src, output_path, driver="COG", compress="DEFLATE", overview_resampling="average")
+    return output_path
+
+
+def tile_bounds(x, y, z):
+    """WebMercator bounds (left, bottom, right, top) of an XYZ tile"""
+    size = 2 * ORIGIN / 2 ** z
+    left = -ORIGIN + x * size
+    top = ORIGIN - y * size
+    return left, top - size, left + size, top
+
+
+def tiles_for_bounds(bounds, z):
+    """XYZ tiles at zoom z intersecting WebMercator bounds (left, bottom, right, top)"""
+    size = 2 * ORIGIN / 2 ** z
+    left, bottom, right, top = bounds
+    x_min = max(int((left + ORIGIN) // size), 0)
+    x_max = min(int((right + ORIGIN) // size), 2 ** z - 1)
+    y_min = max(int((ORIGIN - top) // size), 0)
+    y_max = min(int((ORIGIN - bottom) // size), 2 ** z - 1)
+    return [(x, y, z) for x in range(x_min, x_max + 1) for y in range(y_min, y_max + 1)]
+
+
+def colourize(values, threshold=0.0, colours=FIRE_COLOURS, alpha=200):
+    """
+    Map values in [threshold, 1] onto the fire colour ramp as RGBA, values at or below threshold are transparent
+    :param values: 2D float array
+    :param threshold: values above this are drawn
+    :param colours: hex colours from low to high values
+    :param alpha: opacity of drawn pixels
+    :return: uint8 array of shape (h, w, 4)
+    """
+    ramp = np.array([[int(c.strip().lstrip("#")[i:i + 2], 16) for i in (0, 2, 4)] for c in colours], dtype=np.float32)
+    scaled = np.clip((np.nan_to_num(values, nan=0.0) - threshold) / max(1.0 - threshold, 1e-6), 0, 1)
+    position = scaled * (len(colours) - 1)
+    lower = np.floor(position).astype(int)
+    upper = np.minimum(lower + 1, len(colours) - 1)
+    weight = (position - lower)[..., None]
+    rgba = np.zeros(values.shape + (4,), dtype=np.uint8)
+    rgba[..., :3] = (ramp[lower] * (1 - weight) + ramp[upper] * weight).astype(np.uint8)
+    rgba[..., 3] = np.where(np.nan_to_num(values, nan=-np.inf) > threshold, alpha, 0)
+    return rgba
+
+
+def _chip_signature(chip_dir, array_name):
+    """Hash of a chip's array and bbox, so changed chips are rendered again"""
+    digest = hashlib.sha1()
+    for name in (array_name, "bbox.geojson"):
+        with open(os.path.join(chip_dir, name), "rb") as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+
+def _clear_tiles(output_dir):
+    """Remove the {z} directories of a tile pyramid, keeping any other files in output_dir"""
+    for name in os.listdir(output_dir):
+        if name.isdigit() and os.path.isdir(os.path.join(output_dir, name)):
+            shutil.rmtree(os.path.join(output_dir, name))
+
+
+def render_tiles(chip_dirs, output_dir, zooms=range(5, 13), array_name="probabilities.npy", threshold=None):
+    """
+    Render an XYZ PNG tile pyramid of chip fire values, only re-rendering tiles touched by new or changed chips
+    :param chip_dirs: all chip directories to show, chips missing from a previous run have their tiles cleared
+    :param output_dir: directory of the {z}/{x}/{y}.png tiles
+    :param zooms: zoom levels to render
+    :param array_name: array to render
+    :param threshold: values above this are drawn, defaults to 0.5 for probabilities and 0 otherwise
+    :return: number of tiles written
+    """
+    if threshold is None:
+        threshold = 0.5 if "probabilities" in array_name else 0
+    zooms = list(zooms)
+    manifest_path = os.path.join(output_dir, MANIFEST)
+    previous = {}
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            previous = json.load(f)
+    settings = {"array_name": array_name, "threshold": threshold, "zooms": zooms}
+    if previous and previous.get("settings") != settings:
+        # every tile is rendered again, clear the old pyramid so that tiles of removed chips or dropped zooms go too
+        _clear_tiles(output_dir)
+        previous = {}
+    previous_chips = previous.get("chips", {})
+
+    chips = {}
+    for chip_dir in chip_dirs:
+        bbox, epsg = read_bbox(os.path.join(chip_dir, "bbox.geojson"))
+        chips[chip_dir] = {
+            "signature": _chip_signature(chip_dir, array_name),
+            "bounds": transform_bounds(CRS.from_epsg(epsg), WEB_MERCATOR, *bbox.bounds),
+        }
+
+    changed = [c for c in chips if previous_chips.get(c, {}).get("signature") != chips[c]["signature"]]
+    removed = [c for c in previous_chips if c not in chips]
+    dirty = set()
+    for chip in changed:
+        for z in zooms:
+            dirty.update(tiles_for_bounds(chips[chip]["bounds"], z))
+    for chip in removed:
+        for z in zooms:
+            dirty.update(tiles_for_bounds(previous_chips[chip]["bounds"], z))
+
+    # chips covering each dirty tile, computed once per chip rather than per tile
+    tile_chips = {}
+    for chip in chips:
+        for z in zooms:
+            for tile in tiles_for_bounds(chips[chip]["bounds"], z):
+                if tile in dirty:
+                    tile_chips.setdefault(tile, []).append(chip)
+
+    rasters = {}
+    for x, y, z in dirty:
+        tile_path = os.path.join(output_dir, str(z), str(x), f"{y}.png")
+        covering = tile_chips.get((x, y, z), [])
+        if not covering:
+            if os.path.exists(tile_path):
+                os.remove(tile_path)
+            continue
+        for chip in covering:
+            if chip not in rasters:
+                rasters[chip] = chip_raster(chip, array_name)
+        left, bottom, right, top = tile_bounds(x, y, z)
+        dst_transform = affine.Affine((right - left) / TILE_SIZE, 0.0, left, 0.0, -(top - bottom) / TILE_SIZE, top)
+        values = _warp_into(np.full((TILE_SIZE, TILE_SIZE), np.nan, dtype=np.float32), dst_transform,
+                            [rasters[chip] for chip in covering])
+        os.makedirs(os.path.dirname(tile_path), exist_ok=True)
+        Image.fromarray(colourize(values, threshold), mode="RGBA").save(tile_path)
+
+    os.makedirs(output_dir, exist_ok=True)
+    with open(manifest_path, "w") as f:
+        json.dump({"settings": settings, "chips": chips}, f)
+    return sum(1 for tile in dirty if tile in tile_chips)